@@ -1,12 +1,41 @@
 import os
+import argparse
+import csv
+import fcntl
+import functools
+import hashlib
+import hmac
+import gzip
+import io
+import json
+import math
 import yaml
+import re
 import secrets
+import shutil
+import signal
+import socket
+import sqlite3
 import string
 import subprocess
+import tempfile
+import urllib.parse
+import base64
+import cProfile
+import marshal
+import pstats
+import bisect
+import heapq
+import threading
 import time
 import requests
-from datetime import datetime, date
-from flask import Flask, render_template_string, request, redirect, url_for, flash, jsonify
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from datetime import datetime, date, timedelta, timezone
+from types import MappingProxyType
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g
+from flask import before_render_template, template_rendered
+from werkzeug.serving import BaseWSGIServer
 
 # --- CONFIGURATION ---
 # Change this to your actual domain
@@ -19,52 +48,431 @@ CONFIG_FILE = 'config.yaml'
 BINARY_PATH = './outline-ss-server'
 METRICS_PORT = 9091
 METRICS_URL = f"http://127.0.0.1:{METRICS_PORT}/metrics"
+SERVER_LOG_FILE = 'outline.log'
+# Compiled copy of the parsed config (JSON, next to CONFIG_FILE) that warm
+# starts load instead of re-parsing the YAML; ignored unless its hash
+# matches the config file. Set to None to disable.
+CONFIG_SNAPSHOT_SUFFIX = '.snapshot.json'
+# Where users are kept. 'sqlite': USERS_DB_FILE is the source of truth and
+# CONFIG_FILE is rendered from it with server fields only (hand edits there
+# are overwritten; use --import-config); an existing CONFIG_FILE is imported
+# on first start. 'yaml': everything lives in CONFIG_FILE, as before.
+USER_STORE = 'sqlite'
+USERS_DB_FILE = 'users.db'
+# Key fields outline-ss-server reads; everything else is admin-only
+SERVER_KEY_FIELDS = ('id', 'port', 'cipher', 'secret')
+# Background metrics scraper: seconds between scrapes and per-scrape timeout
+METRICS_SCRAPE_INTERVAL = 10
+METRICS_SCRAPE_TIMEOUT = 2
+# Persistent per-key usage history (SQLite) and how long to keep each rollup
+USAGE_DB_FILE = 'usage.db'
+USAGE_HOURLY_RETENTION_DAYS = 14
+USAGE_DAILY_RETENTION_DAYS = 400
+# outline-ss-server re-reads its config on SIGHUP without dropping tunnels.
+# Set to None to always do a full restart (e.g. for a binary without it).
+SERVER_RELOAD_SIGNAL = signal.SIGHUP
+# Seconds to wait for a stopped server to exit / a new one to open METRICS_PORT
+SERVER_STOP_TIMEOUT = 5
+SERVER_READY_TIMEOUT = 10
+# Config changes are saved at once but applied to the server in the
+# background: one reload after RELOAD_DEBOUNCE quiet seconds covers every
+# change in the burst, and no change waits longer than RELOAD_MAX_DELAY
+RELOAD_DEBOUNCE = 2
+RELOAD_MAX_DELAY = 10
+# Ciphers offered in the admin UI and accepted by bulk import
+CIPHERS = ('chacha20-ietf-poly1305', 'aes-256-gcm', 'aes-128-gcm')
+DEFAULT_CIPHER = 'chacha20-ietf-poly1305'
+# Upper bound on users created by one /bulk request
+BULK_MAX_USERS = 5000
+# Keys can be spread over several services ("shards"), each with its own
+# websocket paths, so a new connection is only trial-decrypted against one
+# shard's keys. Key id % shard count picks the shard; shard 0 keeps the
+# original paths and shard N gets SHARD_PATH_FORMAT (e.g. /tcp-ray-3).
+# Only the first SHARDS_FIELD services (a top-level config entry written by
+# /shards, ignored by outline-ss-server) are shards; any other service is
+# left exactly as it is, keys included.
+SHARD_PATH_FORMAT = '{path}-{shard}'
+SHARDS_FIELD = 'admin_shards'
+MAX_SHARDS = 64
+# Dashboard paging, and what counts as "expiring soon"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+EXPIRING_SOON_DAYS = 7
+# What happens to keys past their expire_date: 'disable' moves them to the
+# top-level disabled_keys list (kept for re-enabling), 'delete' removes them,
+# None leaves them working and only marks them in the dashboard
+EXPIRED_KEY_ACTION = 'disable'
+# Longest the expiry scheduler sleeps before re-checking the config
+EXPIRY_CHECK_INTERVAL = 60
+# Seconds between dashboard polls of /dashboard/data
+DASHBOARD_POLL_INTERVAL = 10
+# Live throughput (/dashboard/stream): scrape interval while a dashboard is
+# subscribed, relative rate change worth pushing, size of the top-talkers
+# list, open streams allowed (each holds an admin thread) and seconds
+# between keepalives
+LIVE_SCRAPE_INTERVAL = 2
+RATE_CHANGE_THRESHOLD = 0.05
+TOP_TALKERS = 10
+STREAM_MAX_CLIENTS = 8
+STREAM_KEEPALIVE = 15
+# Responses at least this large are gzip-compressed for clients that accept it
+GZIP_MIN_SIZE = 1024
+# Rendered client configs kept in memory (LRU) and how long /api responses
+# may be cached by clients and intermediaries before revalidating
+CLIENT_CONFIG_CACHE_SIZE = 10000
+API_CACHE_MAX_AGE = 300
+# /api abuse limits: a token bucket per client IP (burst size, refill per
+# second) over at most API_RATE_MAX_CLIENTS addresses (least recently seen
+# dropped first), and how long / how many secrets that matched no key are
+# answered 404 from memory
+API_RATE_BURST = 20
+API_RATE_PER_SECOND = 1
+API_RATE_MAX_CLIENTS = 10000
+API_NEGATIVE_TTL = 30
+API_NEGATIVE_CACHE_SIZE = 10000
+# Peers whose X-Forwarded-For header is believed (Caddy on this host)
+TRUSTED_PROXIES = ('127.0.0.1', '::1')
+# Host/port put into classic ss:// URLs. These have no websocket transport,
+# so they only work against a plain TCP Shadowsocks listener.
+SS_URL_PORT = 443
+GZIP_MIMETYPES = {'text/html', 'application/json', 'text/yaml', 'text/csv', 'text/css', 'application/javascript'}
+# Bucket bounds (seconds) of the panel's own latency histograms (/admin-metrics)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Fleet mode: further outline-ss-server nodes, each running agent.py. The
+# registry file lists name/url/token per node; this machine is LOCAL_NODE.
+# Every push and scrape goes to all nodes at once, FLEET_TIMEOUT per node.
+NODES_FILE = 'nodes.yaml'
+LOCAL_NODE = 'local'
+FLEET_TIMEOUT = 5
+FLEET_WORKERS = 16
+# Public endpoints /api may send a client to, as (domain, node whose
+# throughput measures its load). A key stays on its endpoint for at least
+# ENDPOINT_STICKY seconds and then only moves if another one is lighter
+# by more than ENDPOINT_HYSTERESIS; ENDPOINT_ASSIGNMENTS bounds how many
+# keys' choices are remembered. A pool of one is the single-domain setup.
+ENDPOINTS = ((DOMAIN, LOCAL_NODE),)
+ENDPOINT_STICKY = 3600
+ENDPOINT_HYSTERESIS = 0.25
+ENDPOINT_ASSIGNMENTS = 100000
+
+# Production serving (python admin.py): the admin UI and the public /api
+# listener run as separate servers, each with its own thread pool, so /api
+# traffic from Caddy (:8443) cannot starve the admin UI or vice versa.
+ADMIN_HOST = '0.0.0.0'
+ADMIN_PORT = 5000
+ADMIN_THREADS = 16
+API_HOST = '127.0.0.1'
+API_PORT = 5001
+API_THREADS = 32
+# Seconds in-flight requests get to finish on SIGTERM/SIGINT
+SHUTDOWN_TIMEOUT = 10
+# Request profiling (cProfile), off by default. PROFILE_ENV set to '*'
+# profiles every request, or a comma-separated list of endpoint names
+# (e.g. 'index,api_get_client_key') just those; ?profile=1 profiles one
+# admin page. The last PROFILE_KEEP profiles are listed at /profiles.
+PROFILE_ENV = 'OUTLINE_ADMIN_PROFILE'
+PROFILE_KEEP = 20
+# Lines of the text report (/profiles/<id>?format=text)
+PROFILE_TEXT_LINES = 60
+# Flask session signing key, shared by all workers (created on first run)
+SECRET_KEY_FILE = '.admin_secret_key'
+
+def load_secret_key():
+    """Read the session key, creating it atomically if this is the first worker"""
+    try:
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    # A worker racing the creator may briefly see an empty file
+    for _ in range(50):
+        with open(SECRET_KEY_FILE) as f:
+            key = f.read().strip()
+        if key:
+            return key
+        time.sleep(0.01)
+    raise RuntimeError(f"Empty secret key file '{SECRET_KEY_FILE}'")
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+app.secret_key = os.environ.get('ADMIN_SECRET_KEY') or load_secret_key()
 
 # --- HTML TEMPLATE (Embedded for single-file simplicity) ---
+# Shared CSS/JS are served from /assets (see STATIC ASSETS below)
+
+ADMIN_CSS = """
+body { font-family: sans-serif; margin: 40px auto; padding: 20px; }
+body.page-index { max-width: 1000px; background: #f4f7f6; }
+body.page-form { max-width: 600px; }
+h1 { color: #333; }
+table { width: 100%; border-collapse: collapse; margin-top: 20px; background: white; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }
+th, td { border: 1px solid #ddd; padding: 12px; text-align: left; }
+th { background-color: #007bff; color: white; }
+tr:hover { background-color: #f1f1f1; }
+.btn { padding: 8px 12px; text-decoration: none; color: white; border-radius: 4px; border: none; cursor: pointer; display: inline-block; margin: 2px; font-size: 14px; }
+.page-form .btn { padding: 10px 20px; margin: 5px 10px 5px 0; font-size: inherit; }
+.btn-green { background-color: #4CAF50; }
+.btn-red { background-color: #f44336; }
+.btn-blue { background-color: #008CBA; }
+.btn-orange { background-color: #ff9800; }
+.btn-gray { background-color: #6c757d; }
+.btn-purple { background-color: #6f42c1; }
+.box { background: #f9f9f9; padding: 15px; border: 1px solid #ddd; margin-bottom: 20px; border-radius: 4px; }
+textarea { width: 100%; height: 150px; }
+.page-client textarea { height: 300px; font-family: monospace; padding: 10px; box-sizing: border-box; }
+.page-index form { display: inline; }
+.form-group { margin-bottom: 15px; }
+.form-group label { display: block; margin-bottom: 5px; font-weight: bold; }
+.form-group input, .form-group select { width: 100%; padding: 8px; box-sizing: border-box; }
+.button-group { margin: 15px 0; }
+.secret-masked { font-family: monospace; font-size: 0.9em; }
+.badge { padding: 5px 10px; border-radius: 12px; background: #e9ecef; font-weight: bold; font-size: 0.9em; display: inline-block; }
+.badge-active { background: #d4edda; color: #155724; }
+.status-dot { display: inline-block; width: 10px; height: 10px; border-radius: 50%; margin-right: 5px; }
+.status-active { background-color: #28a745; }
+.status-idle { background-color: #6c757d; }
+.usage-info { font-size: 0.85em; color: #666; margin-top: 5px; }
+.expired { background-color: #f8d7da !important; }
+.expired-text { color: #dc3545; font-weight: bold; }
+.expire-date { font-size: 0.9em; }
+.search-box { background: #e9ecef; padding: 15px; border: 1px solid #ddd; margin-bottom: 20px; border-radius: 4px; }
+.search-form { display: flex; gap: 10px; align-items: center; }
+.search-input { flex: 1; padding: 8px 12px; border: 1px solid #ddd; border-radius: 4px; font-size: 14px; }
+.copy-success { color: #28a745; font-size: 0.85em; margin-left: 5px; }
+.reload-pending { color: #856404; font-weight: bold; }
+.live-rate { color: #007bff; font-weight: bold; }
+.reload-error { color: #dc3545; font-weight: bold; }
+"""
+
+ADMIN_JS = """
+// Page settings are passed in by the template as window.ADMIN
+const API_BASE_URL = window.ADMIN.apiBaseUrl;
+let dataEtag = null;
+
+function formatBytes(bytes) {
+    // Same output as Jinja's filesizeformat (decimal units)
+    if (bytes === 1) return '1 Byte';
+    if (bytes < 1000) return Math.round(bytes) + ' Bytes';
+    const units = ['kB', 'MB', 'GB', 'TB', 'PB', 'EB'];
+    let unit = -1;
+    do { bytes /= 1000; unit++; } while (bytes >= 1000 && unit < units.length - 1);
+    return bytes.toFixed(1) + ' ' + units[unit];
+}
+
+function statusHtml(status, reason) {
+    if (status === 'disabled') return '<span class="status-dot status-idle"></span><span style="color: #6c757d;">Disabled (' + reason + ')</span>';
+    if (status === 'expired') return '<span class="expired-text">● Expired</span>';
+    if (status === 'active') return '<span class="status-dot status-active"></span><span style="color: #28a745;">Active</span>';
+    return '<span class="status-dot status-idle"></span><span style="color: #6c757d;">Idle</span>';
+}
+
+function applyData(data) {
+    const rows = document.querySelectorAll('tbody tr[data-id]');
+    const shown = Array.from(rows, function(tr) { return tr.dataset.id; });
+    const fresh = data.keys.map(function(k) { return String(k.id); });
+    if (shown.join(',') !== fresh.join(',')) {
+        // Users were added/removed/reordered: re-render the page
+        location.reload();
+        return;
+    }
+    data.keys.forEach(function(key, i) {
+        const tr = rows[i];
+        if (tr.dataset.expired !== String(key.is_expired)) {
+            location.reload();
+            return;
+        }
+        const usage = tr.querySelector('[data-field=usage]');
+        const usageHtml = '<span class="badge' + (key.live_bytes > 0 ? ' badge-active' : '') + '">' + formatBytes(key.usage_bytes) + '</span>'
+            + (key.usage_bytes === 0 ? '<div class="usage-info">No data usage recorded</div>' : '')
+            + (key.quota_bytes ? '<div class="usage-info">' + formatBytes(key.month_bytes) + ' of ' + formatBytes(key.quota_bytes) + ' this month</div>' : '');
+        if (usage.dataset.html !== usageHtml) {
+            usage.innerHTML = usage.dataset.html = usageHtml;
+        }
+        const status = tr.querySelector('[data-field=status]');
+        if (status.dataset.status !== key.status) {
+            status.innerHTML = statusHtml(key.status, key.disabled_reason);
+            status.dataset.status = key.status;
+        }
+    });
+    const reload = document.getElementById('reload-info');
+    reload.textContent = data.reload.text;
+    reload.className = 'usage-info reload-' + data.reload.state;
+    const info = document.getElementById('metrics-info');
+    info.textContent = 'Data Usage is the persistent total across server restarts. '
+        + (data.metrics.age === null ? 'Usage stats: waiting for the first metrics scrape'
+           : 'Usage stats as of ' + Math.round(data.metrics.age) + 's ago')
+        + (data.metrics.error ? ' (⚠️ last scrape failed: ' + data.metrics.error + ')' : '');
+}
+
+function pollData() {
+    const headers = dataEtag ? {'If-None-Match': dataEtag} : {};
+    fetch(window.ADMIN.dataUrl, {headers: headers, cache: 'no-store', credentials: 'same-origin'}).then(function(response) {
+        if (response.status === 200) {
+            dataEtag = response.headers.get('ETag');
+            return response.json().then(applyData);
+        }
+        // 304: nothing changed since the last poll
+    }).catch(function() {}).finally(function() {
+        setTimeout(pollData, window.ADMIN.pollInterval * 1000);
+    });
+}
+if (window.ADMIN.dataUrl) {
+    setTimeout(pollData, window.ADMIN.pollInterval * 1000);
+}
+
+function formatRate(bytesPerSecond) {
+    return formatBytes(bytesPerSecond) + '/s';
+}
+
+function applyRates(data) {
+    document.querySelectorAll('tbody tr[data-id]').forEach(function(tr) {
+        const id = tr.dataset.id;
+        if (!(id in data.rates) && !data.full) return;
+        const rate = data.rates[id] || 0;
+        tr.querySelector('[data-field=rate]').textContent = rate ? '↕ ' + formatRate(rate) : '';
+    });
+}
+
+function applyTopTalkers(talkers) {
+    const list = document.getElementById('top-talkers');
+    list.innerHTML = '';
+    if (!talkers.length) {
+        list.innerHTML = '<li>No traffic right now</li>';
+        return;
+    }
+    talkers.forEach(function(talker) {
+        const li = document.createElement('li');
+        li.textContent = '#' + talker.id + (talker.name ? ' ' + talker.name : '') + ' — ' + formatRate(talker.rate);
+        list.appendChild(li);
+    });
+}
+
+if (window.ADMIN.streamUrl && window.EventSource) {
+    // One shared server-side sampler feeds every open dashboard
+    const stream = new EventSource(window.ADMIN.streamUrl);
+    stream.addEventListener('rates', function(e) { applyRates(JSON.parse(e.data)); });
+    stream.addEventListener('top', function(e) { applyTopTalkers(JSON.parse(e.data)); });
+    stream.onerror = function() {
+        if (stream.readyState === EventSource.CLOSED) {
+            document.getElementById('top-talkers').innerHTML = '<li>Live stream unavailable</li>';
+        }
+    };
+}
+
+function copyApiUrl(secret, button) {
+    const apiUrl = API_BASE_URL + '/api?key=' + secret;
+
+    // Check if clipboard API is available
+    if (navigator.clipboard && navigator.clipboard.writeText) {
+        navigator.clipboard.writeText(apiUrl).then(function() {
+            const originalText = button.textContent;
+            button.textContent = '✓ Copied!';
+            button.style.backgroundColor = '#28a745';
+            setTimeout(function() {
+                button.textContent = originalText;
+                button.style.backgroundColor = '#6f42c1';
+            }, 2000);
+        }).catch(function(err) {
+            // Fallback if clipboard API fails
+            fallbackCopy(apiUrl, button);
+        });
+    } else {
+        // Use fallback for browsers without clipboard API
+        fallbackCopy(apiUrl, button);
+    }
+}
+
+function fallbackCopy(text, button) {
+    const textarea = document.createElement('textarea');
+    textarea.value = text;
+    textarea.style.position = 'fixed';
+    textarea.style.top = '0';
+    textarea.style.left = '0';
+    textarea.style.width = '2em';
+    textarea.style.height = '2em';
+    textarea.style.padding = '0';
+    textarea.style.border = 'none';
+    textarea.style.outline = 'none';
+    textarea.style.boxShadow = 'none';
+    textarea.style.background = 'transparent';
+    textarea.style.opacity = '0';
+    document.body.appendChild(textarea);
+    textarea.focus();
+    textarea.select();
+    try {
+        const successful = document.execCommand('copy');
+        if (successful) {
+            const originalText = button.textContent;
+            button.textContent = '✓ Copied!';
+            button.style.backgroundColor = '#28a745';
+            setTimeout(function() {
+                button.textContent = originalText;
+                button.style.backgroundColor = '#6f42c1';
+            }, 2000);
+        } else {
+            alert('Failed to copy. Please copy manually: ' + text);
+        }
+    } catch (err) {
+        alert('Failed to copy. Please copy manually: ' + text);
+    }
+    document.body.removeChild(textarea);
+}
+
+function copyYaml(button) {
+    const yamlText = document.querySelector('textarea').value;
+
+    // Check if clipboard API is available
+    if (navigator.clipboard && navigator.clipboard.writeText) {
+        navigator.clipboard.writeText(yamlText).then(function() {
+                const originalText = button.textContent;
+            button.textContent = '✓ Copied!';
+            button.style.backgroundColor = '#28a745';
+            setTimeout(function() {
+                button.textContent = originalText;
+                button.style.backgroundColor = '#008CBA';
+            }, 2000);
+        }).catch(function(err) {
+            // Fallback if clipboard API fails
+            const textarea = document.querySelector('textarea');
+            textarea.select();
+            try {
+                const successful = document.execCommand('copy');
+                if (successful) {
+                    alert('YAML config copied to clipboard!');
+                } else {
+                    alert('Failed to copy. Please select and copy manually.');
+                }
+            } catch (err) {
+                alert('Failed to copy. Please select and copy manually.');
+            }
+        });
+    } else {
+        // Use fallback for browsers without clipboard API
+        const textarea = document.querySelector('textarea');
+        textarea.select();
+        try {
+            const successful = document.execCommand('copy');
+            if (successful) {
+                alert('YAML config copied to clipboard!');
+            } else {
+                alert('Failed to copy. Please select and copy manually.');
+            }
+        } catch (err) {
+            alert('Failed to copy. Please select and copy manually.');
+        }
+    }
+}
+"""
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
     <title>Outline User Manager</title>
-    <meta http-equiv="refresh" content="30">
-    <style>
-        body { font-family: sans-serif; max-width: 1000px; margin: 40px auto; padding: 20px; background: #f4f7f6; }
-        h1 { color: #333; }
-        table { width: 100%; border-collapse: collapse; margin-top: 20px; background: white; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }
-        th, td { border: 1px solid #ddd; padding: 12px; text-align: left; }
-        th { background-color: #007bff; color: white; }
-        tr:hover { background-color: #f1f1f1; }
-        .btn { padding: 8px 12px; text-decoration: none; color: white; border-radius: 4px; border: none; cursor: pointer; display: inline-block; margin: 2px; font-size: 14px; }
-        .btn-green { background-color: #4CAF50; }
-        .btn-red { background-color: #f44336; }
-        .btn-blue { background-color: #008CBA; }
-        .btn-orange { background-color: #ff9800; }
-        .box { background: #f9f9f9; padding: 15px; border: 1px solid #ddd; margin-bottom: 20px; border-radius: 4px; }
-        textarea { width: 100%; height: 150px; }
-        .secret-masked { font-family: monospace; font-size: 0.9em; }
-        form { display: inline; }
-        .badge { padding: 5px 10px; border-radius: 12px; background: #e9ecef; font-weight: bold; font-size: 0.9em; display: inline-block; }
-        .badge-active { background: #d4edda; color: #155724; }
-        .status-dot { display: inline-block; width: 10px; height: 10px; border-radius: 50%; margin-right: 5px; }
-        .status-active { background-color: #28a745; }
-        .status-idle { background-color: #6c757d; }
-        .usage-info { font-size: 0.85em; color: #666; margin-top: 5px; }
-        .expired { background-color: #f8d7da !important; }
-        .expired-text { color: #dc3545; font-weight: bold; }
-        .expire-date { font-size: 0.9em; }
-        .search-box { background: #e9ecef; padding: 15px; border: 1px solid #ddd; margin-bottom: 20px; border-radius: 4px; }
-        .search-form { display: flex; gap: 10px; align-items: center; }
-        .search-input { flex: 1; padding: 8px 12px; border: 1px solid #ddd; border-radius: 4px; font-size: 14px; }
-        .btn-gray { background-color: #6c757d; }
-        .btn-purple { background-color: #6f42c1; }
-        .copy-success { color: #28a745; font-size: 0.85em; margin-left: 5px; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
 </head>
-<body>
+<body class="page-index">
     <h1>🚀 Outline User Manager</h1>
 
     {% with messages = get_flashed_messages() %}
@@ -78,16 +486,23 @@ HTML_TEMPLATE = """
     <div class="search-box">
         <form action="/" method="get" class="search-form">
             <input type="text" name="search" class="search-input" placeholder="🔍 Search by username..." value="{{ search_query or '' }}">
+            <select name="filter" style="padding: 8px;">
+                {% for f in filters %}
+                <option value="{{ f }}" {% if view.status_filter == f %}selected{% endif %}>{{ f|capitalize }}</option>
+                {% endfor %}
+            </select>
+            <input type="hidden" name="sort" value="{{ view.sort }}">
+            <input type="hidden" name="order" value="{{ 'desc' if view.descending else 'asc' }}">
+            <input type="hidden" name="page_size" value="{{ view.page_size }}">
             <button type="submit" class="btn btn-blue">Search</button>
-            {% if search_query %}
+            {% if search_query or view.status_filter != 'all' %}
             <a href="/" class="btn btn-gray">Clear</a>
             {% endif %}
         </form>
-        {% if search_query %}
         <p style="margin-top: 10px; font-size: 0.9em; color: #666;">
-            Showing results for "{{ search_query }}" ({{ keys|length }} result{% if keys|length != 1 %}s{% endif %})
+            {% if search_query %}Showing results for "{{ search_query }}": {% endif %}
+            {{ total }} of {{ key_count }} user{% if key_count != 1 %}s{% endif %} match
         </p>
-        {% endif %}
     </div>
 
     <div class="box">
@@ -97,27 +512,117 @@ HTML_TEMPLATE = """
                 <input type="date" name="expire_date" id="expire_date" style="padding: 8px; width: 200px;">
                 <small style="color: #666; margin-left: 10px;">Leave empty for no expiration</small>
             </div>
-            <button type="submit" class="btn btn-green">➕ Add New User & Restart Server</button>
+            <button type="submit" class="btn btn-green">➕ Add New User</button>
         </form>
-        <p style="margin-top: 10px; font-size: 0.9em; color: #666;">Page auto-refreshes every 30 seconds to update usage stats</p>
+        <details style="margin-top: 10px;">
+            <summary style="cursor: pointer; font-weight: bold;">Bulk add / import users</summary>
+            <form action="/bulk" method="post" enctype="multipart/form-data" style="display: block; margin-top: 10px;">
+                <div style="margin-bottom: 10px;">
+                    <label for="bulk_count">Number of users:</label>
+                    <input type="number" name="count" id="bulk_count" min="1" max="{{ bulk_max_users }}" style="padding: 8px; width: 100px;">
+                    <label for="bulk_expire_date" style="margin-left: 10px;">Expire Date:</label>
+                    <input type="date" name="expire_date" id="bulk_expire_date" style="padding: 8px;">
+                </div>
+                <div style="margin-bottom: 10px;">
+                    <label for="bulk_data">...or paste a CSV (name,cipher,expire_date) or JSON list:</label>
+                    <textarea name="data" id="bulk_data" style="height: 80px;" placeholder="name,cipher,expire_date&#10;Alice,chacha20-ietf-poly1305,2030-01-31"></textarea>
+                    <input type="file" name="file" accept=".csv,.json,text/csv,application/json">
+                </div>
+                <label for="bulk_output">Download as:</label>
+                <select name="output" id="bulk_output" style="padding: 8px;">
+                    <option value="yaml">YAML (client configs)</option>
+                    <option value="json">JSON (client configs)</option>
+                    <option value="csv">CSV (API URLs)</option>
+                </select>
+                <button type="submit" class="btn btn-green">➕ Create Users</button>
+            </form>
+        </details>
+        <details style="margin-top: 10px;">
+            <summary style="cursor: pointer; font-weight: bold;">Shards ({{ shards|length }})</summary>
+            <p class="usage-info">
+                Each shard is a service with its own paths; a new connection is only checked against its shard's keys.
+                {% for shard in shards %}<br>Shard {{ loop.index0 }}: {{ shard.paths[0] }}, {{ shard.paths[1] }} &mdash; {{ shard.key_count }} key{% if shard.key_count != 1 %}s{% endif %}{% endfor %}
+            </p>
+            <form action="/shards" method="post" style="display: block;" onsubmit="return confirm('Move keys between shards? Clients with static configs of moved keys must re-download them.');">
+                <label for="shard_count">Number of shards:</label>
+                <input type="number" name="count" id="shard_count" min="1" max="{{ max_shards }}" value="{{ shards|length or 1 }}" style="padding: 8px; width: 80px;">
+                <button type="submit" class="btn btn-orange">Rebalance</button>
+            </form>
+        </details>
+        <p style="margin-top: 10px; font-size: 0.9em; color: #666;">Usage stats update in place every {{ poll_interval }} seconds</p>
+    </div>
+
+    <p class="usage-info reload-{{ reload.state }}" id="reload-info">{{ reload.text }}</p>
+
+    <div class="box">
+        <strong>📈 Top talkers (live)</strong>
+        <ol id="top-talkers" class="usage-info"><li>Waiting for the next metrics scrape…</li></ol>
     </div>
 
+    <p class="usage-info" id="metrics-info">
+        Data Usage is the persistent total across server restarts.
+        {% if metrics_age is none %}
+            Usage stats: waiting for the first metrics scrape{% if metrics_error %} (⚠️ {{ metrics_error }}){% endif %}
+        {% else %}
+            Usage stats as of {{ metrics_age|round|int }}s ago{% if metrics_error %} (⚠️ last scrape failed: {{ metrics_error }}){% endif %}
+        {% endif %}
+    </p>
+
+    <details class="box">
+        <summary style="cursor: pointer; font-weight: bold;">Fleet nodes ({{ fleet_nodes|length + 1 }})</summary>
+        <table>
+            <thead><tr><th>Node</th><th>Agent URL</th><th>Last Scrape</th><th>Last Config Push</th><th>Actions</th></tr></thead>
+            <tbody>
+                <tr><td>{{ local_node }}</td><td>(this server)</td><td></td><td></td><td></td></tr>
+                {% for node in fleet_nodes %}
+                <tr>
+                    <td>{{ node.name }}</td>
+                    <td>{{ node.url }}</td>
+                    {% for result in (node.scrape, node.push) %}
+                    <td>{% if not result %}-{% elif result.ok %}✅ {{ '%.2f'|format(result.duration) }}s{% if result.action %} ({{ result.action }}){% endif %}{% else %}<span class="expired-text">⚠️ {{ result.error }}</span>{% endif %}</td>
+                    {% endfor %}
+                    <td>
+                        <form action="{{ url_for('remove_node', name=node.name) }}" method="post" onsubmit="return confirm('Remove node {{ node.name }}?');">
+                            <button type="submit" class="btn btn-red">Remove</button>
+                        </form>
+                    </td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        <form action="{{ url_for('add_node') }}" method="post" class="search-form" style="margin-top: 10px;">
+            <input type="text" name="name" class="search-input" placeholder="Name" required>
+            <input type="text" name="url" class="search-input" placeholder="https://node2.example.com:5002" required>
+            <input type="password" name="token" class="search-input" placeholder="Agent token" required>
+            <button type="submit" class="btn btn-green">➕ Add Node</button>
+        </form>
+        {% if fleet_nodes %}
+        <form action="{{ url_for('push_fleet') }}" method="post" style="margin-top: 10px;">
+            <button type="submit" class="btn btn-blue">🔄 Push Config to All Nodes</button>
+        </form>
+        {% endif %}
+    </details>
+
     <table>
         <thead>
             <tr>
-                <th>ID</th>
-                <th>Name</th>
+                {% macro sort_header(label, sort) -%}
+                <th><a style="color: white;" href="{{ url_for('index', search=search_query, filter=view.status_filter, sort=sort, page_size=view.page_size,
+                    order='asc' if view.sort != sort or view.descending else 'desc') }}">{{ label }}{% if view.sort == sort %} {{ '▼' if view.descending else '▲' }}{% endif %}</a></th>
+                {%- endmacro %}
+                {{ sort_header('ID', 'id') }}
+                {{ sort_header('Name', 'name') }}
                 <th>Cipher</th>
                 <th>Secret</th>
-                <th>Expire Date</th>
-                <th>Data Usage</th>
+                {{ sort_header('Expire Date', 'expiry') }}
+                {{ sort_header('Data Usage', 'usage') }}
                 <th>Status</th>
                 <th>Actions</th>
             </tr>
         </thead>
         <tbody>
             {% for key in keys %}
-            <tr class="{% if key.is_expired %}expired{% endif %}">
+            <tr class="{% if key.is_expired %}expired{% endif %}" data-id="{{ key.id }}" data-expired="{{ key.is_expired|lower }}">
                 <td><strong>{{ key.id }}</strong></td>
                 <td>{{ key.get('name', '') or '—' }}</td>
                 <td>{{ key.cipher }}</td>
@@ -134,15 +639,23 @@ HTML_TEMPLATE = """
                     {% endif %}
                 </td>
                 <td>
+                    <div data-field="usage">
                     <span class="badge {% if stats.get(key.id|string, 0) > 0 %}badge-active{% endif %}">
-                        {{ stats.get(key.id|string, 0) | filesizeformat }}
+                        {{ totals.get(key.id|string, 0) | filesizeformat }}
                     </span>
-                    {% if stats.get(key.id|string, 0) == 0 %}
+                    {% if totals.get(key.id|string, 0) == 0 %}
                     <div class="usage-info">No data usage recorded</div>
                     {% endif %}
+                    {% if key.quota_bytes %}
+                    <div class="usage-info">{{ key.month_bytes|filesizeformat }} of {{ key.quota_bytes|filesizeformat }} this month</div>
+                    {% endif %}
+                    </div>
+                    <div class="usage-info live-rate" data-field="rate"></div>
                 </td>
-                <td>
-                    {% if key.is_expired %}
+                <td data-field="status">
+                    {% if key.disabled_reason %}
+                        <span class="status-dot status-idle"></span><span style="color: #6c757d;">Disabled ({{ key.disabled_reason }})</span>
+                    {% elif key.is_expired %}
                         <span class="expired-text">● Expired</span>
                     {% elif stats.get(key.id|string, 0) > 0 %}
                         <span class="status-dot status-active"></span><span style="color: #28a745;">Active</span>
@@ -154,6 +667,11 @@ HTML_TEMPLATE = """
                     <a href="/client/{{ key.id }}" class="btn btn-blue">Get Client Key</a>
                     <button type="button" class="btn btn-purple" onclick="copyApiUrl('{{ key.secret }}', this)">Copy API URL</button>
                     <a href="/edit/{{ key.id }}" class="btn btn-orange">Edit</a>
+                    {% if key.disabled_reason %}
+                    <form action="/enable/{{ key.id }}" method="post" style="display: inline;">
+                        <button type="submit" class="btn btn-green">Enable</button>
+                    </form>
+                    {% endif %}
                     <form action="/delete/{{ key.id }}" method="post" style="display: inline;">
                         <button type="submit" class="btn btn-red" onclick="return confirm('Are you sure you want to delete user {{ key.id }}?');">Delete</button>
                     </form>
@@ -163,67 +681,20 @@ HTML_TEMPLATE = """
         </tbody>
     </table>
 
-    <script>
-        const API_BASE_URL = '{{ api_base_url }}';
-        function copyApiUrl(secret, button) {
-            const apiUrl = API_BASE_URL + '/api?key=' + secret;
-
-            // Check if clipboard API is available
-            if (navigator.clipboard && navigator.clipboard.writeText) {
-                navigator.clipboard.writeText(apiUrl).then(function() {
-                    const originalText = button.textContent;
-                    button.textContent = '✓ Copied!';
-                    button.style.backgroundColor = '#28a745';
-                    setTimeout(function() {
-                        button.textContent = originalText;
-                        button.style.backgroundColor = '#6f42c1';
-                    }, 2000);
-                }).catch(function(err) {
-                    // Fallback if clipboard API fails
-                    fallbackCopy(apiUrl, button);
-                });
-            } else {
-                // Use fallback for browsers without clipboard API
-                fallbackCopy(apiUrl, button);
-            }
-        }
+    <div style="margin-top: 15px;">
+        {% if view.cursor %}
+        <a class="btn btn-gray" href="{{ url_for('index', search=search_query, filter=view.status_filter, sort=view.sort,
+            order='desc' if view.descending else 'asc', page_size=view.page_size) }}">⏮ First page</a>
+        {% endif %}
+        {% if next_cursor %}
+        <a class="btn btn-blue" href="{{ url_for('index', search=search_query, filter=view.status_filter, sort=view.sort,
+            order='desc' if view.descending else 'asc', page_size=view.page_size, cursor=next_cursor) }}">Next page ⏭</a>
+        {% endif %}
+    </div>
 
-        function fallbackCopy(text, button) {
-            const textarea = document.createElement('textarea');
-            textarea.value = text;
-            textarea.style.position = 'fixed';
-            textarea.style.top = '0';
-            textarea.style.left = '0';
-            textarea.style.width = '2em';
-            textarea.style.height = '2em';
-            textarea.style.padding = '0';
-            textarea.style.border = 'none';
-            textarea.style.outline = 'none';
-            textarea.style.boxShadow = 'none';
-            textarea.style.background = 'transparent';
-            textarea.style.opacity = '0';
-            document.body.appendChild(textarea);
-            textarea.focus();
-            textarea.select();
-            try {
-                const successful = document.execCommand('copy');
-                if (successful) {
-                    const originalText = button.textContent;
-                    button.textContent = '✓ Copied!';
-                    button.style.backgroundColor = '#28a745';
-                    setTimeout(function() {
-                        button.textContent = originalText;
-                        button.style.backgroundColor = '#6f42c1';
-                    }, 2000);
-                } else {
-                    alert('Failed to copy. Please copy manually: ' + text);
-                }
-            } catch (err) {
-                alert('Failed to copy. Please copy manually: ' + text);
-            }
-            document.body.removeChild(textarea);
-        }
-    </script>
+    <script>window.ADMIN = {{ {'apiBaseUrl': api_base_url, 'dataUrl': data_url, 'pollInterval': poll_interval,
+                                'streamUrl': url_for('dashboard_stream')}|tojson }};</script>
+    <script src="{{ asset_url('admin.js') }}"></script>
 </body>
 </html>
 """
@@ -233,20 +704,19 @@ EDIT_TEMPLATE = """
 <html>
 <head>
     <title>Edit User - Outline User Manager</title>
-    <style>
-        body { font-family: sans-serif; max-width: 600px; margin: 40px auto; padding: 20px; }
-        .form-group { margin-bottom: 15px; }
-        label { display: block; margin-bottom: 5px; font-weight: bold; }
-        input, select { width: 100%; padding: 8px; box-sizing: border-box; }
-        .btn { padding: 10px 20px; color: white; border: none; border-radius: 4px; cursor: pointer; margin-right: 10px; }
-        .btn-green { background-color: #4CAF50; }
-        .btn-blue { background-color: #008CBA; }
-        .box { background: #f9f9f9; padding: 15px; border: 1px solid #ddd; margin-bottom: 20px; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
 </head>
-<body>
+<body class="page-form page-edit">
     <h2>Edit User {{ user_id }}</h2>
+    {% with messages = get_flashed_messages() %}
+        {% if messages %}
+            <div style="background: #fff3cd; padding: 15px; margin-bottom: 20px; border-radius: 4px; border: 1px solid #ffeeba;">
+                {{ messages[0] }}
+            </div>
+        {% endif %}
+    {% endwith %}
     <form action="/update/{{ user_id }}" method="post">
+        <input type="hidden" name="version" value="{{ version }}">
         <div class="form-group">
             <label>ID:</label>
             <input type="text" value="{{ user_id }}" disabled>
@@ -272,8 +742,13 @@ EDIT_TEMPLATE = """
             <input type="date" name="expire_date" value="{{ expire_date or '' }}">
             <small style="color: #666;">Leave empty for no expiration</small>
         </div>
+        <div class="form-group">
+            <label>Monthly Data Quota in GB (Optional):</label>
+            <input type="number" name="quota_gb" min="0" step="0.1" value="{{ quota_gb or '' }}">
+            <small style="color: #666;">The key is suspended when it goes over this in a calendar month (UTC); leave empty for no limit</small>
+        </div>
         <div class="box">
-            <button type="submit" class="btn btn-green">Update & Restart Server</button>
+            <button type="submit" class="btn btn-green">Update</button>
             <button type="button" class="btn btn-blue" onclick="document.querySelector('input[name=secret]').value='{{ new_secret }}'">Generate New Secret</button>
         </div>
     </form>
@@ -287,485 +762,3523 @@ CLIENT_TEMPLATE = """
 <html>
 <head>
     <title>Client Config</title>
-    <style>
-        body { font-family: sans-serif; max-width: 600px; margin: 40px auto; padding: 20px; }
-        .btn { padding: 10px 20px; color: white; border: none; border-radius: 4px; cursor: pointer; text-decoration: none; display: inline-block; margin: 5px; }
-        .btn-blue { background-color: #008CBA; }
-        .btn-purple { background-color: #6f42c1; }
-        .btn-green { background-color: #4CAF50; }
-        textarea { width: 100%; height: 300px; font-family: monospace; padding: 10px; box-sizing: border-box; }
-        .button-group { margin: 15px 0; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
 </head>
-<body>
+<body class="page-form page-client">
     <h2>Client Configuration for User {{ user_id }}</h2>
     <p>Copy the code below and paste it into the Outline Client:</p>
     <textarea readonly>{{ yaml_config }}</textarea>
     <div class="button-group">
         <button type="button" class="btn btn-purple" onclick="copyApiUrl('{{ secret }}', this)">Copy API URL</button>
-        <button type="button" class="btn btn-blue" onclick="copyYaml()">Copy YAML Config</button>
+        <button type="button" class="btn btn-blue" onclick="copyYaml(this)">Copy YAML Config</button>
     </div>
     <br><br>
     <a href="/" class="btn btn-green">Back to Dashboard</a>
 
-    <script>
-        const API_BASE_URL = '{{ api_base_url }}';
-        function copyApiUrl(secret, button) {
-            const apiUrl = API_BASE_URL + '/api?key=' + secret;
-
-            // Check if clipboard API is available
-            if (navigator.clipboard && navigator.clipboard.writeText) {
-                navigator.clipboard.writeText(apiUrl).then(function() {
-                    const originalText = button.textContent;
-                    button.textContent = '✓ Copied!';
-                    button.style.backgroundColor = '#28a745';
-                    setTimeout(function() {
-                        button.textContent = originalText;
-                        button.style.backgroundColor = '#6f42c1';
-                    }, 2000);
-                }).catch(function(err) {
-                    // Fallback if clipboard API fails
-                    fallbackCopy(apiUrl, button);
-                });
-            } else {
-                // Use fallback for browsers without clipboard API
-                fallbackCopy(apiUrl, button);
-            }
-        }
-
-        function fallbackCopy(text, button) {
-            const textarea = document.createElement('textarea');
-            textarea.value = text;
-            textarea.style.position = 'fixed';
-            textarea.style.top = '0';
-            textarea.style.left = '0';
-            textarea.style.width = '2em';
-            textarea.style.height = '2em';
-            textarea.style.padding = '0';
-            textarea.style.border = 'none';
-            textarea.style.outline = 'none';
-            textarea.style.boxShadow = 'none';
-            textarea.style.background = 'transparent';
-            textarea.style.opacity = '0';
-            document.body.appendChild(textarea);
-            textarea.focus();
-            textarea.select();
-            try {
-                const successful = document.execCommand('copy');
-                if (successful) {
-                    const originalText = button.textContent;
-                    button.textContent = '✓ Copied!';
-                    button.style.backgroundColor = '#28a745';
-                    setTimeout(function() {
-                        button.textContent = originalText;
-                        button.style.backgroundColor = '#6f42c1';
-                    }, 2000);
-                } else {
-                    alert('Failed to copy. Please copy manually: ' + text);
-                }
-            } catch (err) {
-                alert('Failed to copy. Please copy manually: ' + text);
-            }
-            document.body.removeChild(textarea);
-        }
-
-        function copyYaml() {
-            const yamlText = document.querySelector('textarea').value;
-
-            // Check if clipboard API is available
-            if (navigator.clipboard && navigator.clipboard.writeText) {
-                navigator.clipboard.writeText(yamlText).then(function() {
-                    const button = event.target;
-                    const originalText = button.textContent;
-                    button.textContent = '✓ Copied!';
-                    button.style.backgroundColor = '#28a745';
-                    setTimeout(function() {
-                        button.textContent = originalText;
-                        button.style.backgroundColor = '#008CBA';
-                    }, 2000);
-                }).catch(function(err) {
-                    // Fallback if clipboard API fails
-                    const textarea = document.querySelector('textarea');
-                    textarea.select();
-                    try {
-                        const successful = document.execCommand('copy');
-                        if (successful) {
-                            alert('YAML config copied to clipboard!');
-                        } else {
-                            alert('Failed to copy. Please select and copy manually.');
-                        }
-                    } catch (err) {
-                        alert('Failed to copy. Please select and copy manually.');
-                    }
-                });
-            } else {
-                // Use fallback for browsers without clipboard API
-                const textarea = document.querySelector('textarea');
-                textarea.select();
-                try {
-                    const successful = document.execCommand('copy');
-                    if (successful) {
-                        alert('YAML config copied to clipboard!');
-                    } else {
-                        alert('Failed to copy. Please select and copy manually.');
-                    }
-                } catch (err) {
-                    alert('Failed to copy. Please select and copy manually.');
-                }
-            }
-        }
-    </script>
+    <script>window.ADMIN = {{ {'apiBaseUrl': api_base_url}|tojson }};</script>
+    <script src="{{ asset_url('admin.js') }}"></script>
 </body>
 </html>
 """
 
-# --- HELPERS ---
-def load_config():
-    """Load and validate config file structure"""
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            config = yaml.safe_load(f)
-
-        # Validate config structure
-        if not config:
-            raise ValueError("Config file is empty")
-        if 'services' not in config or not config['services']:
-            raise ValueError("Config missing 'services' section")
-        if 'keys' not in config['services'][0]:
-            # Initialize keys if missing
-            config['services'][0]['keys'] = []
+# --- STATIC ASSETS & TEMPLATE REGISTRY ---
+class StaticAsset:
+    """In-memory asset served under a content-hash URL, with a gzip copy"""
 
-        return config
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Config file '{CONFIG_FILE}' not found")
-    except yaml.YAMLError as e:
-        raise ValueError(f"Invalid YAML in config file: {e}")
+    def __init__(self, name, body, mimetype):
+        self.body = body.encode('utf-8')
+        self.gzipped = gzip.compress(self.body, compresslevel=9)
+        self.mimetype = mimetype
+        stem, ext = name.rsplit('.', 1)
+        self.url_name = f"{stem}.{hashlib.sha256(self.body).hexdigest()[:12]}.{ext}"
 
-def save_config(data):
-    """Save config with error handling"""
-    try:
-        with open(CONFIG_FILE, 'w') as f:
-            yaml.dump(data, f, default_flow_style=False, sort_keys=False)
-    except Exception as e:
-        raise IOError(f"Failed to save config: {e}")
+ASSETS = {
+    'admin.css': StaticAsset('admin.css', ADMIN_CSS, 'text/css'),
+    'admin.js': StaticAsset('admin.js', ADMIN_JS, 'application/javascript'),
+}
+ASSETS_BY_URL = {asset.url_name: asset for asset in ASSETS.values()}
 
-def get_keys(config):
-    """Safely get keys array from config"""
-    try:
-        return config.get('services', [{}])[0].get('keys', [])
-    except (IndexError, KeyError, TypeError):
-        return []
+def asset_url(name):
+    """Cache-busting URL of a shared asset; changes whenever its content does"""
+    return url_for('static_asset', filename=ASSETS[name].url_name)
 
-def set_keys(config, keys):
-    """Safely set keys array in config"""
-    if 'services' not in config:
-        config['services'] = [{}]
-    if not config['services']:
-        config['services'] = [{}]
-    config['services'][0]['keys'] = keys
-
-def restart_server_process():
-    """Restart server with error handling and metrics enabled"""
-    try:
-        # 1. Kill existing server matching the config
-        subprocess.run(['pkill', '-9', '-f', 'outline-ss-server -config=config.yaml'],
-                      stderr=subprocess.DEVNULL, timeout=5)
-        time.sleep(1)
-        # 2. Start new server with metrics enabled
-        # The -metrics flag exposes Prometheus metrics on the specified port
-        cmd = f"nohup {BINARY_PATH} -config={CONFIG_FILE} -metrics 127.0.0.1:{METRICS_PORT} > outline.log 2>&1 &"
-        subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except subprocess.TimeoutExpired:
-        flash("Warning: Server restart timeout", "warning")
-    except Exception as e:
-        flash(f"Error restarting server: {e}", "error")
+app.jinja_env.globals['asset_url'] = asset_url
 
-def generate_secret():
-    """Generate a random 20-char secret"""
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for i in range(20))
+# Compiled once at startup; render_template() accepts the Template objects
+TEMPLATES = {
+    'index': app.jinja_env.from_string(HTML_TEMPLATE),
+    'edit': app.jinja_env.from_string(EDIT_TEMPLATE),
+    'client': app.jinja_env.from_string(CLIENT_TEMPLATE),
+}
 
-def mask_secret(secret, show_chars=4):
-    """Mask secret showing only first and last few characters"""
-    if not secret or len(secret) <= show_chars * 2:
-        return secret
-    return f"{secret[:show_chars]}{'*' * (len(secret) - show_chars * 2)}{secret[-show_chars:]}"
+# --- SELF-METRICS ---
+def format_labels(names, values):
+    """Prometheus label set: {a="1",b="x\\"y"} (empty string without labels)"""
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
 
-def check_expiration(expire_date_str):
-    """Check if a date string is expired. Returns (is_expired, formatted_date)"""
-    if not expire_date_str:
-        return False, None
+class Counter:
+    """Monotonic per-label-set counter; inc() is one dict update under a lock"""
+    kind = 'counter'
 
-    try:
-        expire_date = datetime.strptime(expire_date_str, '%Y-%m-%d').date()
-        today = date.today()
-        is_expired = expire_date < today
-        formatted_date = expire_date.strftime('%Y-%m-%d')
-        return is_expired, formatted_date
-    except (ValueError, TypeError):
-        # Invalid date format, treat as not expired
-        return False, expire_date_str
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
 
-def generate_client_yaml(target_key):
-    """Generate client YAML configuration for a given key"""
-    client_yaml = {
-        'transport': {
-            '$type': 'tcpudp',
-            'tcp': {
-                '$type': 'shadowsocks',
-                'endpoint': {'$type': 'websocket', 'url': f'wss://{DOMAIN}/tcp-ray'},
-                'cipher': target_key.get('cipher', 'chacha20-ietf-poly1305'),
-                'secret': target_key.get('secret', '')
-            },
-            'udp': {
-                '$type': 'shadowsocks',
-                'endpoint': {'$type': 'websocket', 'url': f'wss://{DOMAIN}/udp-ray'},
-                'cipher': target_key.get('cipher', 'chacha20-ietf-poly1305'),
-                'secret': target_key.get('secret', '')
-            }
-        }
-    }
-    return yaml.dump(client_yaml, default_flow_style=False, sort_keys=False)
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
 
-def get_metrics():
-    """Scrape the Outline Prometheus metrics endpoint to calculate usage per key"""
-    usage_map = {}
-    try:
-        response = requests.get(METRICS_URL, timeout=2)
-        if response.status_code == 200:
-            lines = response.text.split('\n')
-            for line in lines:
-                # Look for lines like: shadowsocks_data_bytes{access_key="1",...} 5000
-                if line.startswith('shadowsocks_data_bytes') and not line.startswith('#'):
-                    parts = line.split(' ')
-                    if len(parts) >= 2:
-                        try:
-                            val = float(parts[-1])
-
-                            # Extract access_key ID from the metric line
-                            # Format is usually: shadowsocks_data_bytes{access_key="1",direction="down",...} 5000
-                            if 'access_key="' in line:
-                                key_id = line.split('access_key="')[1].split('"')[0]
-                                if key_id not in usage_map:
-                                    usage_map[key_id] = 0
-                                usage_map[key_id] += val
-                        except (ValueError, IndexError):
-                            continue
-    except requests.exceptions.RequestException:
-        # Metrics server might not be ready yet or not running
-        pass
-    except Exception:
-        # Any other error, just return empty map
-        pass
-    return usage_map
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for values, value in items:
+            yield self.name, format_labels(self.labels, values), value
 
-# --- ROUTES ---
-@app.route('/')
-def index():
-    try:
-        config = load_config()
-        keys = get_keys(config)
+class Histogram:
+    """Cumulative-bucket latency histogram per label set"""
+    kind = 'histogram'
 
-        # Get search query from URL parameters
-        search_query = request.args.get('search', '').strip()
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
 
-        # Filter keys by username if search query is provided
-        if search_query:
-            search_lower = search_query.lower()
-            keys = [key for key in keys if search_lower in key.get('name', '').lower()]
+    def observe(self, seconds, *label_values):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # [per-bucket counts (+Inf last), sum, count]
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][slot] += 1
+            state[1] += seconds
+            state[2] += 1
 
-        # Add masked secret and expiration status for display
-        for key in keys:
-            key['secret_masked'] = mask_secret(key.get('secret', ''))
-            # Check expiration
-            expire_date_str = key.get('expire_date', '')
-            is_expired, formatted_date = check_expiration(expire_date_str)
-            key['is_expired'] = is_expired
-            key['expire_date'] = formatted_date if formatted_date else expire_date_str
+    def samples(self):
+        with self._lock:
+            items = [(values, list(counts), total, count) for values, (counts, total, count) in self._values.items()]
+        for values, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield (f"{self.name}_bucket", format_labels(self.labels + ('le',), values + (bound,)), cumulative)
+            yield f"{self.name}_sum", format_labels(self.labels, values), total
+            yield f"{self.name}_count", format_labels(self.labels, values), count
 
-        # Get metrics data usage for each user
-        stats = get_metrics()
+class Gauge:
+    """Value read when /admin-metrics is scraped: collect() -> {label values tuple: value}"""
+    kind = 'gauge'
 
-        # Determine API base URL
-        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
 
-        return render_template_string(HTML_TEMPLATE, keys=keys, stats=stats, search_query=search_query, api_base_url=api_base_url)
-    except Exception as e:
-        flash(f"Error loading config: {e}", "error")
-        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
-        return render_template_string(HTML_TEMPLATE, keys=[], stats={}, search_query='', api_base_url=api_base_url)
+    def samples(self):
+        for values, value in self.collect().items():
+            yield self.name, format_labels(self.labels, values), value
 
-@app.route('/add', methods=['POST'])
-def add_user():
-    try:
-        config = load_config()
-        keys = get_keys(config)
+class MetricsRegistry:
+    """The panel's own metrics in Prometheus text format.
+
+    Values live in this process only; with several workers each one reports
+    its own share (scrape them separately or sum in Prometheus).
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
 
-        # Calculate new ID
-        new_id = 1
-        if keys:
+    def render(self):
+        lines = []
+        for metric in self.metrics:
             try:
-                new_id = max(int(k.get('id', 0)) for k in keys) + 1
-            except (ValueError, TypeError):
-                new_id = len(keys) + 1
+                samples = list(metric.samples())
+            except Exception as e:
+                # A failing gauge must not take the whole endpoint down
+                lines.append(f"# {metric.name} unavailable: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
 
-        # Get expiration date from form
-        expire_date = request.form.get('expire_date', '').strip()
+admin_metrics = MetricsRegistry()
+request_duration = admin_metrics.register(Histogram(
+    'admin_http_request_duration_seconds', "Request handling time by route, method and status",
+    ('route', 'method', 'status')))
+template_render_duration = admin_metrics.register(Histogram(
+    'admin_template_render_duration_seconds', "Page template rendering time", ('template',)))
+config_loads = admin_metrics.register(Counter(
+    'admin_config_loads_total', "Config reads: cached, or a new version (parsed YAML, JSON snapshot, SQLite store, just saved)", ('result',)))
+config_parse_duration = admin_metrics.register(Histogram(
+    'admin_config_parse_duration_seconds', "Time to load a new config version"))
+config_saves = admin_metrics.register(Counter(
+    'admin_config_saves_total', "Config writes by outcome", ('result',)))
+config_save_duration = admin_metrics.register(Histogram(
+    'admin_config_save_duration_seconds', "Time to store a config version"))
+server_actions = admin_metrics.register(Counter(
+    'admin_server_actions_total', "outline-ss-server reloads/restarts/starts by outcome", ('action', 'result')))
+server_action_duration = admin_metrics.register(Histogram(
+    'admin_server_action_duration_seconds', "Time to reload or restart outline-ss-server", ('action',)))
+scrape_duration = admin_metrics.register(Histogram(
+    'admin_metrics_scrape_duration_seconds', "Time for one metrics scrape of all nodes"))
+scrape_failures = admin_metrics.register(Counter(
+    'admin_metrics_scrape_failures_total', "Failed metrics scrapes per node", ('node',)))
+reload_requests = admin_metrics.register(Counter(
+    'admin_reload_requests_total', "Config changes queued for a server reload (many per reload when coalesced)"))
+fleet_pushes = admin_metrics.register(Counter(
+    'admin_fleet_pushes_total', "Config pushes to fleet nodes by outcome", ('node', 'result')))
+api_rejections = admin_metrics.register(Counter(
+    'admin_api_rejected_total', "/api requests answered without a config lookup", ('reason',)))
 
-        new_user = {
-            'id': new_id,
-            'name': '',  # Optional name field for admin display
-            'cipher': 'chacha20-ietf-poly1305',
-            'secret': generate_secret(),
-            'expire_date': expire_date if expire_date else None
-        }
+TEMPLATE_NAMES = {id(template): name for name, template in TEMPLATES.items()}
 
-        # Remove None values to keep config clean
-        if new_user['expire_date'] is None:
-            new_user.pop('expire_date', None)
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
 
-        keys.append(new_user)
-        set_keys(config, keys)
-        save_config(config)
-        restart_server_process()
+@template_rendered.connect_via(app)
+def record_render_time(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        template_render_duration.observe(time.perf_counter() - started, TEMPLATE_NAMES.get(id(template), 'other'))
 
-        flash(f"User {new_id} added and Server Restarted!")
-    except Exception as e:
-        flash(f"Error adding user: {e}", "error")
-    return redirect(url_for('index'))
+# Registered before every other hook, so the timing covers them all
+# (after_request hooks run in reverse order of registration)
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-@app.route('/edit/<int:user_id>')
-def edit_user(user_id):
-    try:
-        config = load_config()
-        keys = get_keys(config)
-        target_key = next((k for k in keys if int(k.get('id', 0)) == user_id), None)
+@app.after_request
+def record_request_time(response):
+    started = g.get('request_started')
+    if started is not None:
+        # The URL rule, not the path, keeps the label set bounded
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_duration.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
 
-        if not target_key:
-            flash(f"User {user_id} not found", "error")
-            return redirect(url_for('index'))
+# --- PROFILING ---
+PROFILE_ENDPOINTS = frozenset(name.strip() for name in os.environ.get(PROFILE_ENV, '').split(',') if name.strip())
+# Set by the public /api listener (see api_app), where ?profile= is ignored
+PUBLIC_ENVIRON_KEY = 'outline_admin.public'
 
-        new_secret = generate_secret()
-        expire_date = target_key.get('expire_date', '')
-        return render_template_string(EDIT_TEMPLATE,
-                                    user_id=user_id,
-                                    name=target_key.get('name', ''),
-                                    cipher=target_key.get('cipher', 'chacha20-ietf-poly1305'),
-                                    secret=target_key.get('secret', ''),
-                                    expire_date=expire_date,
-                                    new_secret=new_secret)
-    except Exception as e:
-        flash(f"Error loading user: {e}", "error")
-        return redirect(url_for('index'))
+class ProfileRing:
+    """The last few request profiles, oldest dropped first"""
 
-@app.route('/update/<int:user_id>', methods=['POST'])
-def update_user(user_id):
-    try:
-        config = load_config()
-        keys = get_keys(config)
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._profiles = deque(maxlen=size)
+        self._next_id = 1
 
-        target_key = next((k for k in keys if int(k.get('id', 0)) == user_id), None)
-        if not target_key:
-            flash(f"User {user_id} not found", "error")
-            return redirect(url_for('index'))
+    def add(self, info, profiler):
+        profiler.create_stats()
+        with self._lock:
+            entry = dict(info, id=self._next_id)
+            self._next_id += 1
+            self._profiles.append((entry, profiler))
+        return entry
 
-        # Update name, cipher, secret, and expiration date
-        name = request.form.get('name', '').strip()
-        cipher = request.form.get('cipher', 'chacha20-ietf-poly1305')
-        secret = request.form.get('secret', '').strip()
-        expire_date = request.form.get('expire_date', '').strip()
+    def entries(self):
+        with self._lock:
+            return [entry for entry, _ in reversed(self._profiles)]
 
-        if not secret:
-            flash("Secret cannot be empty", "error")
-            return redirect(url_for('edit_user', user_id=user_id))
+    def get(self, profile_id):
+        """(entry, profiler) or (None, None)"""
+        with self._lock:
+            for entry, profiler in self._profiles:
+                if entry['id'] == profile_id:
+                    return entry, profiler
+        return None, None
 
-        target_key['name'] = name
-        target_key['cipher'] = cipher
-        target_key['secret'] = secret
+profiles = ProfileRing(PROFILE_KEEP)
+# cProfile can only run one profiler at a time on newer Pythons; requests
+# that arrive while one is being profiled simply run unprofiled
+_profiler_slot = threading.Lock()
 
-        # Update expiration date
-        if expire_date:
-            target_key['expire_date'] = expire_date
-        else:
-            # Remove expiration date if empty
-            target_key.pop('expire_date', None)
+@app.before_request
+def start_profiler():
+    # Fast path: no env selection and no query flag means no profiling work at all
+    if not PROFILE_ENDPOINTS and 'profile' not in request.args:
+        return
+    wanted = ('*' in PROFILE_ENDPOINTS or request.endpoint in PROFILE_ENDPOINTS
+              or ('profile' in request.args and not request.environ.get(PUBLIC_ENVIRON_KEY)))
+    if not wanted or not _profiler_slot.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.profile_started = time.perf_counter()
+    g.profiler.enable()
 
-        set_keys(config, keys)
-        save_config(config)
-        restart_server_process()
+def finish_profile(status):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    _profiler_slot.release()
+    profiles.add({'at': datetime.now().isoformat(timespec='seconds'), 'method': request.method,
+                  'path': request.path, 'endpoint': request.endpoint, 'status': status,
+                  'duration': round(time.perf_counter() - g.profile_started, 4)}, profiler)
 
-        flash(f"User {user_id} updated and Server Restarted!")
-    except Exception as e:
-        flash(f"Error updating user: {e}", "error")
-    return redirect(url_for('index'))
+@app.after_request
+def stop_profiler(response):
+    finish_profile(response.status_code)
+    return response
 
-@app.route('/delete/<int:user_id>', methods=['POST'])
-def delete_user(user_id):
-    try:
-        config = load_config()
-        keys = get_keys(config)
+@app.teardown_request
+def stop_failed_profiler(exc):
+    # after_request does not run when a view raised
+    finish_profile(500)
 
-        original_count = len(keys)
-        keys = [k for k in keys if int(k.get('id', 0)) != user_id]
+# --- CONFIG CACHE ---
+def freeze(value):
+    """Recursively turn dicts/lists into read-only mappings/tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
 
-        if len(keys) == original_count:
-            flash(f"User {user_id} not found", "error")
-        else:
-            set_keys(config, keys)
-            save_config(config)
-            restart_server_process()
-            flash(f"User {user_id} deleted and Server Restarted!")
-    except Exception as e:
-        flash(f"Error deleting user: {e}", "error")
-    return redirect(url_for('index'))
+def thaw(value):
+    """Recursively turn a frozen view back into plain mutable dicts/lists"""
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
 
-@app.route('/client/<int:user_id>')
-def get_client_config(user_id):
-    try:
-        config = load_config()
-        keys = get_keys(config)
-        target_key = next((k for k in keys if int(k.get('id', 0)) == user_id), None)
+VERSION_HEADER = '# admin-version:'
 
-        if not target_key:
-            return "User not found", 404
+# libyaml bindings are several times faster; fall back to pure Python without them
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
-        # Generate the Client YAML structure
-        yaml_text = generate_client_yaml(target_key)
-        secret = target_key.get('secret', '')
-        # Determine API base URL
-        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
-        return render_template_string(CLIENT_TEMPLATE, user_id=user_id, yaml_config=yaml_text, secret=secret, api_base_url=api_base_url)
-    except Exception as e:
-        return f"Error generating client config: {e}", 500
+def yaml_load(stream):
+    return yaml.load(stream, Loader=YamlLoader)
 
-@app.route('/api')
-def api_get_client_key():
-    """API endpoint to retrieve client key by password/secret only"""
+def yaml_dump(data, stream=None):
+    """Block-style YAML in insertion order, like the files users edit by hand"""
+    return yaml.dump(data, stream, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)
+
+def parse_generation(text):
+    """Version counter from the header line save_config() writes (0 if absent)"""
+    if text.startswith(VERSION_HEADER):
+        try:
+            return int(text[len(VERSION_HEADER):text.find('\n')].strip())
+        except ValueError:
+            return 0
+    return 0
+
+def parse_config(stream):
+    """Parse and validate config file structure"""
     try:
-        key_param = request.args.get('key', '').strip()
+        config = yaml_load(stream)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Invalid YAML in config file: {e}")
+    return validate_config(config)
 
-        if not key_param:
-            return jsonify({'error': 'Missing key parameter. Use /api?key=password'}), 400
+def validate_config(config):
+    # Validate config structure
+    if not config:
+        raise ValueError("Config file is empty")
+    if 'services' not in config or not config['services']:
+        raise ValueError("Config missing 'services' section")
+    for service in config['services']:
+        if not service.get('keys'):
+            # Initialize keys if missing
+            service['keys'] = []
+    return config
 
-        config = load_config()
-        keys = get_keys(config)
+def secret_digest(secret):
+    """Hash a secret for use as an index key"""
+    return hashlib.sha256(str(secret).encode('utf-8')).digest()
 
-        # Only match by secret/password (more secure)
-        target_key = next((k for k in keys if k.get('secret', '') == key_param), None)
+class KeyIndex:
+    """Hashed lookups over a frozen keys tuple: secret -> key and id -> key.
 
-        if not target_key:
-            return jsonify({'error': 'User not found. Invalid password/secret.'}), 404
+    Secrets are indexed by their SHA-256 digest so the dict probe does not
+    compare raw secrets; the final match is confirmed in constant time.
+    First occurrence wins for duplicates, like the scans it replaces.
+    """
 
-        # Generate client YAML
-        yaml_text = generate_client_yaml(target_key)
+    def __init__(self, keys):
+        self.by_secret = {}
+        self.by_id = {}
+        for pos, key in enumerate(keys):
+            self.by_secret.setdefault(secret_digest(key.get('secret', '')), key)
+            try:
+                self.by_id.setdefault(int(key.get('id', 0)), (pos, key))
+            except (ValueError, TypeError):
+                continue
 
-        # Return as plain text YAML (can be used directly by clients)
-        return yaml_text, 200, {'Content-Type': 'text/yaml; charset=utf-8'}
+    def find_by_secret(self, secret):
+        key = self.by_secret.get(secret_digest(secret))
+        if key is None:
+            return None
+        if not hmac.compare_digest(str(key.get('secret', '')).encode('utf-8'), secret.encode('utf-8')):
+            return None
+        return key
 
-    except Exception as e:
-        return jsonify({'error': f'Error retrieving client key: {str(e)}'}), 500
+    def find_by_id(self, user_id):
+        entry = self.by_id.get(user_id)
+        return entry[1] if entry else None
+
+    def position_of(self, user_id):
+        """Position of the key in the keys list, or None if not found"""
+        entry = self.by_id.get(user_id)
+        return entry[0] if entry else None
+
+class ConfigSnapshot:
+    """One parsed version of the config file plus indexes derived from it"""
+
+    def __init__(self, config, version, stamp=None, generation=0):
+        self.config = config
+        self.version = version
+        # Counter bumped by every committed config_transaction(), shared by all workers
+        self.generation = generation
+        # Identity of the file this was parsed from; the same in every worker
+        self.etag = hashlib.sha1(repr(stamp).encode()).hexdigest()[:16]
+        self.keys = get_keys(config)
+        self.index = KeyIndex(self.keys)
+        # Keys taken out of service (expired, over quota); never served by /api
+        self.disabled_keys = get_disabled_keys(config)
+        self.disabled_index = KeyIndex(self.disabled_keys)
+        # Expiry dates parsed once per version, by position
+        self.expire_on = tuple(parse_expire_date(k.get('expire_date')) for k in self.keys)
+        self.disabled_expire_on = tuple(parse_expire_date(k.get('expire_date')) for k in self.disabled_keys)
+        self._derived = {}
+
+    def locate(self, user_id):
+        """('keys' | 'disabled_keys', position) of a key id, or (None, None)"""
+        position = self.index.position_of(user_id)
+        if position is not None:
+            return 'keys', position
+        position = self.disabled_index.position_of(user_id)
+        if position is not None:
+            return 'disabled_keys', position
+        return None, None
+
+    def find(self, user_id):
+        """Active or disabled key record by id, or None"""
+        return self.index.find_by_id(user_id) or self.disabled_index.find_by_id(user_id)
+
+    def derived(self, name, factory):
+        """Structure computed from this version on first use and kept until the next"""
+        value = self._derived.get(name)
+        if value is None:
+            value = self._derived[name] = factory(self)
+        return value
+
+    def thaw(self):
+        """Private mutable copy of the config; key positions match self.index"""
+        return thaw(self.config)
+
+def config_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def read_config_sidecar(path, digest):
+    """Parsed config from the snapshot next to path if it was compiled from
+    exactly this file content, else None"""
+    if not CONFIG_SNAPSHOT_SUFFIX:
+        return None
+    try:
+        with open(path + CONFIG_SNAPSHOT_SUFFIX, 'rb') as f:
+            sidecar = json.loads(f.read())
+        if sidecar.get('sha256') != digest:
+            return None
+        return validate_config(sidecar['config'])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def write_config_sidecar(path, digest, config):
+    """Best-effort atomic write of the snapshot; a config that JSON cannot
+    represent exactly (e.g. unquoted YAML dates) simply gets none"""
+    if not CONFIG_SNAPSHOT_SUFFIX:
+        return
+    sidecar_path = path + CONFIG_SNAPSHOT_SUFFIX
+    try:
+        data = json.dumps({'sha256': digest, 'config': config}, separators=(',', ':'))
+    except (TypeError, ValueError):
+        # Leave no stale snapshot behind; its hash would not match anyway
+        try:
+            os.unlink(sidecar_path)
+        except OSError:
+            pass
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix='.snapshot.', suffix='.tmp', dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, sidecar_path)
+        tmp_path = None
+    except OSError as e:
+        app.logger.warning("Could not write config snapshot: %s", e)
+    finally:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+# --- USER STORE ---
+def write_file_atomic(path, data):
+    """Replace path with data (bytes): temp file, fsync, rename, fsync directory.
+
+    Readers see either the old or the new file, never a partial one; the
+    old file's permissions are kept.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        tmp_path = None
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    finally:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
+
+class YamlUserStore:
+    """Users kept in config.yaml itself, next to the server settings.
+
+    A version is identified by (path, mtime, size, inode), so a cheap
+    stat() notices edits made by this process, another worker or a human
+    with a text editor. New versions come from the JSON snapshot sidecar
+    when its hash matches the file and are parsed from YAML otherwise
+    (then the sidecar is rewritten for the next start).
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def _stamp_of(path, st):
+        return (path, st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def stamp(self):
+        try:
+            return self._stamp_of(self.path, os.stat(self.path))
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Config file '{self.path}' not found")
+
+    def load(self, unless_stamp=None):
+        """(stamp, config, generation, source) of the current file, or None if it is unless_stamp"""
+        # Stamp the file descriptor we actually parse so a write racing
+        # stamp() cannot be cached under the old stamp
+        with open(self.path, 'rb') as f:
+            stamp = self._stamp_of(self.path, os.fstat(f.fileno()))
+            if stamp == unless_stamp:
+                return None
+            data = f.read()
+        digest = config_digest(data)
+        config = read_config_sidecar(self.path, digest)
+        if config is not None:
+            source = 'snapshot'
+        else:
+            config = parse_config(data)
+            write_config_sidecar(self.path, digest, config)
+            source = 'parsed'
+        return stamp, config, parse_generation(data[:64].decode('utf-8', 'replace')), source
+
+    def save(self, data, generation):
+        text = f"{VERSION_HEADER} {generation}\n{yaml_dump(data)}".encode('utf-8')
+        # Compile the snapshot first: the next load finds it already matching
+        write_config_sidecar(self.path, config_digest(text), validate_config(data))
+        write_file_atomic(self.path, text)
+
+    def render_server_config(self):
+        """The file is the config, so it is always current; True means 'apply it'"""
+        return True
+
+class SqliteUserStore:
+    """Users in SQLite as the source of truth; config.yaml is rendered from it.
+
+    Each key is one row (indexed by id, secret, name and expire_date) with
+    its full record as JSON; the rest of the config (web, listeners) is one
+    meta entry. save() diffs the new config against the last version it
+    knows and writes only changed rows in one transaction, so editing one
+    user costs one row, not a rewrite of every key. The meta generation
+    counter is the version stamp, which lets other workers notice writes
+    with one indexed read.
+
+    config.yaml only holds what outline-ss-server reads (SERVER_KEY_FIELDS
+    of active keys); it is re-rendered by render_server_config() when the
+    server part changed, so renaming a user or moving an expiry date never
+    touches the file or the server. On first use an existing config.yaml
+    is imported (see import_config()).
+    """
+
+    def __init__(self, path, config_path):
+        self.path = path
+        self.config_path = config_path
+        self._lock = threading.Lock()
+        self._db = None
+        # Last version read or written: generation, frozen config and {id: row}
+        self._generation = None
+        self._config = None
+        self._rows = {}
+        self._server = None
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY, state TEXT NOT NULL, shard INTEGER NOT NULL, seq INTEGER NOT NULL,
+                    secret TEXT NOT NULL, name TEXT, expire_date TEXT, record TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS users_secret ON users (secret);
+                CREATE INDEX IF NOT EXISTS users_name ON users (name);
+                CREATE INDEX IF NOT EXISTS users_expire_date ON users (expire_date);
+                CREATE INDEX IF NOT EXISTS users_order ON users (state, shard, seq);
+            """)
+            self._db = db
+            if self._meta('generation') is None and os.path.exists(self.config_path):
+                try:
+                    self._import(self.config_path)
+                except BaseException:
+                    # Try again on the next call rather than look empty
+                    self._db = None
+                    db.close()
+                    raise
+        return self._db
+
+    def _meta(self, name):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def generation(self):
+        with self._lock:
+            self._connect()
+            value = self._meta('generation')
+        return None if value is None else int(value)
+
+    def stamp(self):
+        generation = self.generation()
+        if generation is None:
+            raise FileNotFoundError(f"No users in '{self.path}' and no '{self.config_path}' to import")
+        return (self.path, generation)
+
+    def load(self, unless_stamp=None):
+        """(stamp, config, generation, source) of the current version, or None if it is unless_stamp"""
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN")
+            try:
+                generation = self._meta('generation')
+                if generation is None:
+                    raise FileNotFoundError(f"No users in '{self.path}' and no '{self.config_path}' to import")
+                generation = int(generation)
+                stamp = (self.path, generation)
+                if stamp == unless_stamp:
+                    return None
+                if generation == self._generation:
+                    return stamp, self._config, generation, 'saved'
+                config = self._read(db, generation)
+            finally:
+                db.execute("COMMIT")
+            return stamp, config, generation, 'store'
+
+    def _read(self, db, generation):
+        """Load every row into memory and assemble the config (caller holds a transaction)"""
+        server = self._meta('server')
+        config = json.loads(server)
+        services = config['services']
+        disabled = []
+        rows = {}
+        for key_id, state, shard, seq, record in db.execute(
+                "SELECT id, state, shard, seq, record FROM users ORDER BY state, shard, seq"):
+            key = freeze(json.loads(record))
+            rows[key_id] = (state, shard, seq, key)
+            if state == 'disabled':
+                disabled.append(key)
+            else:
+                services[shard if shard < len(services) else shard_of(key_id, shard_count(config))]['keys'].append(key)
+        if disabled:
+            config['disabled_keys'] = disabled
+        self._generation, self._rows, self._server = generation, rows, server
+        # The records are frozen already and freeze() leaves them as they are
+        self._config = freeze(config)
+        return self._config
+
+    @staticmethod
+    def server_part(config):
+        """Everything but the keys, as canonical JSON"""
+        server = {name: value for name, value in config.items() if name != 'disabled_keys'}
+        server['services'] = [dict({name: value for name, value in service.items() if name != 'keys'}, keys=[])
+                              for service in config['services']]
+        return json.dumps(server, sort_keys=True, default=str)
+
+    def save(self, data, generation, replace=False):
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._write(db, data, generation, replace)
+            except BaseException:
+                db.execute("ROLLBACK")
+                # The in-memory copy may be half updated
+                self._generation = None
+                raise
+            db.execute("COMMIT")
+
+    def _write(self, db, data, generation, replace):
+        current = self._meta('generation')
+        if replace:
+            db.execute("DELETE FROM users")
+            self._rows, self._server = {}, None
+        elif current is not None and int(current) != self._generation:
+            self._read(db, int(current))
+        config = validate_config(data)
+        server = self.server_part(config)
+        server_changed = server != self._server
+        rows, changed = {}, []
+
+        def place(state, shard, keys):
+            """Rows for one list of keys; unchanged keys keep their frozen record"""
+            nonlocal server_changed
+            frozen = []
+            seq = 0
+            for key in keys:
+                try:
+                    key_id = int(key.get('id'))
+                except (ValueError, TypeError):
+                    raise ValueError(f"Key id {key.get('id')!r} is not an integer")
+                if key_id in rows:
+                    raise ValueError(f"Duplicate key id {key_id}")
+                # Keep each surviving row's sequence number while the order
+                # allows it, so deleting or appending keys rewrites no neighbours
+                old = self._rows.get(key_id)
+                seq = old[2] if old and old[:2] == (state, shard) and old[2] > seq else seq + 1
+                if old is not None and old[3] == key:
+                    row = (state, shard, seq, old[3])
+                else:
+                    row = (state, shard, seq, freeze(key))
+                if row != old:
+                    changed.append((key_id, state, shard, seq, key))
+                    if not server_changed and (state == 'active' or (old and old[0] == 'active')) and (
+                            old is None or old[:2] != row[:2]
+                            or any(old[3].get(field) != key.get(field) for field in SERVER_KEY_FIELDS)):
+                        server_changed = True
+                rows[key_id] = row
+                frozen.append(row[3])
+            return tuple(frozen)
+
+        services = tuple(MappingProxyType({name: place('active', shard, value or ()) if name == 'keys' else freeze(value)
+                                           for name, value in service.items()})
+                         for shard, service in enumerate(config['services']))
+        frozen = MappingProxyType({name: services if name == 'services'
+                                   else place('disabled', 0, value or ()) if name == 'disabled_keys'
+                                   else freeze(value) for name, value in config.items()})
+        removed = [key_id for key_id in self._rows if key_id not in rows]
+        if not server_changed:
+            server_changed = any(self._rows[key_id][0] == 'active' for key_id in removed)
+
+        db.executemany("DELETE FROM users WHERE id = ?", ((key_id,) for key_id in removed))
+        db.executemany("INSERT OR REPLACE INTO users (id, state, shard, seq, secret, name, expire_date, record) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       ((key_id, state, shard, seq, str(key.get('secret', '')), key.get('name'),
+                         str(key['expire_date']) if key.get('expire_date') else None,
+                         json.dumps(key, separators=(',', ':'), default=str))
+                        for key_id, state, shard, seq, key in changed))
+        updates = [('generation', str(generation))]
+        if server_changed:
+            updates += [('server', server), ('server_generation', str(generation))]
+        db.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", updates)
+        self._generation, self._rows, self._server, self._config = generation, rows, server, frozen
+
+    def _import(self, path):
+        """Replace every user with the contents of a config.yaml (caller holds the lock)"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Round-trip through JSON so YAML dates become the strings the store keeps
+        config = json.loads(json.dumps(parse_config(data), default=str))
+        current = self._meta('generation')
+        generation = max(parse_generation(data[:64].decode('utf-8', 'replace')), int(current or 0)) + 1
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._write(self._db, config, generation, replace=True)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            self._generation = None
+            raise
+        self._db.execute("COMMIT")
+        # The next render drops the admin-only fields; keep the original around
+        backup = f"{self.config_path}.pre-import"
+        if os.path.exists(self.config_path) and not os.path.exists(backup):
+            shutil.copy2(self.config_path, backup)
+        return len(self._rows)
+
+    def import_config(self, path):
+        """One-time import of an existing config.yaml; returns the number of keys"""
+        with self._lock:
+            self._connect()
+            return self._import(path)
+
+    def render_server_config(self):
+        """Rewrite config.yaml if the server part changed since it was rendered; True if it did"""
+        with self._lock:
+            self._connect()
+            wanted = int(self._meta('server_generation') or 0)
+        try:
+            with open(self.config_path) as f:
+                if parse_generation(f.readline()) >= wanted:
+                    return False
+        except FileNotFoundError:
+            pass
+        snapshot = load_snapshot()
+        config = {name: value for name, value in thaw(snapshot.config).items()
+                  if name not in ('disabled_keys', SHARDS_FIELD)}
+        for service in config['services']:
+            service['keys'] = [{field: key[field] for field in SERVER_KEY_FIELDS if field in key}
+                               for key in service.get('keys') or ()]
+        write_file_atomic(self.config_path,
+                          f"{VERSION_HEADER} {snapshot.generation}\n{yaml_dump(config)}".encode('utf-8'))
+        return True
+
+def open_user_store():
+    """The USER_STORE backend for the configured files"""
+    if USER_STORE == 'sqlite':
+        return SqliteUserStore(USERS_DB_FILE, CONFIG_FILE)
+    return YamlUserStore(CONFIG_FILE)
+
+user_store = open_user_store()
+
+class ConfigCache:
+    """Parsed config kept in memory and reloaded only when the store changes.
+
+    Every call asks the user store for its cheap version stamp (a stat()
+    of config.yaml, or the generation row of the SQLite store); only a new
+    stamp loads the config again. The cached config is frozen so request
+    handlers can share it without being able to corrupt it, and the key
+    indexes are rebuilt only when a new version is loaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._snapshot = None
+        self.version = 0
+
+    def get(self, store):
+        stamp = store.stamp()
+        snapshot = self._snapshot
+        if snapshot is not None and stamp == self._stamp:
+            config_loads.inc('cached')
+            return snapshot
+
+        with self._lock:
+            started = time.perf_counter()
+            loaded = store.load(unless_stamp=self._stamp if self._snapshot is not None else None)
+            if loaded is None:
+                config_loads.inc('cached')
+                return self._snapshot
+            stamp, config, generation, source = loaded
+            self.version += 1
+            self._snapshot = ConfigSnapshot(freeze(config), self.version, stamp, generation)
+            self._stamp = stamp
+            config_loads.inc(source)
+            config_parse_duration.observe(time.perf_counter() - started)
+            return self._snapshot
+
+    def current(self):
+        """Last loaded snapshot without checking the store (None right after a save)"""
+        return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._stamp = None
+
+config_cache = ConfigCache()
+
+# --- HELPERS ---
+def load_snapshot():
+    """Return the current ConfigSnapshot (config view plus key indexes)"""
+    return config_cache.get(user_store)
+
+def load_config(mutable=False):
+    """Return the cached config as a read-only view.
+
+    Pass mutable=True to get a private deep copy. To write changes back,
+    prefer config_transaction(), which also locks out concurrent writers.
+    """
+    snapshot = load_snapshot()
+    return snapshot.thaw() if mutable else snapshot.config
+
+def save_config(data, generation=None):
+    """Atomically store a new config version in the user store.
+
+    Readers see either the old or the new version, never a partial one. Call
+    it from inside config_transaction() so concurrent writers are serialized.
+    """
+    if generation is None:
+        generation = load_snapshot().generation + 1
+    started = time.perf_counter()
+    try:
+        user_store.save(thaw(data), generation)
+    except Exception as e:
+        config_saves.inc('error')
+        raise IOError(f"Failed to save config: {e}")
+    else:
+        config_saves.inc('ok')
+        config_save_duration.observe(time.perf_counter() - started)
+    finally:
+        config_cache.invalidate()
+
+class ConfigConflictError(Exception):
+    """The config was changed by someone else since the caller read it"""
+
+class config_transaction:
+    """Read-modify-write of the config under an exclusive advisory lock.
+
+        with config_transaction(expected_version=form_version) as txn:
+            keys = get_keys(txn.config)
+            ...
+
+    txn.config is a private mutable copy of the latest config and
+    txn.snapshot the snapshot it came from (its key positions match). On a
+    clean exit the config is saved atomically with the version bumped;
+    call txn.cancel() to leave the store untouched. The flock on
+    CONFIG_FILE.lock serializes writers across threads and worker
+    processes; expected_version gives optimistic concurrency for forms.
+    """
+
+    def __init__(self, expected_version=None):
+        self.expected_version = expected_version
+        self.cancelled = False
+        self._lock_file = None
+
+    def __enter__(self):
+        try:
+            # Separate open() per transaction, so threads exclude each other too
+            self._lock_file = open(f"{CONFIG_FILE}.lock", 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            # The cache re-stats the file, so writes by other workers are seen
+            self.snapshot = load_snapshot()
+            if self.expected_version is not None and self.expected_version != self.snapshot.generation:
+                raise ConfigConflictError(
+                    f"Config changed since it was loaded (version {self.expected_version} -> "
+                    f"{self.snapshot.generation}); reload and try again")
+            self.config = self.snapshot.thaw()
+            self.version = self.snapshot.generation
+            return self
+        except BaseException:
+            self._release()
+            raise
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and not self.cancelled:
+                save_config(self.config, generation=self.version + 1)
+                self.version += 1
+        finally:
+            self._release()
+        return False
+
+    def _release(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+def shard_count(config):
+    """Number of leading services /shards manages as shards (1: just services[0])"""
+    try:
+        count = int(config.get(SHARDS_FIELD) or 1)
+    except (ValueError, TypeError):
+        return 1
+    return max(1, min(count, len(config.get('services') or ()) or 1))
+
+def get_keys(config):
+    """Safely get keys array from config.
+
+    Without shards this is services[0]'s own list; with shards it is a new
+    list of all shards' keys in service order, so write it back with
+    set_keys() after adding or removing keys. Services that are not
+    shards are never included.
+    """
+    try:
+        services = config.get('services') or [{}]
+        count = shard_count(config)
+        if count == 1:
+            return services[0].get('keys', [])
+        keys = [key for service in services[:count] for key in service.get('keys') or ()]
+        return tuple(keys) if isinstance(services, tuple) else keys
+    except (AttributeError, KeyError, TypeError):
+        return []
+
+def get_disabled_keys(config):
+    """Keys moved out of the server config; outline-ss-server ignores this section"""
+    return config.get('disabled_keys') or []
+
+def key_list(config, where):
+    """Mutable 'keys' or 'disabled_keys' list of a config, as named by ConfigSnapshot.locate()"""
+    if where == 'disabled_keys':
+        return config.setdefault('disabled_keys', [])
+    return get_keys(config)
+
+def all_keys(config):
+    """Active and disabled keys, e.g. for allocating unused ids"""
+    return list(get_keys(config)) + list(get_disabled_keys(config))
+
+def shard_of(key_id, count):
+    """Stable shard (service index) of a key id among count shards"""
+    return key_id % count if count > 1 else 0
+
+def set_keys(config, keys):
+    """Safely set keys array in config, each key in its shard's service"""
+    if 'services' not in config:
+        config['services'] = [{}]
+    if not config['services']:
+        config['services'] = [{}]
+    services = config['services']
+    count = shard_count(config)
+    if count == 1:
+        services[0]['keys'] = keys
+        return
+    shards = [[] for _ in range(count)]
+    for key in keys:
+        shards[shard_of(int_id(key), count)].append(key)
+    for service, shard_keys in zip(services, shards):
+        service['keys'] = shard_keys
+
+def service_paths(service):
+    """(tcp path, udp path) of a service's websocket listeners"""
+    paths = {'websocket-stream': '/tcp-ray', 'websocket-packet': '/udp-ray'}
+    for listener in service.get('listeners') or ():
+        if listener.get('type') in paths and listener.get('path'):
+            paths[listener['type']] = listener['path']
+    return paths['websocket-stream'], paths['websocket-packet']
+
+def shard_layout(snapshot):
+    """(paths per service, {key id: service index}) built once per config version"""
+    def build(snap):
+        services = (snap.config.get('services') or ())[:shard_count(snap.config)]
+        placement = {}
+        for index, service in enumerate(services):
+            for key in service.get('keys') or ():
+                placement[int_id(key)] = index
+        return tuple(service_paths(service) for service in services) or (service_paths({}),), placement
+    return snapshot.derived('shards', build)
+
+def shard_paths(snapshot, key):
+    """(tcp path, udp path) a key is served on; disabled keys get the shard they will return to"""
+    paths, placement = shard_layout(snapshot)
+    key_id = int_id(key)
+    index = placement.get(key_id)
+    return paths[index if index is not None else shard_of(key_id, len(paths))]
+
+def rebalance_shards(config, count):
+    """Re-shard a mutable config into count services; returns how many keys changed shard.
+
+    New shards copy service 0's websocket listeners under SHARD_PATH_FORMAT
+    paths and go right after the existing shards; shards beyond count are
+    removed after their keys are moved. Services that are not shards keep
+    their place after the shards and their keys.
+    """
+    if not 1 <= count <= MAX_SHARDS:
+        raise ValueError(f"Shard count must be between 1 and {MAX_SHARDS}")
+    services = config['services']
+    previous = shard_count(config)
+    shards, others = services[:previous], services[previous:]
+    template = shards[0].get('listeners') or []
+    if count > previous and any(not listener.get('path') for listener in template):
+        raise ValueError("Service 0 has listeners without a websocket path; they cannot be copied into shards")
+    before = {int_id(key): index for index, service in enumerate(shards) for key in service.get('keys') or ()}
+    keys = sorted(get_keys(config), key=int_id)
+    del shards[count:]
+    for shard in range(len(shards), count):
+        listeners = [dict(listener, path=SHARD_PATH_FORMAT.format(path=listener['path'], shard=shard))
+                     for listener in template]
+        shards.append({'listeners': listeners, 'keys': []})
+    services[:] = shards + others
+    if count > 1:
+        config[SHARDS_FIELD] = count
+    else:
+        config.pop(SHARDS_FIELD, None)
+    set_keys(config, keys)
+    return sum(1 for key in keys if before.get(int_id(key)) != shard_of(int_id(key), count))
+
+def listen_ports(config):
+    """TCP ports outline-ss-server accepts client connections on"""
+    ports = set()
+    addresses = []
+    for server in (config.get('web') or {}).get('servers') or ():
+        addresses.extend(server.get('listen') or ())
+    for service in config.get('services') or ():
+        for listener in service.get('listeners') or ():
+            if listener.get('address'):
+                addresses.append(listener['address'])
+    for address in addresses:
+        try:
+            ports.add(int(str(address).rsplit(':', 1)[1]))
+        except (IndexError, ValueError):
+            continue
+    return ports
+
+def count_established(ports):
+    """Count ESTABLISHED TCP connections on the given local ports (Linux /proc)"""
+    count = 0
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table) as f:
+                next(f, None)
+                for line in f:
+                    fields = line.split()
+                    # fields[1] is "ADDR:PORT" in hex, fields[3] the state (01 = ESTABLISHED)
+                    if len(fields) > 3 and fields[3] == '01' and int(fields[1].rsplit(':', 1)[1], 16) in ports:
+                        count += 1
+        except (OSError, ValueError, IndexError):
+            continue
+    return count
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class ServerSupervisor:
+    """Owns the outline-ss-server process and applies config changes to it.
+
+    A running server is sent SERVER_RELOAD_SIGNAL so it re-reads config.yaml
+    in place and keeps existing tunnels and counters. Only when there is no
+    server (or no reload signal) is it (re)started, and readiness is decided
+    by the METRICS_PORT listener accepting connections rather than a fixed
+    sleep. Every reload/restart is recorded in self.events.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc = None
+        self.events = deque(maxlen=50)
+
+    def command(self):
+        return [BINARY_PATH, f'-config={CONFIG_FILE}', '-metrics', f'127.0.0.1:{METRICS_PORT}']
+
+    def find_pids(self):
+        """PIDs of the running server: our own child, or one started outside the admin"""
+        if self._proc is not None and self._proc.poll() is None:
+            return [self._proc.pid]
+        pattern = f"{re.escape(os.path.basename(BINARY_PATH))}.*-config[= ]{re.escape(CONFIG_FILE)}"
+        try:
+            result = subprocess.run(['pgrep', '-f', pattern], capture_output=True, text=True, timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            return []
+        return [int(pid) for pid in result.stdout.split() if pid.isdigit() and int(pid) != os.getpid()]
+
+    def apply(self):
+        """Make the server pick up the current config.yaml; returns the recorded event"""
+        # The flock keeps several admin workers from restarting the server at once
+        with self._lock, open(f"{CONFIG_FILE}.server.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            started = time.monotonic()
+            pids = self.find_pids()
+            if pids and SERVER_RELOAD_SIGNAL is not None:
+                try:
+                    for pid in pids:
+                        os.kill(pid, SERVER_RELOAD_SIGNAL)
+                    return self._record('reloaded', started, interrupted=0, ok=True)
+                except ProcessLookupError:
+                    # Exited under us; fall through to a full restart
+                    pids = [pid for pid in pids if pid_alive(pid)]
+            return self._restart(pids, started)
+
+    def _restart(self, pids, started):
+        try:
+            interrupted = count_established(listen_ports(load_config())) if pids else 0
+        except (OSError, ValueError):
+            interrupted = 0
+        try:
+            self._stop(pids)
+            self._spawn()
+            ok = self._wait_ready()
+        except Exception as e:
+            self._record('restarted', started, interrupted=interrupted, ok=False, error=str(e))
+            raise
+        return self._record('restarted', started, interrupted=interrupted, ok=ok,
+                            error=None if ok else f"metrics port {METRICS_PORT} not ready after {SERVER_READY_TIMEOUT}s")
+
+    def _stop(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + SERVER_STOP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._proc is not None:
+                self._proc.poll()
+            if not any(pid_alive(pid) for pid in pids):
+                break
+            time.sleep(0.05)
+        else:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        if self._proc is not None:
+            try:
+                self._proc.wait(timeout=SERVER_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                pass
+            self._proc = None
+
+    def _spawn(self):
+        with open(SERVER_LOG_FILE, 'ab') as log:
+            # New session so the server outlives the admin, like nohup did
+            self._proc = subprocess.Popen(self.command(), stdin=subprocess.DEVNULL, stdout=log,
+                                          stderr=subprocess.STDOUT, start_new_session=True)
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + SERVER_READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._proc.poll() is not None:
+                raise RuntimeError(f"server exited with code {self._proc.returncode}, see {SERVER_LOG_FILE}")
+            try:
+                with socket.create_connection(('127.0.0.1', METRICS_PORT), timeout=0.2):
+                    return True
+            except OSError:
+                time.sleep(0.05)
+        return False
+
+    def _record(self, action, started, interrupted, ok, error=None):
+        server_actions.inc(action, 'ok' if ok else 'error')
+        server_action_duration.observe(time.monotonic() - started, action)
+        event = {
+            'action': action,
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'duration': round(time.monotonic() - started, 4),
+            'interrupted_connections': interrupted,
+            'ok': ok,
+            'error': error,
+        }
+        self.events.append(event)
+        return event
+
+supervisor = ServerSupervisor()
+
+def apply_server_changes(reason):
+    """Reload the server (hot reload, or restart if unavoidable) and the fleet; logs failures.
+
+    The fleet gets the config whatever happened locally, so one broken
+    local binary cannot hold back every node; the event has both results.
+    """
+    try:
+        if not user_store.render_server_config():
+            # Only admin fields changed; the server and the nodes have nothing new to read
+            return {'action': 'unchanged', 'at': datetime.now().isoformat(timespec='seconds'), 'duration': 0,
+                    'interrupted_connections': 0, 'ok': True, 'error': None}
+        event = supervisor.apply()
+        if not event['ok']:
+            app.logger.warning("Server %s after %s: %s", event['action'], reason, event['error'])
+    except Exception as e:
+        app.logger.exception("Server reload after %s failed", reason)
+        event = {'action': 'failed', 'at': datetime.now().isoformat(timespec='seconds'), 'duration': 0,
+                 'interrupted_connections': 0, 'ok': False, 'error': str(e)}
+    try:
+        failed = failed_nodes(push_to_fleet())
+    except Exception as e:
+        app.logger.exception("Config push after %s failed", reason)
+        failed = str(e)
+    if failed:
+        app.logger.warning("Config push after %s failed on node(s) %s", reason, failed)
+        event = dict(event, fleet_error=failed)
+    return event
+
+class ReloadQueue:
+    """Applies committed config changes to the server from one background thread.
+
+    Writers save the config first and then call request(); the applier
+    waits until no request has come in for RELOAD_DEBOUNCE seconds (at
+    most RELOAD_MAX_DELAY after the first one) and reloads once for the
+    whole batch, so requests never wait on the process manager and a
+    burst of edits costs one reload. A change requested while a reload
+    is running starts the next batch. Queues are per process; with
+    several workers the supervisor's lock serializes their reloads.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._first_at = None
+        self._last_at = None
+        self._applying = 0
+        self._stopping = False
+        self._thread = None
+        # Bumped on every state change, e.g. for dashboard ETags
+        self.version = 0
+        self.last_applied = None
+
+    def request(self, reason):
+        """Queue a reload for an already saved change; returns the number of pending changes"""
+        reload_requests.inc()
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_at = now
+            self._last_at = now
+            self._pending.append(reason)
+            self.version += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='reload-queue', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return len(self._pending)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                if self._stopping:
+                    return None
+                self._cond.wait()
+            while not self._stopping:
+                due = min(self._last_at + RELOAD_DEBOUNCE, self._first_at + RELOAD_MAX_DELAY)
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._pending = self._pending, []
+            self._applying = len(batch)
+            self.version += 1
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            reason = batch[0] if len(batch) == 1 else f"{len(batch)} changes ({'; '.join(batch[:3])}{'; ...' if len(batch) > 3 else ''})"
+            try:
+                event = apply_server_changes(reason)
+            except Exception as e:
+                app.logger.exception("Applying %s failed", reason)
+                event = {'action': 'failed', 'at': datetime.now().isoformat(timespec='seconds'), 'duration': 0,
+                         'interrupted_connections': 0, 'ok': False, 'error': str(e)}
+            with self._cond:
+                self._applying = 0
+                self.last_applied = {'at': datetime.now().isoformat(timespec='seconds'), 'changes': len(batch),
+                                     'reasons': batch[:10], 'event': event}
+                self.version += 1
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Apply pending changes now instead of after the debounce; True once all are applied"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._first_at = self._last_at = float('-inf')
+            self._cond.notify_all()
+            while self._pending or self._applying:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self, timeout=None):
+        """Apply whatever is pending, then let the applier thread exit"""
+        applied = self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        return applied
+
+    def state(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'pending_reasons': self._pending[:10],
+                    'applying': self._applying, 'last_applied': self.last_applied}
+
+reload_queue = ReloadQueue()
+
+def queue_server_reload(reason):
+    """Queue a reload after a committed change; returns the flash message tail"""
+    pending = reload_queue.request(reason)
+    if pending > 1:
+        return f"; server reload queued with {pending - 1} other pending change{'s' if pending > 2 else ''}!"
+    return "; server reload queued!"
+
+def generate_secret():
+    """Generate a random 20-char secret"""
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(secrets.choice(alphabet) for i in range(20))
+
+def mask_secret(secret, show_chars=4):
+    """Mask secret showing only first and last few characters"""
+    if not secret or len(secret) <= show_chars * 2:
+        return secret
+    return f"{secret[:show_chars]}{'*' * (len(secret) - show_chars * 2)}{secret[-show_chars:]}"
+
+def client_config(target_key, paths=('/tcp-ray', '/udp-ray'), domain=DOMAIN):
+    """Build the client transport configuration for a given key on its shard's (tcp, udp) paths"""
+    tcp_path, udp_path = paths
+    return {
+        'transport': {
+            '$type': 'tcpudp',
+            'tcp': {
+                '$type': 'shadowsocks',
+                'endpoint': {'$type': 'websocket', 'url': f'wss://{domain}{tcp_path}'},
+                'cipher': target_key.get('cipher', 'chacha20-ietf-poly1305'),
+                'secret': target_key.get('secret', '')
+            },
+            'udp': {
+                '$type': 'shadowsocks',
+                'endpoint': {'$type': 'websocket', 'url': f'wss://{domain}{udp_path}'},
+                'cipher': target_key.get('cipher', 'chacha20-ietf-poly1305'),
+                'secret': target_key.get('secret', '')
+            }
+        }
+    }
+
+def ss_url(target_key, domain=DOMAIN):
+    """Classic SIP002 ss:// URL for a given key"""
+    userinfo = f"{target_key.get('cipher', 'chacha20-ietf-poly1305')}:{target_key.get('secret', '')}"
+    encoded = base64.urlsafe_b64encode(userinfo.encode('utf-8')).decode('ascii').rstrip('=')
+    url = f"ss://{encoded}@{domain}:{SS_URL_PORT}"
+    if target_key.get('name'):
+        url += '#' + urllib.parse.quote(str(target_key['name']))
+    return url
+
+# format -> (renderer(key, paths, domain), Content-Type)
+CLIENT_FORMATS = {
+    'yaml': (lambda key, paths, domain: yaml_dump(client_config(key, paths, domain)),
+             'text/yaml; charset=utf-8'),
+    'json': (lambda key, paths, domain: json.dumps(client_config(key, paths, domain), indent=2), 'application/json'),
+    'ss': (lambda key, paths, domain: ss_url(key, domain) + '\n', 'text/plain; charset=utf-8'),
+}
+
+class RenderedConfigCache:
+    """LRU of rendered client configs keyed by everything the output depends on.
+
+    Editing a key changes its cipher/secret and re-sharding its paths,
+    which are part of the cache key, so stale entries are simply never hit
+    again and age out.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def cache_key(target_key, fmt, paths, domain):
+        return (fmt, target_key.get('cipher', 'chacha20-ietf-poly1305'), target_key.get('secret', ''),
+                domain, SS_URL_PORT, target_key.get('name', '') if fmt == 'ss' else paths)
+
+    def get(self, target_key, fmt='yaml', paths=('/tcp-ray', '/udp-ray'), domain=DOMAIN):
+        """(body, etag) for a key in one of CLIENT_FORMATS, served on paths (see shard_paths()) at domain"""
+        cache_key = self.cache_key(target_key, fmt, paths, domain)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                return entry
+        body = CLIENT_FORMATS[fmt][0](target_key, paths, domain)
+        entry = (body, hashlib.sha1(body.encode('utf-8')).hexdigest())
+        with self._lock:
+            self._entries[cache_key] = entry
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+rendered_configs = RenderedConfigCache(CLIENT_CONFIG_CACHE_SIZE)
+
+class TokenBucketLimiter:
+    """Per-client token buckets in an LRU table of bounded size.
+
+    Each client may make burst requests at once and then rate per second.
+    Buckets are refilled lazily on access, so idle clients cost nothing
+    until they are evicted as least recently seen; an evicted client simply
+    starts again with a full bucket.
+    """
+
+    def __init__(self, burst, rate, max_clients, clock=time.monotonic):
+        self.burst = burst
+        self.rate = rate
+        self.max_clients = max_clients
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def allow(self, client):
+        """(True, 0) if client may proceed, else (False, seconds until a token is available)"""
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / self.rate
+
+class NegativeCache:
+    """Secrets that recently matched no key, answered without a config lookup.
+
+    Entries hold a digest of the secret (never the secret itself) and the
+    config cache version they were checked against: any config change in
+    this process voids them at once, and the TTL bounds how long a key
+    added by another worker can be missed.
+    """
+
+    def __init__(self, ttl, size, clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def contains(self, secret):
+        current = config_cache.current()
+        digest = secret_digest(secret)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return False
+            expires, version = entry
+            if expires > self.clock() and current is not None and version == current.version:
+                return True
+            del self._entries[digest]
+            return False
+
+    def add(self, secret, snapshot):
+        digest = secret_digest(secret)
+        with self._lock:
+            self._entries[digest] = (self.clock() + self.ttl, snapshot.version)
+            self._entries.move_to_end(digest)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+api_limiter = TokenBucketLimiter(API_RATE_BURST, API_RATE_PER_SECOND, API_RATE_MAX_CLIENTS)
+api_misses = NegativeCache(API_NEGATIVE_TTL, API_NEGATIVE_CACHE_SIZE)
+
+def client_ip():
+    """Address of the caller; X-Forwarded-For is only believed when sent by TRUSTED_PROXIES"""
+    remote = request.remote_addr or ''
+    if remote not in TRUSTED_PROXIES:
+        return remote
+    # Proxies append the address they saw, so the last untrusted hop is the client
+    hops = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',')]
+    for hop in reversed(hops):
+        if hop and hop not in TRUSTED_PROXIES:
+            return hop
+    return remote
+
+def generate_client_yaml(target_key, snapshot=None):
+    """Generate client YAML configuration for a given key"""
+    return rendered_configs.get(target_key, 'yaml', shard_paths(snapshot or load_snapshot(), target_key))[0]
+
+# --- FLEET ---
+NODE_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+class Node:
+    """A remote node from NODES_FILE, reached through its agent.py"""
+
+    def __init__(self, name, url, token):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.token = token
+
+    @property
+    def headers(self):
+        return {'Authorization': f"Bearer {self.token}"}
+
+class NodeRegistry:
+    """NODES_FILE ('nodes: [{name, url, token}, ...]'), reread when it changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._nodes = ()
+
+    def nodes(self):
+        """Registered nodes; empty when NODES_FILE does not exist (single-node mode).
+
+        Entries without a name or url are skipped, and a file that does
+        not parse keeps the last good list; both are logged once per change.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return ()
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp != self._stamp:
+            with self._lock:
+                self._stamp = stamp
+                try:
+                    with open(self.path) as f:
+                        data = yaml_load(f) or {}
+                    entries = data.get('nodes') or [] if isinstance(data, dict) else None
+                    if not isinstance(entries, list):
+                        raise ValueError("expected 'nodes: [{name, url, token}, ...]'")
+                except (OSError, yaml.YAMLError, ValueError) as e:
+                    app.logger.error("Ignoring unreadable %s, keeping %d node(s): %s", self.path, len(self._nodes), e)
+                    return self._nodes
+                nodes = []
+                for position, entry in enumerate(entries):
+                    if (not isinstance(entry, dict) or not isinstance(entry.get('name'), str)
+                            or not isinstance(entry.get('url'), str)):
+                        app.logger.error("Skipping node #%d in %s: it needs a name and a url", position + 1, self.path)
+                        continue
+                    nodes.append(Node(entry['name'], entry['url'], str(entry.get('token') or '')))
+                self._nodes = tuple(nodes)
+        return self._nodes
+
+    def save(self, nodes):
+        """Atomically rewrite NODES_FILE (it holds agent tokens, so mode 0600)"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.nodes.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                yaml_dump({'nodes': [{'name': node.name, 'url': node.url, 'token': node.token} for node in nodes]}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def add(self, name, url, token):
+        if not NODE_NAME_RE.match(name) or name == LOCAL_NODE:
+            raise ValueError(f"Invalid node name '{name}' (letters, digits, '.', '_', '-'; not '{LOCAL_NODE}')")
+        if not url.startswith(('http://', 'https://')):
+            raise ValueError("Node URL must start with http:// or https://")
+        if not token or not token.strip():
+            raise ValueError("Node token is required (the agent's .agent_token)")
+        nodes = self.nodes()
+        if any(node.name == name for node in nodes):
+            raise ValueError(f"Node '{name}' already exists")
+        self.save(nodes + (Node(name, url, token),))
+
+    def remove(self, name):
+        nodes = self.nodes()
+        remaining = tuple(node for node in nodes if node.name != name)
+        if len(remaining) == len(nodes):
+            raise KeyError(name)
+        self.save(remaining)
+
+node_registry = NodeRegistry(NODES_FILE)
+
+class FleetClient:
+    """Talks to every node's agent concurrently over one pooled session.
+
+    Calls fan out on a shared thread pool; every node gets FLEET_TIMEOUT
+    and its own result dict (ok, error, duration, ...), so a slow or dead
+    node never holds up the others. Keep-alive connections are reused
+    between pushes and scrapes.
+    """
+
+    def __init__(self):
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=FLEET_WORKERS, pool_maxsize=FLEET_WORKERS)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix='fleet')
+        self.last_push = {}
+
+    def submit(self, nodes, call):
+        """Start call(node) on every node; pass the result to collect()"""
+        return {node.name: self._executor.submit(self._timed, call, node) for node in nodes}
+
+    @staticmethod
+    def collect(futures):
+        """{node name: result}, with nodes that overran FLEET_TIMEOUT reported as failed"""
+        wait_futures(futures.values(), timeout=FLEET_TIMEOUT + 1)
+        return {name: future.result() if future.done()
+                else {'ok': False, 'error': f"timed out after {FLEET_TIMEOUT}s", 'duration': FLEET_TIMEOUT}
+                for name, future in futures.items()}
+
+    @staticmethod
+    def _timed(call, node):
+        started = time.monotonic()
+        try:
+            result = dict(call(node), ok=True, error=None)
+        except Exception as e:
+            result = {'ok': False, 'error': str(e)}
+        result['duration'] = round(time.monotonic() - started, 4)
+        result['at'] = datetime.now().isoformat(timespec='seconds')
+        return result
+
+    def push(self, nodes, body, generation, force=False):
+        """PUT the saved config to every agent; {node name: result}"""
+        headers = {'X-Config-Version': str(generation), 'Content-Type': 'text/yaml'}
+        if force:
+            headers['X-Config-Force'] = '1'
+
+        def put(node):
+            response = self._session.put(f"{node.url}/config", data=body, headers={**node.headers, **headers},
+                                         timeout=FLEET_TIMEOUT)
+            reply = response.json()
+            if response.status_code != 200 or not reply.get('ok'):
+                raise RuntimeError(reply.get('error') or f"HTTP {response.status_code}")
+            return {'action': reply.get('action'), 'generation': reply.get('generation')}
+
+        results = self.collect(self.submit(nodes, put))
+        for name, result in results.items():
+            fleet_pushes.inc(name, 'ok' if result['ok'] else 'error')
+        self.last_push = results
+        return results
+
+    def submit_scrape(self, nodes):
+        """Start fetching every agent's /metrics; collect() gives {'usage': {...}} per node"""
+        def scrape(node):
+            with self._session.get(f"{node.url}/metrics", headers=node.headers, timeout=FLEET_TIMEOUT,
+                                   stream=True) as response:
+                response.raise_for_status()
+                return {'usage': parse_usage(response.iter_lines())}
+
+        return self.submit(nodes, scrape)
+
+fleet = FleetClient()
+
+def push_to_fleet(force=False):
+    """Send the saved config to every registered node ({} in single-node mode)"""
+    nodes = node_registry.nodes()
+    if not nodes:
+        return {}
+    user_store.render_server_config()
+    with open(CONFIG_FILE, 'rb') as f:
+        body = f.read()
+    return fleet.push(nodes, body, parse_generation(body.decode('utf-8', 'replace')), force)
+
+def failed_nodes(results):
+    """Comma-separated 'name (error)' list of failed per-node results"""
+    return ', '.join(f"{name} ({result['error']})" for name, result in results.items() if not result['ok'])
+
+# --- METRICS ---
+USAGE_METRIC = 'shadowsocks_data_bytes'
+_LABEL_ESCAPES = {'\\': '\\', '"': '"', 'n': '\n'}
+
+def parse_labels(text):
+    """Parse a Prometheus label set body: k="v",k2="v\"2" -> dict"""
+    labels = {}
+    i, n = 0, len(text)
+    while i < n:
+        eq = text.find('=', i)
+        if eq < 0 or eq + 1 >= n or text[eq + 1] != '"':
+            raise ValueError(f"Malformed labels: {text!r}")
+        name = text[i:eq].strip().lstrip(',').strip()
+        i = eq + 2
+        value = []
+        while i < n and text[i] != '"':
+            if text[i] == '\\' and i + 1 < n:
+                value.append(_LABEL_ESCAPES.get(text[i + 1], '\\' + text[i + 1]))
+                i += 2
+            else:
+                value.append(text[i])
+                i += 1
+        if i >= n:
+            raise ValueError(f"Unterminated label value: {text!r}")
+        labels[name] = ''.join(value)
+        i += 1
+        while i < n and text[i] in ', ':
+            i += 1
+    return labels
+
+def parse_sample(line):
+    """Parse one exposition line into (name, labels, value)"""
+    brace = line.find('{')
+    if brace >= 0:
+        close = line.rfind('}')
+        if close < brace:
+            raise ValueError(f"Malformed sample: {line!r}")
+        name = line[:brace]
+        labels = parse_labels(line[brace + 1:close])
+        rest = line[close + 1:].split()
+    else:
+        name, *rest = line.split()
+        labels = {}
+    if not rest:
+        raise ValueError(f"Sample without value: {line!r}")
+    # rest[1], if present, is an optional timestamp
+    return name.strip(), labels, float(rest[0])
+
+def parse_usage(lines, metric=USAGE_METRIC):
+    """Sum one metric family per access_key from an iterable of byte lines.
+
+    Only lines of the wanted family are decoded and parsed, so the rest of
+    the (potentially large) exposition is skipped without allocation.
+    """
+    prefix = metric.encode('ascii')
+    usage = {}
+    for line in lines:
+        if not line.startswith(prefix) or line[len(prefix):len(prefix) + 1] not in (b'{', b' '):
+            continue
+        try:
+            _, labels, value = parse_sample(line.decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            continue
+        key_id = labels.get('access_key')
+        if key_id is not None:
+            usage[key_id] = usage.get(key_id, 0) + value
+    return usage
+
+class MetricsSnapshot:
+    """Immutable result of one scrape: per-key usage plus when/how it was taken.
+
+    usage is summed over all nodes; sources keeps each node's raw counters,
+    nodes each node's scrape result and failed the nodes (LOCAL_NODE
+    included) this scrape could not reach.
+    """
+
+    def __init__(self, usage, version, scraped_at=None, duration=0.0, error=None, sources=None, nodes=None,
+                 failed=()):
+        self.usage = MappingProxyType(usage)
+        self.version = version
+        self.scraped_at = scraped_at
+        self.duration = duration
+        self.error = error
+        self.sources = MappingProxyType(sources if sources is not None else {LOCAL_NODE: usage})
+        self.nodes = MappingProxyType(nodes or {})
+        self.failed = frozenset(failed)
+
+    def counters(self):
+        """Raw counters for UsageHistory: key id on this node, 'key_id@node' elsewhere"""
+        counters = dict(self.sources.get(LOCAL_NODE, {}))
+        for node, usage in self.sources.items():
+            if node != LOCAL_NODE:
+                counters.update((f"{key_id}@{node}", raw) for key_id, raw in usage.items())
+        return counters
+
+    @property
+    def age(self):
+        """Seconds since the scrape, or None if nothing was scraped yet"""
+        return None if self.scraped_at is None else time.time() - self.scraped_at
+
+class MetricsScraper:
+    """Scrapes METRICS_URL on a background thread over a pooled session.
+
+    Readers take self.snapshot, which is swapped atomically after every
+    scrape, so page renders never wait on the metrics port. A failed
+    scrape keeps the previous usage and records the error. In fleet mode
+    every node's agent is scraped in parallel with the local server; a
+    node that fails keeps its previous counters for that round.
+    """
+
+    def __init__(self):
+        self.snapshot = MetricsSnapshot({}, version=0)
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call callback(snapshot) on the scraper thread after every successful scrape"""
+        self._listeners.append(callback)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='metrics-scraper', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Scrape now instead of at the end of the current interval"""
+        self.start()
+        self._wake.set()
+
+    def scrape_once(self):
+        started = time.monotonic()
+        previous = self.snapshot
+        pending = fleet.submit_scrape(node_registry.nodes())
+        sources, nodes, errors = {}, {}, []
+        try:
+            with self._session.get(METRICS_URL, timeout=METRICS_SCRAPE_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                sources[LOCAL_NODE] = parse_usage(response.iter_lines())
+        except Exception as e:
+            # Metrics server might not be ready yet or not running
+            errors.append(f"{LOCAL_NODE}: {e}" if pending else str(e))
+        for name, result in fleet.collect(pending).items():
+            nodes[name] = {key: value for key, value in result.items() if key != 'usage'}
+            if result['ok']:
+                sources[name] = result['usage']
+            else:
+                errors.append(f"{name}: {result['error']}")
+        error = '; '.join(errors) or None
+        scrape_duration.observe(time.monotonic() - started)
+        failed = [name for name in (LOCAL_NODE, *nodes) if name not in sources]
+        for name in failed:
+            scrape_failures.inc(name)
+
+        if not sources:
+            snapshot = MetricsSnapshot(dict(previous.usage), previous.version, previous.scraped_at,
+                                       time.monotonic() - started, error, previous.sources, nodes, failed)
+            self.snapshot = snapshot
+            return snapshot
+        for name, usage in previous.sources.items():
+            # Nodes that failed this round keep their last counters
+            if name not in sources and (name == LOCAL_NODE or name in nodes):
+                sources[name] = usage
+        usage = {}
+        for counters in sources.values():
+            for key_id, raw in counters.items():
+                usage[key_id] = usage.get(key_id, 0) + raw
+        snapshot = MetricsSnapshot(usage, previous.version + 1, time.time(), time.monotonic() - started,
+                                   error, sources, nodes, failed)
+        self.snapshot = snapshot
+        for callback in self._listeners:
+            try:
+                callback(snapshot)
+            except Exception:
+                app.logger.exception("Metrics listener %r failed", callback)
+        return snapshot
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.scrape_once()
+            except Exception:
+                app.logger.exception("Metrics scrape failed")
+            # Scrape faster while someone is watching live rates
+            self._wake.wait(LIVE_SCRAPE_INTERVAL if rate_tracker.subscribers else METRICS_SCRAPE_INTERVAL)
+            self._wake.clear()
+
+metrics_scraper = MetricsScraper()
+
+# --- USAGE HISTORY ---
+def usage_month(at):
+    """Billing month of a unix time as YYYYMM (UTC)"""
+    moment = datetime.fromtimestamp(at, timezone.utc)
+    return moment.year * 100 + moment.month
+
+def counter_key_id(counter):
+    """Key id of a UsageHistory counter ('7' or '7@node')"""
+    return counter.partition('@')[0]
+
+class UsageHistory:
+    """Persistent, counter-reset-aware per-key byte totals in SQLite.
+
+    outline-ss-server counters restart from zero whenever the process does.
+    Each scrape is turned into per-key deltas against the last raw value
+    seen (a drop means the counter was reset, so the new raw value is the
+    delta) and accumulated into a monotonic total, a running total for the
+    current month (for quotas) and hourly and daily buckets (UTC). A whole
+    scrape is written in one transaction; BEGIN IMMEDIATE and the stored
+    last scrape time make concurrent workers scraping the same server
+    harmless. In fleet mode each node's counter is tracked on its own row
+    ('key_id@node', see MetricsSnapshot.counters()) so one node restarting
+    is not mistaken for a reset of the others; totals, months and buckets
+    are per key.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self._totals = MappingProxyType({})
+        self._months = {}
+        self._last_prune = 0
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS counters (
+                    key_id TEXT PRIMARY KEY, last_raw REAL NOT NULL, total REAL NOT NULL,
+                    resets INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL,
+                    month INTEGER NOT NULL DEFAULT 0, month_bytes REAL NOT NULL DEFAULT 0) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS usage_hourly (
+                    key_id TEXT NOT NULL, bucket INTEGER NOT NULL, bytes REAL NOT NULL,
+                    PRIMARY KEY (key_id, bucket)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS usage_daily (
+                    key_id TEXT NOT NULL, bucket INTEGER NOT NULL, bytes REAL NOT NULL,
+                    PRIMARY KEY (key_id, bucket)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS usage_hourly_bucket ON usage_hourly (bucket);
+                CREATE INDEX IF NOT EXISTS usage_daily_bucket ON usage_daily (bucket);
+            """)
+            columns = {row[1] for row in db.execute("PRAGMA table_info(counters)")}
+            if 'month' not in columns:
+                # Databases created before per-month totals were tracked
+                db.execute("ALTER TABLE counters ADD COLUMN month INTEGER NOT NULL DEFAULT 0")
+                db.execute("ALTER TABLE counters ADD COLUMN month_bytes REAL NOT NULL DEFAULT 0")
+            self._db = db
+            rows = db.execute("SELECT key_id, total, month, month_bytes FROM counters").fetchall()
+            self._aggregate({counter: (total, month, month_bytes) for counter, total, month, month_bytes in rows})
+        return self._db
+
+    def _aggregate(self, counters):
+        """Fold per-counter {counter: (total, month, month_bytes)} into per-key totals and months"""
+        totals, months = {}, {}
+        for counter, (total, month, month_bytes) in counters.items():
+            key_id = counter_key_id(counter)
+            totals[key_id] = totals.get(key_id, 0) + total
+            key_month, key_bytes = months.get(key_id, (month, 0))
+            if month > key_month:
+                months[key_id] = (month, month_bytes)
+            elif month == key_month:
+                months[key_id] = (month, key_bytes + month_bytes)
+        self._totals = MappingProxyType(totals)
+        self._months = months
+
+    def totals(self):
+        """Monotonic byte totals per key id (read-only, never touches the disk)"""
+        if self._db is None:
+            with self._lock:
+                self._connect()
+        return self._totals
+
+    def record(self, usage, at):
+        """Accumulate one scrape's raw counters; returns {key_id: delta bytes} summed over nodes"""
+        hour = int(at // 3600) * 3600
+        day = int(at // 86400) * 86400
+        month = usage_month(at)
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT value FROM meta WHERE name = 'last_scrape_at'").fetchone()
+                if row and row[0] >= at:
+                    # Another worker already recorded a newer scrape
+                    db.execute("ROLLBACK")
+                    return {}
+                stored = {key_id: (last_raw, total, resets, key_month, month_bytes)
+                          for key_id, last_raw, total, resets, key_month, month_bytes
+                          in db.execute("SELECT key_id, last_raw, total, resets, month, month_bytes FROM counters")}
+                deltas, counters = {}, []
+                for counter, raw in usage.items():
+                    last_raw, total, resets, key_month, month_bytes = stored.get(counter, (0, 0, 0, month, 0))
+                    if raw < last_raw:
+                        delta = raw
+                        resets += 1
+                    else:
+                        delta = raw - last_raw
+                    if delta == 0 and counter in stored:
+                        continue
+                    if key_month != month:
+                        month_bytes = 0
+                    key_id = counter_key_id(counter)
+                    deltas[key_id] = deltas.get(key_id, 0) + delta
+                    counters.append((counter, raw, total + delta, resets, at, month, month_bytes + delta))
+                db.executemany("INSERT OR REPLACE INTO counters (key_id, last_raw, total, resets, updated_at, month, month_bytes) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)", counters)
+                buckets = [(key_id, delta) for key_id, delta in deltas.items() if delta > 0]
+                for table, bucket in (('usage_hourly', hour), ('usage_daily', day)):
+                    db.executemany(f"INSERT INTO {table} (key_id, bucket, bytes) VALUES (?, {bucket}, ?) "
+                                   f"ON CONFLICT (key_id, bucket) DO UPDATE SET bytes = bytes + excluded.bytes",
+                                   buckets)
+                db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('last_scrape_at', ?)", (at,))
+                if at - self._last_prune > 3600:
+                    self._prune(db, at)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            merged = {counter: (entry[1], entry[3], entry[4]) for counter, entry in stored.items()}
+            for counter, _, total, _, _, key_month, month_bytes in counters:
+                merged[counter] = (total, key_month, month_bytes)
+            self._aggregate(merged)
+            return deltas
+
+    def month_total(self, key_id, month):
+        """Bytes used by a key in a usage_month() (from memory, kept current by record())"""
+        if self._db is None:
+            with self._lock:
+                self._connect()
+        key_month, month_bytes = self._months.get(str(key_id), (month, 0))
+        return month_bytes if key_month == month else 0
+
+    def _prune(self, db, at):
+        db.execute("DELETE FROM usage_hourly WHERE bucket < ?", (at - USAGE_HOURLY_RETENTION_DAYS * 86400,))
+        db.execute("DELETE FROM usage_daily WHERE bucket < ?", (at - USAGE_DAILY_RETENTION_DAYS * 86400,))
+        self._last_prune = at
+
+    def series(self, key_id, resolution='hourly'):
+        """[(bucket_start_unix, bytes), ...] for one key, oldest first"""
+        table = 'usage_daily' if resolution == 'daily' else 'usage_hourly'
+        with self._lock:
+            db = self._connect()
+            return db.execute(f"SELECT bucket, bytes FROM {table} WHERE key_id = ? ORDER BY bucket",
+                              (str(key_id),)).fetchall()
+
+usage_history = UsageHistory(USAGE_DB_FILE)
+
+def on_metrics_scraped(snapshot):
+    """Scraper listener: persist the scrape, then enforce quotas on its deltas"""
+    deltas = usage_history.record(snapshot.counters(), snapshot.scraped_at)
+    quota_enforcer.check(deltas, snapshot.scraped_at)
+    return deltas
+
+metrics_scraper.add_listener(on_metrics_scraped)
+
+def rate_changed(old, new):
+    """Whether a published rate is stale enough to push again"""
+    if not old or not new:
+        return old != new
+    return abs(new - old) > RATE_CHANGE_THRESHOLD * old
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+class RateTracker:
+    """Per-key bytes/sec from successive scrapes, shared by every live dashboard.
+
+    A scraper listener: all open streams read the same published rates, so
+    no tab causes a scrape of its own. A rate is republished only when it
+    moved by more than RATE_CHANGE_THRESHOLD (or started/stopped), and each
+    update keeps just those keys, which is all a subscriber that saw the
+    previous update needs. Rates are summed over nodes, with counter resets
+    handled per node like UsageHistory does.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._previous = None
+        self.rates = MappingProxyType({})
+        self.changed = MappingProxyType({})
+        self.top = ()
+        # Bytes/sec per node, all keys together (see EndpointPool)
+        self.node_rates = MappingProxyType({})
+        self.version = 0
+        self.subscribers = 0
+
+    def update(self, snapshot):
+        counters, at = snapshot.counters(), snapshot.scraped_at
+        if at is None:
+            return
+        previous, self._previous = self._previous, (counters, at)
+        if previous is None or at <= previous[1]:
+            return
+        last_counters, elapsed = previous[0], at - previous[1]
+        moved, node_moved = {}, {}
+        for counter, raw in counters.items():
+            last = last_counters.get(counter)
+            if last is None:
+                continue
+            delta = raw - last if raw >= last else raw
+            if delta > 0:
+                key_id, _, node = counter.partition('@')
+                moved[key_id] = moved.get(key_id, 0) + delta
+                node = node or LOCAL_NODE
+                node_moved[node] = node_moved.get(node, 0) + delta
+        current = {key_id: round(delta / elapsed) for key_id, delta in moved.items() if delta >= elapsed}
+        self.node_rates = MappingProxyType({node: round(delta / elapsed) for node, delta in node_moved.items()})
+
+        published = dict(self.rates)
+        changed = {key_id: rate for key_id, rate in current.items() if rate_changed(published.get(key_id, 0), rate)}
+        changed.update((key_id, 0) for key_id in published if key_id not in current)
+        for key_id, rate in changed.items():
+            if rate:
+                published[key_id] = rate
+            else:
+                del published[key_id]
+        top = tuple(sorted(published.items(), key=lambda item: -item[1])[:TOP_TALKERS])
+        with self._cond:
+            self.rates = MappingProxyType(published)
+            self.changed = MappingProxyType(changed)
+            self.top = top
+            self.version += 1
+            self._cond.notify_all()
+
+    def top_talkers(self, top):
+        snapshot = load_snapshot()
+        talkers = []
+        for key_id, rate in top:
+            key = snapshot.find(int(key_id)) if key_id.isdigit() else None
+            talkers.append({'id': key_id, 'name': (key or {}).get('name') or '', 'rate': rate})
+        return talkers
+
+    def stream(self):
+        """SSE events: all rates and the top list first, then only what changed"""
+        with self._cond:
+            self.subscribers += 1
+        metrics_scraper.wake()
+        try:
+            with self._cond:
+                version, rates, top = self.version, dict(self.rates), self.top
+            yield f"retry: {LIVE_SCRAPE_INTERVAL * 2500}\n"
+            yield sse_event('rates', {'full': True, 'rates': rates, 'interval': LIVE_SCRAPE_INTERVAL})
+            yield sse_event('top', self.top_talkers(top))
+            sent_top = top
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self.version != version, timeout=STREAM_KEEPALIVE)
+                    if self.version == version:
+                        changed = None
+                    elif self.version == version + 1:
+                        changed = dict(self.changed)
+                    else:
+                        # Missed updates: resend everything
+                        changed = None
+                        rates = dict(self.rates)
+                    behind, version, top = self.version - version, self.version, self.top
+                if behind == 0:
+                    yield ": keepalive\n\n"
+                    continue
+                if changed is None:
+                    yield sse_event('rates', {'full': True, 'rates': rates})
+                elif changed:
+                    yield sse_event('rates', {'full': False, 'rates': changed})
+                if top != sent_top:
+                    yield sse_event('top', self.top_talkers(top))
+                    sent_top = top
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+rate_tracker = RateTracker()
+metrics_scraper.add_listener(rate_tracker.update)
+
+class EndpointPool:
+    """Chooses which of ENDPOINTS /api sends each key to.
+
+    An endpoint's load is its node's current bytes/sec from the rate
+    tracker (as of the last scrape); nodes the last scrape could not reach
+    are skipped unless all of them failed. A new key goes to the lightest
+    endpoint; endpoints within the hysteresis margin of it count as equally
+    light and are spread by key id, so a burst of new keys between two
+    scrapes is not all sent to one host. A key keeps its endpoint for the
+    sticky period and afterwards as long as it is within the margin, so
+    clients do not flap as loads move. Choices are kept per process in an
+    LRU table; workers that lose one make the same id-based choice again.
+    """
+
+    def __init__(self, endpoints, sticky, hysteresis, size):
+        if not endpoints:
+            raise ValueError("ENDPOINTS needs at least one (domain, node) entry")
+        self.endpoints = tuple(endpoints)
+        self.sticky = sticky
+        self.hysteresis = hysteresis
+        self.size = size
+        self._lock = threading.Lock()
+        self._assigned = OrderedDict()
+
+    def loads(self):
+        """{domain: bytes/sec} of the endpoints that are up"""
+        rates, failed = rate_tracker.node_rates, metrics_scraper.snapshot.failed
+        loads = {domain: rates.get(node, 0) for domain, node in self.endpoints if node not in failed}
+        return loads or {domain: rates.get(node, 0) for domain, node in self.endpoints}
+
+    def choose(self, key_id):
+        """Domain to hand out for a key id"""
+        if len(self.endpoints) == 1:
+            return self.endpoints[0][0]
+        loads = self.loads()
+        margin = min(loads.values()) * (1 + self.hysteresis)
+        now = time.monotonic()
+        with self._lock:
+            current = self._assigned.get(key_id)
+            if current is not None and current[0] in loads and (
+                    now - current[1] < self.sticky or loads[current[0]] <= margin):
+                self._assigned.move_to_end(key_id)
+                return current[0]
+            light = [domain for domain in loads if loads[domain] <= margin]
+            domain = light[key_id % len(light)]
+            self._assigned[key_id] = (domain, now)
+            self._assigned.move_to_end(key_id)
+            if len(self._assigned) > self.size:
+                self._assigned.popitem(last=False)
+            return domain
+
+    def status(self):
+        """Per-endpoint load and how many remembered keys it holds"""
+        with self._lock:
+            counts = {}
+            for domain, _ in self._assigned.values():
+                counts[domain] = counts.get(domain, 0) + 1
+        failed = metrics_scraper.snapshot.failed
+        return [{'domain': domain, 'node': node, 'bytes_per_second': rate_tracker.node_rates.get(node, 0),
+                 'up': node not in failed, 'keys': counts.get(domain, 0)} for domain, node in self.endpoints]
+
+endpoint_pool = EndpointPool(ENDPOINTS, ENDPOINT_STICKY, ENDPOINT_HYSTERESIS, ENDPOINT_ASSIGNMENTS)
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
+
+def get_metrics():
+    """Latest per-key usage from the background scraper (never blocks)"""
+    return metrics_scraper.snapshot.usage
+
+# --- KEY LISTING ---
+def int_id(key):
+    try:
+        return int(key.get('id', 0))
+    except (ValueError, TypeError):
+        return 0
+
+def parse_expire_date(value):
+    """expire_date from the config (str or YAML date) -> date, or None"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return parse_date_text(str(value))
+
+@functools.lru_cache(maxsize=4096)
+def parse_date_text(text):
+    """'YYYY-MM-DD' -> date or None; memoized, since many keys share a date and strptime is slow"""
+    try:
+        return datetime.strptime(text, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class KeyListing:
+    """Display rows, name search index and sort orders for one config version.
+
+    Everything here is derived from the keys alone (masked secrets, parsed
+    expiry dates, a trigram index over lowercased names, presorted orders),
+    so it is built once per ConfigSnapshot. Per-request work is limited to
+    filtering by date/usage and rendering one page.
+    """
+
+    SORTS = ('id', 'name', 'expiry', 'usage')
+    FILTERS = ('all', 'active', 'idle', 'expired', 'expiring', 'disabled')
+
+    def __init__(self, snapshot):
+        self.rows = []
+        self.names = []
+        self.trigram_index = {}
+        entries = list(zip(snapshot.keys, snapshot.expire_on))
+        entries.extend(zip(snapshot.disabled_keys, snapshot.disabled_expire_on))
+        for pos, (key, expire_on) in enumerate(entries):
+            expire_value = key.get('expire_date', '')
+            self.rows.append(MappingProxyType({
+                'id': key.get('id'),
+                'int_id': int_id(key),
+                'name': key.get('name', '') or '',
+                'cipher': key.get('cipher'),
+                'secret': key.get('secret', ''),
+                'secret_masked': mask_secret(key.get('secret', '')),
+                'expire_on': expire_on,
+                'expire_date': expire_on.strftime('%Y-%m-%d') if expire_on else (expire_value or ''),
+                'disabled_reason': key.get('disabled_reason', 'disabled') if pos >= len(snapshot.keys) else None,
+                'quota_bytes': parse_quota(key.get('quota_bytes')),
+            }))
+            name = (key.get('name', '') or '').lower()
+            self.names.append(name)
+            for gram in trigrams(name):
+                self.trigram_index.setdefault(gram, []).append(pos)
+        self._orders = {}
+
+    def search(self, query):
+        """Positions whose name contains query (case-insensitive), in key order"""
+        query = query.lower()
+        if len(query) < 3:
+            return [pos for pos, name in enumerate(self.names) if query in name]
+        postings = sorted((self.trigram_index.get(gram, ()) for gram in trigrams(query)), key=len)
+        if not postings[0]:
+            return []
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+        # Trigram hits are candidates; confirm the actual substring match
+        return sorted(pos for pos in candidates if query in self.names[pos])
+
+    def sort_key(self, sort, pos, totals):
+        row = self.rows[pos]
+        if sort == 'name':
+            return (self.names[pos], row['int_id'])
+        if sort == 'expiry':
+            expire_on = row['expire_on']
+            return (expire_on is None, expire_on.toordinal() if expire_on else 0, row['int_id'])
+        if sort == 'usage':
+            return (totals.get(str(row['id']), 0), row['int_id'])
+        return (row['int_id'],)
+
+    def order(self, sort, totals):
+        """Ascending [(sort_key, pos)]; cached per version except for usage"""
+        if sort == 'usage':
+            return sorted((self.sort_key(sort, pos, totals), pos) for pos in range(len(self.rows)))
+        if sort not in self._orders:
+            self._orders[sort] = sorted((self.sort_key(sort, pos, totals), pos) for pos in range(len(self.rows)))
+        return self._orders[sort]
+
+    def matches(self, pos, status_filter, stats, today):
+        if status_filter == 'all':
+            return True
+        if status_filter == 'disabled' or self.rows[pos]['disabled_reason']:
+            return status_filter == 'disabled' and self.rows[pos]['disabled_reason'] is not None
+        expire_on = self.rows[pos]['expire_on']
+        expired = expire_on is not None and expire_on < today
+        if status_filter == 'expired':
+            return expired
+        if status_filter == 'expiring':
+            return not expired and expire_on is not None and (expire_on - today).days <= EXPIRING_SOON_DAYS
+        active = stats.get(str(self.rows[pos]['id']), 0) > 0
+        return not expired and (active if status_filter == 'active' else not active)
+
+    def page(self, search='', status_filter='all', sort='id', descending=False, cursor=None,
+             page_size=PAGE_SIZE, stats=None, totals=None, today=None):
+        """One page of display rows; returns (rows, next_cursor, total_matches)"""
+        stats = stats or {}
+        totals = totals or {}
+        today = today or date.today()
+        month = usage_month(time.time())
+        order = self.order(sort, totals)
+        selected = set(self.search(search)) if search else None
+
+        # Keyset pagination: resume strictly after the cursor's sort key
+        remaining = order
+        if cursor is not None:
+            try:
+                split = bisect.bisect_left(order, (cursor,)) if descending else bisect.bisect_right(order, (cursor, float('inf')))
+                remaining = order[:split] if descending else order[split:]
+            except TypeError:
+                # Cursor from a different sort order; start from the top
+                pass
+        if descending:
+            remaining = reversed(remaining)
+
+        total = sum(1 for _, pos in order
+                    if (selected is None or pos in selected) and self.matches(pos, status_filter, stats, today))
+        rows, last_key = [], None
+        for sort_key, pos in remaining:
+            if selected is not None and pos not in selected:
+                continue
+            if not self.matches(pos, status_filter, stats, today):
+                continue
+            if len(rows) == page_size:
+                return rows, encode_cursor(last_key), total
+            row = dict(self.rows[pos])
+            expire_on = row['expire_on']
+            row['is_expired'] = expire_on is not None and expire_on < today
+            row['days_left'] = (expire_on - today).days if expire_on else None
+            row['month_bytes'] = usage_history.month_total(row['id'], month) if row['quota_bytes'] else None
+            rows.append(row)
+            last_key = sort_key
+        return rows, None, total
+
+def encode_cursor(sort_key):
+    return base64.urlsafe_b64encode(json.dumps(list(sort_key)).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Opaque cursor -> sort key tuple, or None if missing/invalid"""
+    if not cursor:
+        return None
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return tuple(value) if isinstance(value, list) else None
+    except (ValueError, TypeError):
+        return None
+
+def key_listing(snapshot):
+    return snapshot.derived('listing', KeyListing)
+
+# --- EXPIRY ---
+def expiry_heap(snapshot):
+    """Min-heap of (expire_on, id) over active keys, built once per config version"""
+    def build(snap):
+        heap = [(expire_on, int_id(key)) for key, expire_on in zip(snap.keys, snap.expire_on) if expire_on]
+        heapq.heapify(heap)
+        return heap
+    return snapshot.derived('expiry_heap', build)
+
+def due_from_heap(heap, today):
+    """Ids whose expiry is before today, walking only the due part of the heap"""
+    due, stack = [], [0] if heap else []
+    while stack:
+        i = stack.pop()
+        expire_on, user_id = heap[i]
+        if expire_on >= today:
+            # Heap order: nothing below this node is due either
+            continue
+        due.append(user_id)
+        stack.extend(child for child in (2 * i + 1, 2 * i + 2) if child < len(heap))
+    return due
+
+def disable_keys(txn, user_ids, reason):
+    """Move active keys into disabled_keys inside a config_transaction; returns moved ids"""
+    user_ids = set(user_ids)
+    keep, moved = [], []
+    disabled = txn.config.setdefault('disabled_keys', [])
+    stamp = datetime.now().isoformat(timespec='seconds')
+    for key in get_keys(txn.config):
+        if int_id(key) in user_ids:
+            key['disabled_reason'] = reason
+            key['disabled_at'] = stamp
+            disabled.append(key)
+            moved.append(int_id(key))
+        else:
+            keep.append(key)
+    set_keys(txn.config, keep)
+    return moved
+
+def delete_keys(txn, user_ids):
+    """Remove active keys inside a config_transaction; returns removed ids"""
+    user_ids = set(user_ids)
+    keys = get_keys(txn.config)
+    removed = [int_id(key) for key in keys if int_id(key) in user_ids]
+    set_keys(txn.config, [key for key in keys if int_id(key) not in user_ids])
+    return removed
+
+class ExpiryScheduler:
+    """Takes expired keys out of service, all due keys in one write and one reload.
+
+    A key is expired once its expire_date is before today, i.e. from local
+    midnight after that date. The thread sleeps until the earliest expiry in
+    the heap (or EXPIRY_CHECK_INTERVAL, to notice config edits), then
+    disables or deletes every due key per EXPIRED_KEY_ACTION.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+
+    def start(self):
+        with self._lock:
+            if EXPIRED_KEY_ACTION and (self._thread is None or not self._thread.is_alive()):
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='expiry-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def next_due_at(self, snapshot):
+        """Unix time the earliest active key expires, or None"""
+        heap = expiry_heap(snapshot)
+        if not heap:
+            return None
+        return datetime.combine(heap[0][0] + timedelta(days=1), datetime.min.time()).timestamp()
+
+    def run_once(self, today=None):
+        """Disable/delete all keys due today; returns the affected ids"""
+        today = today or date.today()
+        if not due_from_heap(expiry_heap(load_snapshot()), today):
+            return []
+        with config_transaction() as txn:
+            # Recompute under the lock: another worker may have done it already
+            due = due_from_heap(expiry_heap(txn.snapshot), today)
+            if EXPIRED_KEY_ACTION == 'delete':
+                affected = delete_keys(txn, due)
+            else:
+                affected = disable_keys(txn, due, 'expired')
+            if not affected:
+                txn.cancel()
+        if affected:
+            reload_queue.request(f"expiring {len(affected)} keys")
+            self.last_run = {'at': datetime.now().isoformat(timespec='seconds'), 'ids': affected,
+                             'action': EXPIRED_KEY_ACTION}
+        return affected
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = EXPIRY_CHECK_INTERVAL
+            try:
+                self.run_once()
+                due_at = self.next_due_at(load_snapshot())
+                if due_at is not None:
+                    wait = min(wait, max(due_at - time.time(), 0.5))
+            except Exception:
+                app.logger.exception("Expiry check failed")
+            self._stop.wait(wait)
+
+expiry_scheduler = ExpiryScheduler()
+
+# --- QUOTAS ---
+GB = 10 ** 9
+
+def format_quota_gb(value):
+    """quota_bytes -> GB string for the edit form ('' if unlimited)"""
+    quota = parse_quota(value)
+    return f"{quota / GB:g}" if quota else ''
+
+def parse_quota(value):
+    """quota_bytes from the config -> int bytes, or None for unlimited"""
+    try:
+        quota = int(value)
+    except (ValueError, TypeError):
+        return None
+    return quota if quota > 0 else None
+
+def key_quotas(snapshot):
+    """{key id str: monthly quota bytes} for active keys with a quota"""
+    def build(snap):
+        quotas = {}
+        for key in snap.keys:
+            quota = parse_quota(key.get('quota_bytes'))
+            if quota:
+                quotas[str(key.get('id'))] = quota
+        return quotas
+    return snapshot.derived('quotas', build)
+
+class QuotaEnforcer:
+    """Suspends keys that exceed their monthly quota_bytes.
+
+    Runs on each scrape with that scrape's per-key deltas, so only keys that
+    actually moved data are compared against their limit, using the
+    running monthly totals UsageHistory maintains. Every key over quota in
+    the same scrape is disabled in one config write and one reload. Keys
+    suspended for quota in an earlier month (by their disabled_at) are
+    re-enabled the same way on the first scrape of a month, including the
+    first one after a restart.
+    """
+
+    def __init__(self):
+        # Month whose stale suspensions have been lifted already
+        self.month = None
+        self.last_run = None
+
+    def check(self, deltas, at):
+        month = usage_month(at)
+        if month != self.month:
+            self.restore_all(month)
+            self.month = month
+
+        quotas = key_quotas(load_snapshot())
+        over = [key_id for key_id in deltas
+                if key_id in quotas and usage_history.month_total(key_id, month) >= quotas[key_id]]
+        if not over:
+            return []
+        with config_transaction() as txn:
+            # Recheck under the lock against the latest quotas
+            quotas = key_quotas(txn.snapshot)
+            due = [int(key_id) for key_id in over
+                   if key_id in quotas and usage_history.month_total(key_id, month) >= quotas[key_id]]
+            suspended = disable_keys(txn, due, 'quota')
+            if not suspended:
+                txn.cancel()
+        if suspended:
+            reload_queue.request(f"suspending {len(suspended)} keys over quota")
+            self.last_run = {'at': datetime.now().isoformat(timespec='seconds'), 'suspended': suspended}
+        return suspended
+
+    @staticmethod
+    def suspended_month(key):
+        """usage_month() a key was suspended in, from its local disabled_at; None if unknown"""
+        try:
+            return usage_month(datetime.fromisoformat(key['disabled_at']).timestamp())
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def restore_all(self, month):
+        """Re-enable keys suspended for quota before month; one write, one reload"""
+        today = date.today()
+        with config_transaction() as txn:
+            disabled = get_disabled_keys(txn.config)
+            restored = [key for key, expire_on in zip(disabled, txn.snapshot.disabled_expire_on)
+                        if key.get('disabled_reason') == 'quota' and not (expire_on and expire_on < today)
+                        and (self.suspended_month(key) or 0) < month]
+            if not restored:
+                txn.cancel()
+            else:
+                restored_ids = {id(key) for key in restored}
+                txn.config['disabled_keys'] = [key for key in disabled if id(key) not in restored_ids]
+                for key in restored:
+                    key.pop('disabled_reason', None)
+                    key.pop('disabled_at', None)
+                keys = get_keys(txn.config)
+                keys.extend(restored)
+                set_keys(txn.config, keys)
+        if restored:
+            reload_queue.request(f"restoring {len(restored)} keys for the new quota month")
+        return [int_id(key) for key in restored]
+
+quota_enforcer = QuotaEnforcer()
+
+def next_key_id(keys):
+    """Smallest id greater than every existing id (one pass over keys)"""
+    try:
+        return max((int(k.get('id', 0)) for k in keys), default=0) + 1
+    except (ValueError, TypeError):
+        return len(keys) + 1
+
+def parse_bulk_users(text):
+    """Parse a CSV (name,cipher,expire_date) or JSON list of user specs"""
+    text = text.strip()
+    if not text:
+        return []
+    if text[0] in '[{':
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        if isinstance(rows, dict):
+            rows = rows.get('users', [rows])
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("JSON must be a list of objects")
+    else:
+        reader = csv.reader(io.StringIO(text))
+        header = [h.strip().lower() for h in next(reader, [])]
+        if 'name' not in header and 'cipher' not in header and 'expire_date' not in header:
+            # Headerless CSV: columns are name,cipher,expire_date
+            rows = [dict(zip(('name', 'cipher', 'expire_date'), header))]
+            header = ['name', 'cipher', 'expire_date']
+        else:
+            rows = []
+        rows.extend(dict(zip(header, (v.strip() for v in row))) for row in reader if any(row))
+
+    users = []
+    for line, row in enumerate(rows, start=1):
+        cipher = str(row.get('cipher') or DEFAULT_CIPHER).strip()
+        if cipher not in CIPHERS:
+            raise ValueError(f"Row {line}: unsupported cipher '{cipher}'")
+        expire_date = str(row.get('expire_date') or '').strip()
+        if expire_date:
+            try:
+                datetime.strptime(expire_date, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"Row {line}: expire_date must be YYYY-MM-DD, got '{expire_date}'")
+        users.append({'name': str(row.get('name') or '').strip(), 'cipher': cipher, 'expire_date': expire_date})
+    return users
+
+def render_bulk_document(created, api_base_url, output, snapshot):
+    """Render created users as one downloadable (body, mimetype, extension)"""
+    records = []
+    for key in created:
+        record = {
+            'id': key['id'],
+            'name': key.get('name', ''),
+            'cipher': key['cipher'],
+            'secret': key['secret'],
+            'expire_date': key.get('expire_date', ''),
+            'api_url': f"{api_base_url}/api?key={key['secret']}",
+        }
+        if output != 'csv':
+            record['client_config'] = client_config(key, shard_paths(snapshot, key))
+        records.append(record)
+
+    if output == 'json':
+        return json.dumps({'users': records}, indent=2), 'application/json', 'json'
+    if output == 'csv':
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=['id', 'name', 'cipher', 'secret', 'expire_date', 'api_url'])
+        writer.writeheader()
+        writer.writerows(records)
+        return buf.getvalue(), 'text/csv', 'csv'
+    return yaml_dump({'users': records}), 'text/yaml', 'yaml'
+
+def listing_view_args(args):
+    """Validated filter/sort/paging options for KeyListing.page()"""
+    sort = args.get('sort', 'id')
+    status_filter = args.get('filter', 'all')
+    try:
+        page_size = min(max(int(args.get('page_size', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except (ValueError, TypeError):
+        page_size = PAGE_SIZE
+    return {
+        'status_filter': status_filter if status_filter in KeyListing.FILTERS else 'all',
+        'sort': sort if sort in KeyListing.SORTS else 'id',
+        'descending': args.get('order') == 'desc',
+        'cursor': decode_cursor(args.get('cursor')),
+        'page_size': page_size,
+    }
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
+@app.after_request
+def compress_response(response):
+    """gzip HTML/JSON/YAML/CSV bodies when the client accepts it and it helps"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in GZIP_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE or not accepts_gzip():
+        return response
+    compressed = gzip.compress(body, compresslevel=6)
+    if len(compressed) >= len(body):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# --- ROUTES ---
+_background_started = False
+
+@app.before_request
+def start_background_workers():
+    """Start background threads lazily, in the process that serves requests"""
+    if not _background_started:
+        start_background_threads()
+
+def dashboard_page(args, snapshot=None):
+    """Listing page and usage stats shared by index() and dashboard_data()"""
+    listing = key_listing(snapshot or load_snapshot())
+
+    # Get search, filter, sort and paging options from URL parameters
+    search_query = args.get('search', '').strip()
+    view = listing_view_args(args)
+
+    # Get metrics data usage for each user from the latest snapshot
+    metrics = metrics_scraper.snapshot
+    stats = metrics.usage
+    totals = usage_history.totals()
+
+    keys, next_cursor, total = listing.page(search=search_query, stats=stats, totals=totals, **view)
+    return {
+        'keys': keys, 'stats': stats, 'totals': totals, 'metrics': metrics, 'search_query': search_query,
+        'view': view, 'total': total, 'next_cursor': next_cursor, 'key_count': len(listing.rows),
+    }
+
+def reload_status():
+    """Pending/applied state of the reload queue for the dashboard"""
+    state = reload_queue.state()
+    last = state['last_applied']
+    if state['pending'] or state['applying']:
+        count = state['pending'] + state['applying']
+        text = f"⏳ {count} change{'s' if count != 1 else ''} waiting to be applied to the server"
+        if state['applying']:
+            text += " (reloading now)"
+        return {'state': 'pending', 'text': text}
+    if last is None:
+        return {'state': 'idle', 'text': ''}
+    event = last['event']
+    if not event['ok'] or event.get('fleet_error'):
+        return {'state': 'error', 'text': f"⚠️ Applying changes at {last['at']} failed: "
+                                          f"{event.get('error') or ''} {event.get('fleet_error') or ''}".strip()}
+    text = f"✅ {last['changes']} change{'s' if last['changes'] != 1 else ''} applied at {last['at']}"
+    if event['action'] == 'unchanged':
+        return {'state': 'applied', 'text': text + " (admin fields only, no server reload needed)"}
+    text += f" (server {event['action']} in {event['duration']:.2f}s"
+    if event['interrupted_connections']:
+        text += f", {event['interrupted_connections']} connections interrupted"
+    return {'state': 'applied', 'text': text + ")"}
+
+def shard_summary(snapshot):
+    """[{'paths': (tcp, udp), 'key_count': n}, ...] per shard for the dashboard"""
+    paths, _ = shard_layout(snapshot)
+    services = snapshot.config.get('services') or ()
+    return [{'paths': service_paths, 'key_count': len(service.get('keys') or ())}
+            for service_paths, service in zip(paths, services)]
+
+def fleet_status(metrics):
+    """Registered nodes with their latest scrape and config push results"""
+    return [{'name': node.name, 'url': node.url, 'scrape': metrics.nodes.get(node.name),
+             'push': fleet.last_push.get(node.name)} for node in node_registry.nodes()]
+
+@app.route('/assets/<filename>')
+def static_asset(filename):
+    """Shared CSS/JS; content-hashed names make them safe to cache forever"""
+    asset = ASSETS_BY_URL.get(filename)
+    if asset is None:
+        return "Not found", 404
+    gzipped = accepts_gzip()
+    response = app.response_class(asset.gzipped if gzipped else asset.body, mimetype=asset.mimetype)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/')
+def index():
+    try:
+        page = dashboard_page(request.args)
+        metrics = page.pop('metrics')
+
+        # Determine API base URL
+        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
+        data_url = url_for('dashboard_data', **request.args)
+
+        return render_template(TEMPLATES['index'], api_base_url=api_base_url, bulk_max_users=BULK_MAX_USERS,
+                                      metrics_age=metrics.age, metrics_error=metrics.error, data_url=data_url,
+                                      fleet_nodes=fleet_status(metrics), local_node=LOCAL_NODE, reload=reload_status(),
+                                      shards=shard_summary(load_snapshot()), max_shards=MAX_SHARDS,
+                                      poll_interval=DASHBOARD_POLL_INTERVAL, sorts=KeyListing.SORTS,
+                                      filters=KeyListing.FILTERS, **page)
+    except Exception as e:
+        flash(f"Error loading config: {e}", "error")
+        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
+        return render_template(TEMPLATES['index'], keys=[], stats={}, totals={}, search_query='', api_base_url=api_base_url,
+                                      bulk_max_users=BULK_MAX_USERS, view=listing_view_args({}), total=0, next_cursor=None,
+                                      key_count=0, sorts=KeyListing.SORTS, filters=KeyListing.FILTERS,
+                                      fleet_nodes=[], local_node=LOCAL_NODE, reload=reload_status(),
+                                      shards=[], max_shards=MAX_SHARDS,
+                                      data_url=url_for('dashboard_data'), poll_interval=DASHBOARD_POLL_INTERVAL)
+
+@app.route('/dashboard/data')
+def dashboard_data():
+    """JSON key list and usage for the dashboard's in-place polling.
+
+    The ETag covers the config file version, the metrics snapshot, today's
+    date (expiry status) and the query, so an unchanged poll is a 304
+    without touching the listing at all.
+    """
+    try:
+        snapshot = load_snapshot()
+        metrics = metrics_scraper.snapshot
+        etag = hashlib.sha1(repr((snapshot.etag, metrics.version, metrics.scraped_at, metrics.error, reload_queue.version,
+                                  date.today().toordinal(), sorted(request.args.items(multi=True)))).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        page = dashboard_page(request.args, snapshot)
+        stats, totals = page['stats'], page['totals']
+        keys = []
+        for key in page['keys']:
+            live = stats.get(str(key['id']), 0)
+            keys.append({
+                'id': key['id'],
+                'name': key['name'],
+                'cipher': key['cipher'],
+                'secret_masked': key['secret_masked'],
+                'expire_date': key['expire_date'],
+                'is_expired': key['is_expired'],
+                'days_left': key['days_left'],
+                'usage_bytes': totals.get(str(key['id']), 0),
+                'live_bytes': live,
+                'disabled_reason': key['disabled_reason'],
+                'quota_bytes': key['quota_bytes'],
+                'month_bytes': key['month_bytes'],
+                'status': ('disabled' if key['disabled_reason'] else
+                           'expired' if key['is_expired'] else 'active' if live > 0 else 'idle'),
+            })
+        response = jsonify({
+            'keys': keys,
+            'total': page['total'],
+            'key_count': page['key_count'],
+            'next_cursor': page['next_cursor'],
+            'metrics': {'age': metrics.age, 'error': metrics.error},
+            'reload': reload_status(),
+        })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({'error': f'Error loading dashboard data: {e}'}), 500
+
+@app.route('/dashboard/stream')
+def dashboard_stream():
+    """Server-Sent Events with live per-key bytes/sec and the top talkers"""
+    if not _stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many live streams open; the dashboard falls back to polling'}), 503
+    response = app.response_class(rate_tracker.stream(), mimetype='text/event-stream')
+    # Released when the server closes the response, even if it never started
+    response.call_on_close(_stream_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/add', methods=['POST'])
+def add_user():
+    try:
+        # Get expiration date from form
+        expire_date = request.form.get('expire_date', '').strip()
+
+        with config_transaction() as txn:
+            keys = get_keys(txn.config)
+
+            # Calculate new ID (disabled keys keep theirs)
+            new_id = next_key_id(all_keys(txn.config))
+
+            new_user = {
+                'id': new_id,
+                'name': '',  # Optional name field for admin display
+                'cipher': 'chacha20-ietf-poly1305',
+                'secret': generate_secret(),
+                'expire_date': expire_date if expire_date else None
+            }
+
+            # Remove None values to keep config clean
+            if new_user['expire_date'] is None:
+                new_user.pop('expire_date', None)
+
+            keys.append(new_user)
+            set_keys(txn.config, keys)
+        flash(f"User {new_id} added{queue_server_reload(f'adding user {new_id}')}")
+    except Exception as e:
+        flash(f"Error adding user: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/bulk', methods=['POST'])
+def bulk_add_users():
+    """Create many users with one config write and one server reload"""
+    try:
+        output = request.form.get('output', 'yaml')
+        if output not in ('yaml', 'json', 'csv'):
+            output = 'yaml'
+
+        text = request.form.get('data', '')
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            text = upload.read().decode('utf-8-sig')
+        specs = parse_bulk_users(text)
+
+        if not specs:
+            count = request.form.get('count', '').strip()
+            count = int(count) if count.isdigit() else 0
+            expire_date = request.form.get('expire_date', '').strip()
+            if expire_date:
+                try:
+                    datetime.strptime(expire_date, '%Y-%m-%d')
+                except ValueError:
+                    flash(f"Bulk add: expire_date must be YYYY-MM-DD, got '{expire_date}'", "error")
+                    return redirect(url_for('index'))
+            specs = [{'name': '', 'cipher': DEFAULT_CIPHER, 'expire_date': expire_date}] * count
+        if not specs:
+            flash("Bulk add: give a number of users or a CSV/JSON list", "error")
+            return redirect(url_for('index'))
+        if len(specs) > BULK_MAX_USERS:
+            flash(f"Bulk add: at most {BULK_MAX_USERS} users per request", "error")
+            return redirect(url_for('index'))
+
+        with config_transaction() as txn:
+            keys = get_keys(txn.config)
+
+            # Allocate ids and secrets in one pass
+            new_id = next_key_id(all_keys(txn.config))
+            created = []
+            for offset, spec in enumerate(specs):
+                new_user = {
+                    'id': new_id + offset,
+                    'name': spec['name'],
+                    'cipher': spec['cipher'],
+                    'secret': generate_secret(),
+                }
+                if spec['expire_date']:
+                    new_user['expire_date'] = spec['expire_date']
+                created.append(new_user)
+
+            keys.extend(created)
+            set_keys(txn.config, keys)
+        suffix = queue_server_reload(f"adding {len(created)} users")
+        flash(f"{len(created)} users added (ids {created[0]['id']}-{created[-1]['id']}){suffix}")
+        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
+        body, mimetype, extension = render_bulk_document(created, api_base_url, output, load_snapshot())
+        filename = f"users-{created[0]['id']}-{created[-1]['id']}.{extension}"
+        return body, 200, {
+            'Content-Type': f'{mimetype}; charset=utf-8',
+            'Content-Disposition': f'attachment; filename="{filename}"',
+        }
+    except Exception as e:
+        flash(f"Error adding users: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/edit/<int:user_id>')
+def edit_user(user_id):
+    try:
+        snapshot = load_snapshot()
+        target_key = snapshot.find(user_id)
+
+        if not target_key:
+            flash(f"User {user_id} not found", "error")
+            return redirect(url_for('index'))
+
+        new_secret = generate_secret()
+        expire_date = target_key.get('expire_date', '')
+        return render_template(TEMPLATES['edit'],
+                                    user_id=user_id,
+                                    name=target_key.get('name', ''),
+                                    cipher=target_key.get('cipher', 'chacha20-ietf-poly1305'),
+                                    secret=target_key.get('secret', ''),
+                                    expire_date=expire_date,
+                                    quota_gb=format_quota_gb(target_key.get('quota_bytes')),
+                                    new_secret=new_secret,
+                                    version=snapshot.generation)
+    except Exception as e:
+        flash(f"Error loading user: {e}", "error")
+        return redirect(url_for('index'))
+
+@app.route('/update/<int:user_id>', methods=['POST'])
+def update_user(user_id):
+    try:
+        # Update name, cipher, secret, and expiration date
+        name = request.form.get('name', '').strip()
+        cipher = request.form.get('cipher', 'chacha20-ietf-poly1305')
+        secret = request.form.get('secret', '').strip()
+        expire_date = request.form.get('expire_date', '').strip()
+        version = request.form.get('version', '')
+        try:
+            quota_bytes = int(float(request.form.get('quota_gb', '').strip() or 0) * GB)
+        except ValueError:
+            flash("Quota must be a number of GB", "error")
+            return redirect(url_for('edit_user', user_id=user_id))
+
+        if not secret:
+            flash("Secret cannot be empty", "error")
+            return redirect(url_for('edit_user', user_id=user_id))
+
+        with config_transaction(expected_version=int(version) if version.isdigit() else None) as txn:
+            where, position = txn.snapshot.locate(user_id)
+            if position is None:
+                txn.cancel()
+                flash(f"User {user_id} not found", "error")
+                return redirect(url_for('index'))
+
+            keys = key_list(txn.config, where)
+            target_key = keys[position]
+            target_key['name'] = name
+            target_key['cipher'] = cipher
+            target_key['secret'] = secret
+
+            # Update expiration date
+            if expire_date:
+                target_key['expire_date'] = expire_date
+            else:
+                # Remove expiration date if empty
+                target_key.pop('expire_date', None)
+
+            # Update monthly quota
+            if quota_bytes > 0:
+                target_key['quota_bytes'] = quota_bytes
+            else:
+                target_key.pop('quota_bytes', None)
+
+        # Disabled keys are not served, so editing them needs no reload
+        suffix = queue_server_reload(f"updating user {user_id}") if where == 'keys' else "!"
+        flash(f"User {user_id} updated{suffix}")
+    except ConfigConflictError as e:
+        flash(f"User {user_id} not saved: {e}", "error")
+        return redirect(url_for('edit_user', user_id=user_id))
+    except Exception as e:
+        flash(f"Error updating user: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/enable/<int:user_id>', methods=['POST'])
+def enable_user(user_id):
+    """Put a disabled key back into service"""
+    try:
+        with config_transaction() as txn:
+            where, position = txn.snapshot.locate(user_id)
+            expire_on = txn.snapshot.disabled_expire_on[position] if where == 'disabled_keys' else None
+            if where != 'disabled_keys':
+                txn.cancel()
+                flash(f"User {user_id} is not disabled", "error")
+                return redirect(url_for('index'))
+            if expire_on is not None and expire_on < date.today():
+                txn.cancel()
+                flash(f"User {user_id} expired on {expire_on}; extend the expire date before enabling", "error")
+                return redirect(url_for('edit_user', user_id=user_id))
+
+            key = txn.config['disabled_keys'][position]
+            quota = parse_quota(key.get('quota_bytes'))
+            if quota and usage_history.month_total(user_id, usage_month(time.time())) >= quota:
+                txn.cancel()
+                flash(f"User {user_id} is over its monthly quota; raise the quota before enabling", "error")
+                return redirect(url_for('edit_user', user_id=user_id))
+
+            txn.config['disabled_keys'].pop(position)
+            key.pop('disabled_reason', None)
+            key.pop('disabled_at', None)
+            keys = get_keys(txn.config)
+            keys.append(key)
+            set_keys(txn.config, keys)
+        flash(f"User {user_id} enabled{queue_server_reload(f'enabling user {user_id}')}")
+    except Exception as e:
+        flash(f"Error enabling user: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/delete/<int:user_id>', methods=['POST'])
+def delete_user(user_id):
+    try:
+        with config_transaction() as txn:
+            where, position = txn.snapshot.locate(user_id)
+            if position is None:
+                txn.cancel()
+            else:
+                keys = key_list(txn.config, where)
+                keys.pop(position)
+                if where == 'keys':
+                    set_keys(txn.config, keys)
+
+        if position is None:
+            flash(f"User {user_id} not found", "error")
+        else:
+            suffix = queue_server_reload(f"deleting user {user_id}") if where == 'keys' else "!"
+            flash(f"User {user_id} deleted{suffix}")
+    except Exception as e:
+        flash(f"Error deleting user: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/client/<int:user_id>')
+def get_client_config(user_id):
+    try:
+        snapshot = load_snapshot()
+        target_key = snapshot.find(user_id)
+
+        if not target_key:
+            return "User not found", 404
+
+        # Generate the Client YAML structure
+        yaml_text = generate_client_yaml(target_key, snapshot)
+        secret = target_key.get('secret', '')
+        # Determine API base URL
+        api_base_url = API_DOMAIN if API_DOMAIN else request.url_root.rstrip('/')
+        return render_template(TEMPLATES['client'], user_id=user_id, yaml_config=yaml_text, secret=secret, api_base_url=api_base_url)
+    except Exception as e:
+        return f"Error generating client config: {e}", 500
+
+@app.route('/usage/<int:user_id>')
+def usage_history_series(user_id):
+    """Persistent usage for one key: total plus hourly or daily series"""
+    resolution = request.args.get('resolution', 'hourly')
+    if resolution not in ('hourly', 'daily'):
+        return jsonify({'error': 'resolution must be hourly or daily'}), 400
+    return jsonify({
+        'id': user_id,
+        'total_bytes': usage_history.totals().get(str(user_id), 0),
+        'resolution': resolution,
+        'series': [{'start': datetime.fromtimestamp(bucket, timezone.utc).isoformat(), 'bytes': value}
+                   for bucket, value in usage_history.series(user_id, resolution)],
+    })
+
+@app.route('/server/events')
+def server_events():
+    """Recent reload/restart events with durations and interrupted connections"""
+    return jsonify({'events': list(supervisor.events), 'reload_queue': reload_queue.state(),
+                    'last_expiry_run': expiry_scheduler.last_run, 'last_quota_run': quota_enforcer.last_run})
+
+@app.route('/fleet')
+def fleet_overview():
+    """Per-node scrape and push results and the /api endpoint pool as JSON"""
+    return jsonify({'local_node': LOCAL_NODE, 'nodes': fleet_status(metrics_scraper.snapshot),
+                    'endpoints': endpoint_pool.status()})
+
+@app.route('/fleet/nodes', methods=['POST'])
+def add_node():
+    name = request.form.get('name', '').strip()
+    try:
+        node_registry.add(name, request.form.get('url', '').strip(), request.form.get('token', '').strip())
+    except (ValueError, IOError) as e:
+        flash(f"Error adding node: {e}", "error")
+        return redirect(url_for('index'))
+    # Bring the new node up to date right away
+    failed = failed_nodes(push_to_fleet())
+    if failed:
+        flash(f"Node {name} added, but config push failed: {failed}", "warning")
+    else:
+        flash(f"Node {name} added and config pushed!", "success")
+    return redirect(url_for('index'))
+
+@app.route('/fleet/nodes/<name>/delete', methods=['POST'])
+def remove_node(name):
+    try:
+        node_registry.remove(name)
+        flash(f"Node {name} removed (its server keeps running with the last pushed config)", "success")
+    except KeyError:
+        flash(f"Node {name} not found!", "error")
+    except IOError as e:
+        flash(f"Error removing node: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/fleet/push', methods=['POST'])
+def push_fleet():
+    """Resend the current config to every node, even ones that report it as current"""
+    try:
+        results = push_to_fleet(force=True)
+    except IOError as e:
+        flash(f"Error reading config: {e}", "error")
+        return redirect(url_for('index'))
+    failed = failed_nodes(results)
+    if failed:
+        flash(f"Config pushed to {len(results)} node(s); failed on {failed}", "warning")
+    else:
+        flash(f"Config pushed to {len(results)} node(s)!", "success")
+    return redirect(url_for('index'))
+
+def key_gauges():
+    snapshot = load_snapshot()
+    return {('active',): len(snapshot.keys), ('disabled',): len(snapshot.disabled_keys)}
+
+def expired_key_gauges():
+    snapshot = load_snapshot()
+    today = date.today()
+    return {('active',): len(due_from_heap(expiry_heap(snapshot), today)),
+            ('disabled',): sum(1 for expire_on in snapshot.disabled_expire_on if expire_on and expire_on < today)}
+
+admin_metrics.register(Gauge('admin_keys', "Access keys in the config", key_gauges, ('state',)))
+admin_metrics.register(Gauge('admin_expired_keys', "Keys past their expire_date", expired_key_gauges, ('state',)))
+admin_metrics.register(Gauge('admin_config_generation', "Version counter in the config header",
+                             lambda: {(): load_snapshot().generation}))
+admin_metrics.register(Gauge('admin_metrics_age_seconds', "Seconds since the last successful metrics scrape",
+                             lambda: {} if metrics_scraper.snapshot.age is None else {(): metrics_scraper.snapshot.age}))
+
+@app.route('/shards', methods=['POST'])
+def rebalance():
+    """Spread active keys over a new number of shards (services)"""
+    try:
+        count = int(request.form.get('count', ''))
+        with config_transaction() as txn:
+            previous = shard_count(txn.config)
+            moved = rebalance_shards(txn.config, count)
+            if count == previous and not moved:
+                txn.cancel()
+                flash(f"Keys are already balanced over {count} shard{'s' if count != 1 else ''}")
+                return redirect(url_for('index'))
+        suffix = queue_server_reload(f"re-sharding from {previous} to {count} shards")
+        # Dynamic keys (/api) pick up the new paths on the client's next fetch
+        flash(f"Keys spread over {count} shard{'s' if count != 1 else ''}, {moved} moved{suffix}")
+    except Exception as e:
+        flash(f"Error rebalancing shards: {e}", "error")
+    return redirect(url_for('index'))
+
+@app.route('/admin-metrics')
+def admin_metrics_page():
+    """The panel's own metrics in Prometheus text format"""
+    return app.response_class(admin_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/profiles')
+def list_profiles():
+    """Recent request profiles, newest first"""
+    return jsonify({'enabled_for': sorted(PROFILE_ENDPOINTS), 'keep': PROFILE_KEEP, 'profiles': [
+        dict(entry, download=url_for('download_profile', profile_id=entry['id']),
+             report=url_for('download_profile', profile_id=entry['id'], format='text'))
+        for entry in profiles.entries()]})
+
+@app.route('/profiles/<int:profile_id>')
+def download_profile(profile_id):
+    """One profile: pstats file (default, for pstats/snakeviz) or ?format=text report"""
+    entry, profiler = profiles.get(profile_id)
+    if entry is None:
+        return jsonify({'error': f"Profile {profile_id} not found (only the last {PROFILE_KEEP} are kept)"}), 404
+    if request.args.get('format') == 'text':
+        buf = io.StringIO()
+        print(f"{entry['method']} {entry['path']} -> {entry['status']} in {entry['duration']}s at {entry['at']}\n",
+              file=buf)
+        pstats.Stats(profiler, stream=buf).sort_stats('cumulative').print_stats(PROFILE_TEXT_LINES)
+        return app.response_class(buf.getvalue(), content_type='text/plain; charset=utf-8')
+    response = app.response_class(marshal.dumps(profiler.stats), content_type='application/octet-stream')
+    response.headers['Content-Disposition'] = f'attachment; filename=profile-{profile_id}.pstats'
+    return response
+
+@app.route('/api')
+def api_get_client_key():
+    """API endpoint to retrieve client key by password/secret only.
+
+    ?format= selects yaml (default, Outline dynamic key), json or ss (URL).
+    Callers are rate limited per IP, and recently failed secrets are
+    answered from memory, so guessing secrets stays slow and cheap. The
+    config points at the endpoint EndpointPool picks for the key.
+    """
+    try:
+        allowed, retry_after = api_limiter.allow(client_ip())
+        if not allowed:
+            api_rejections.inc('rate_limited')
+            response = jsonify({'error': 'Too many requests. Try again later.'})
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response, 429
+
+        key_param = request.args.get('key', '').strip()
+
+        if not key_param:
+            return jsonify({'error': 'Missing key parameter. Use /api?key=password'}), 400
+
+        if api_misses.contains(key_param):
+            api_rejections.inc('negative_cached')
+            return jsonify({'error': 'User not found. Invalid password/secret.'}), 404
+
+        # Only match by secret/password (more secure); O(1) hashed lookup
+        # with a constant-time final comparison
+        snapshot = load_snapshot()
+        target_key = snapshot.index.find_by_secret(key_param)
+
+        if not target_key:
+            api_misses.add(key_param, snapshot)
+            return jsonify({'error': 'User not found. Invalid password/secret.'}), 404
+
+        fmt = request.args.get('format', 'yaml')
+        if fmt not in CLIENT_FORMATS:
+            return jsonify({'error': f"Unknown format. Use one of: {', '.join(CLIENT_FORMATS)}"}), 400
+
+        # Rendered once per key version; clients revalidate with If-None-Match.
+        # YAML (the default) can be used directly by Outline clients.
+        domain = endpoint_pool.choose(int_id(target_key))
+        body, etag = rendered_configs.get(target_key, fmt, shard_paths(snapshot, target_key), domain)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(body, content_type=CLIENT_FORMATS[fmt][1])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'public, max-age={API_CACHE_MAX_AGE}, must-revalidate'
+        return response
+
+    except Exception as e:
+        return jsonify({'error': f'Error retrieving client key: {str(e)}'}), 500
+
+# --- SERVING ---
+class PathAllowlist:
+    """WSGI wrapper that only lets through the given path prefixes (404 otherwise).
+
+    Requests it lets through are marked public (PUBLIC_ENVIRON_KEY), which
+    switches off admin-only query flags such as ?profile=.
+    """
+
+    def __init__(self, wsgi_app, prefixes):
+        self.wsgi_app = wsgi_app
+        self.prefixes = tuple(prefixes)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if any(path == prefix or path.startswith(prefix + '/') for prefix in self.prefixes):
+            environ[PUBLIC_ENVIRON_KEY] = True
+            return self.wsgi_app(environ, start_response)
+        start_response('404 Not Found', [('Content-Type', 'text/plain; charset=utf-8')])
+        return [b'Not found']
+
+# Public listener: only the dynamic-key endpoint. Also usable with any WSGI
+# server, e.g. gunicorn -w 4 --threads 16 -b 127.0.0.1:5001 'admin:api_app'
+api_app = PathAllowlist(app, ('/api',))
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug server that hands each connection to a bounded thread pool.
+
+    The accept loop blocks once every worker thread is busy, leaving further
+    connections in the listen backlog instead of spawning unbounded threads.
+    shutdown() stops accepting; drain() then waits for in-flight requests.
+    """
+
+    def __init__(self, host, port, wsgi_app, threads, name):
+        super().__init__(host, port, wsgi_app)
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self.pool.submit(self._handle, request, client_address)
+        except RuntimeError:
+            # Pool already shut down
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def drain(self, timeout):
+        """Wait up to timeout seconds for in-flight requests; True if all finished"""
+        waiter = threading.Thread(target=self.pool.shutdown, kwargs={'wait': True}, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        return not waiter.is_alive()
+
+def start_background_threads():
+    global _background_started
+    _background_started = True
+    metrics_scraper.start()
+    expiry_scheduler.start()
+
+def stop_background_threads():
+    metrics_scraper.stop()
+    expiry_scheduler.stop()
+    # Saved changes must still reach the server before we exit
+    if not reload_queue.stop(SHUTDOWN_TIMEOUT):
+        app.logger.warning("Exiting with config changes not yet applied to the server")
+
+def serve(admin_port=ADMIN_PORT, api_port=API_PORT, admin_threads=ADMIN_THREADS, api_threads=API_THREADS):
+    """Run the admin UI and the public /api listener until SIGTERM/SIGINT.
+
+    Concurrency model: one process, one accept thread per listener, and a
+    fixed pool of worker threads per listener (admin_threads/api_threads).
+    Background work (metrics scrape, expiry, reloads) runs on its own
+    threads and never inside a request. All request handlers only read
+    immutable snapshots or go through config_transaction(), so they are
+    safe to run concurrently; for more cores run several processes of
+    'admin:app' / 'admin:api_app' under gunicorn instead. Pass api_port=0
+    to serve /api only from the admin listener.
+    """
+    servers = [PooledWSGIServer(ADMIN_HOST, admin_port, app, admin_threads, 'admin')]
+    if api_port:
+        servers.append(PooledWSGIServer(API_HOST, api_port, api_app, api_threads, 'api'))
+
+    stopping = threading.Event()
+    def request_stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    start_background_threads()
+    threads = [threading.Thread(target=server.serve_forever, name=f"{server.name}-accept", daemon=True)
+               for server in servers]
+    for thread, server in zip(threads, servers):
+        thread.start()
+        app.logger.warning("Serving %s on http://%s:%s with %d threads", server.name,
+                           server.server_address[0], server.server_address[1], server.pool._max_workers)
+
+    stopping.wait()
+    # Graceful shutdown: stop accepting, let in-flight requests finish, stop background work
+    app.logger.warning("Shutting down (waiting up to %ss for in-flight requests)", SHUTDOWN_TIMEOUT)
+    for server in servers:
+        server.shutdown()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for server in servers:
+        if not server.drain(max(deadline - time.monotonic(), 0)):
+            app.logger.warning("%s: requests still running after %ss", server.name, SHUTDOWN_TIMEOUT)
+    stop_background_threads()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Outline User Manager")
+    parser.add_argument('--dev', action='store_true', help="run the Flask development server on ADMIN_PORT instead")
+    parser.add_argument('--admin-port', type=int, default=ADMIN_PORT)
+    parser.add_argument('--api-port', type=int, default=API_PORT, help="0 serves /api from the admin listener only")
+    parser.add_argument('--admin-threads', type=int, default=ADMIN_THREADS)
+    parser.add_argument('--api-threads', type=int, default=API_THREADS)
+    parser.add_argument('--import-config', metavar='PATH', nargs='?', const=CONFIG_FILE,
+                        help="replace the users in USERS_DB_FILE with those of a config.yaml and exit")
+    args = parser.parse_args(argv)
+
+    if args.import_config:
+        if not isinstance(user_store, SqliteUserStore):
+            parser.error("--import-config needs USER_STORE = 'sqlite'")
+        # Same lock as config_transaction(), so running workers are not mid-write
+        with open(f"{CONFIG_FILE}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            count = user_store.import_config(args.import_config)
+        user_store.render_server_config()
+        print(f"Imported {count} keys from {args.import_config} into {USERS_DB_FILE}; "
+              f"{CONFIG_FILE} now holds server fields only (the first one imported is kept as {CONFIG_FILE}.pre-import)")
+        return
+
+    if args.dev:
+        # WARNING: Ensure you have a firewall for production use
+        app.run(host=ADMIN_HOST, port=args.admin_port)
+        return
+    serve(args.admin_port, args.api_port, args.admin_threads, args.api_threads)
 
 if __name__ == '__main__':
-    # Running on port 5000, accessible from anywhere
-    # WARNING: Ensure you have a firewall for production use
-    app.run(host='0.0.0.0', port=5000)
+    main()
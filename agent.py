@@ -0,0 +1,247 @@
+import os
+import argparse
+import hmac
+import re
+import secrets
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import yaml
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify
+from werkzeug.serving import BaseWSGIServer
+
+# --- CONFIGURATION ---
+# Per-node agent for fleet mode: runs next to outline-ss-server on every
+# node and lets the admin panel push config and scrape metrics over HTTP.
+CONFIG_FILE = 'config.yaml'
+BINARY_PATH = './outline-ss-server'
+METRICS_PORT = 9091
+METRICS_URL = f"http://127.0.0.1:{METRICS_PORT}/metrics"
+SERVER_LOG_FILE = 'outline.log'
+AGENT_HOST = '0.0.0.0'
+AGENT_PORT = 5002
+# Worker threads for agent requests (pushes are serialized anyway)
+AGENT_THREADS = 4
+# Seconds in-flight requests get to finish on SIGTERM/SIGINT
+SHUTDOWN_TIMEOUT = 10
+# Seconds the agent waits on the local metrics endpoint
+METRICS_TIMEOUT = 2
+# Seconds a newly started server gets to open METRICS_PORT
+SERVER_READY_TIMEOUT = 10
+# Shared secret the panel sends as "Authorization: Bearer <token>"; must match
+# the node's token in the panel's nodes.yaml (created on first run)
+TOKEN_FILE = '.agent_token'
+VERSION_HEADER = '# admin-version:'
+
+# libyaml bindings when available, like admin.py
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+app = Flask(__name__)
+_session = requests.Session()
+_config_lock = threading.Lock()
+
+def load_token():
+    """Agent token from OUTLINE_AGENT_TOKEN or TOKEN_FILE, creating the file on first run.
+
+    May return '' (an empty file); main() refuses to start with that.
+    """
+    token = os.environ.get('OUTLINE_AGENT_TOKEN', '').strip()
+    if token:
+        return token
+    try:
+        fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(TOKEN_FILE) as f:
+            return f.read().strip()
+    token = secrets.token_urlsafe(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+def read_generation():
+    """Version number from the admin-version header of the local config (0 if absent)"""
+    try:
+        with open(CONFIG_FILE) as f:
+            first = f.readline()
+    except FileNotFoundError:
+        return 0
+    if first.startswith(VERSION_HEADER):
+        try:
+            return int(first[len(VERSION_HEADER):].strip())
+        except ValueError:
+            pass
+    return 0
+
+def write_config(config, generation):
+    """Atomically replace the local config (temp file, fsync, rename)"""
+    directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"{VERSION_HEADER} {generation}\n")
+            yaml.dump(config, f, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CONFIG_FILE)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def find_server_pids():
+    """PIDs of outline-ss-server processes running on CONFIG_FILE, however they were started"""
+    pattern = f"{re.escape(os.path.basename(BINARY_PATH))}.*-config[= ]{re.escape(CONFIG_FILE)}"
+    try:
+        result = subprocess.run(['pgrep', '-f', pattern], capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    return [int(pid) for pid in result.stdout.split() if pid.isdigit() and int(pid) != os.getpid()]
+
+def reload_server():
+    """SIGHUP the running outline-ss-server, or start it if none is running"""
+    pids = find_server_pids()
+    if pids:
+        for pid in pids:
+            os.kill(pid, signal.SIGHUP)
+        return 'reloaded'
+    with open(SERVER_LOG_FILE, 'a') as log:
+        proc = subprocess.Popen([os.path.abspath(BINARY_PATH), '-config', CONFIG_FILE,
+                                 '-metrics', f"127.0.0.1:{METRICS_PORT}"],
+                                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+    # Only report success once the server is up, like the panel's supervisor
+    deadline = time.monotonic() + SERVER_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}, see {SERVER_LOG_FILE}")
+        try:
+            with socket.create_connection(('127.0.0.1', METRICS_PORT), timeout=0.2):
+                return 'started'
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server started but metrics port {METRICS_PORT} not ready after {SERVER_READY_TIMEOUT}s")
+
+@app.before_request
+def check_token():
+    # main() sets the token; without one nothing is authorized
+    token = app.config.get('AGENT_TOKEN')
+    header = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(header.encode(), f"Bearer {token}".encode()):
+        return jsonify({'error': 'unauthorized'}), 401
+
+@app.route('/health')
+def health():
+    return jsonify({'ok': True, 'generation': read_generation()})
+
+@app.route('/config', methods=['PUT'])
+def put_config():
+    """Install the panel's config; the node keeps its own 'web' section (listen addresses)"""
+    try:
+        generation = int(request.headers.get('X-Config-Version', '0'))
+        pushed = yaml.load(request.get_data(), Loader=YamlLoader)
+        if not isinstance(pushed, dict):
+            raise ValueError("config must be a YAML mapping")
+    except (ValueError, yaml.YAMLError) as e:
+        return jsonify({'ok': False, 'error': f"Invalid config: {e}"}), 400
+
+    with _config_lock:
+        current = read_generation()
+        # Pushes can arrive out of order; never go back to an older config
+        # unless the panel insists (X-Config-Force, e.g. after a restore)
+        if generation and generation <= current and request.headers.get('X-Config-Force') != '1':
+            return jsonify({'ok': True, 'action': 'unchanged', 'generation': current})
+        try:
+            with open(CONFIG_FILE) as f:
+                local = yaml.load(f, Loader=YamlLoader) or {}
+        except FileNotFoundError:
+            local = {}
+        if 'web' in local:
+            pushed['web'] = local['web']
+        try:
+            write_config(pushed, generation)
+            action = reload_server()
+        except Exception as e:
+            return jsonify({'ok': False, 'error': str(e)}), 500
+    return jsonify({'ok': True, 'action': action, 'generation': generation})
+
+@app.route('/metrics')
+def metrics():
+    """Pass the local outline-ss-server metrics through unchanged"""
+    try:
+        response = _session.get(METRICS_URL, timeout=METRICS_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        return jsonify({'error': f"metrics unavailable: {e}"}), 502
+    return app.response_class(response.content, content_type=response.headers.get('Content-Type', 'text/plain'))
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug server with a bounded worker pool, like admin.py's (this file runs alone on nodes)"""
+
+    def __init__(self, host, port, wsgi_app, threads):
+        super().__init__(host, port, wsgi_app)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='agent')
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self.pool.submit(self._handle, request, client_address)
+        except RuntimeError:
+            # Pool already shut down
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def drain(self, timeout):
+        """Wait up to timeout seconds for in-flight requests; True if all finished"""
+        waiter = threading.Thread(target=self.pool.shutdown, kwargs={'wait': True}, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        return not waiter.is_alive()
+
+def serve(host, port, threads=AGENT_THREADS):
+    """Run the agent until SIGTERM/SIGINT, then let in-flight pushes finish"""
+    server = PooledWSGIServer(host, port, app, threads)
+    stopping = threading.Event()
+    def request_stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    threading.Thread(target=server.serve_forever, name='agent-accept', daemon=True).start()
+    app.logger.warning("Serving the agent on http://%s:%s with %d threads", host, server.server_address[1], threads)
+    stopping.wait()
+    server.shutdown()
+    if not server.drain(SHUTDOWN_TIMEOUT):
+        app.logger.warning("Requests still running after %ss", SHUTDOWN_TIMEOUT)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Outline fleet node agent")
+    parser.add_argument('--host', default=AGENT_HOST)
+    parser.add_argument('--port', type=int, default=AGENT_PORT)
+    parser.add_argument('--threads', type=int, default=AGENT_THREADS)
+    args = parser.parse_args(argv)
+    token = load_token()
+    if not token:
+        parser.error(f"empty agent token: put one in {TOKEN_FILE} or OUTLINE_AGENT_TOKEN")
+    app.config['AGENT_TOKEN'] = token
+    # WARNING: the token is sent in clear text; put the agent behind TLS
+    # (e.g. a Caddy site block) or a private network
+    serve(args.host, args.port, args.threads)
+
+if __name__ == '__main__':
+    main()
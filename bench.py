@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""Benchmarks for the admin.py hot paths at several key counts.
+
+    python bench.py                         # 1k, 10k and 100k keys
+    python bench.py --sizes 1000 --output before.json
+
+Each size gets a scratch directory with a synthetic config.yaml, a stub
+outline-ss-server (this script with --serve-metrics) that serves realistic
+shadowsocks_data_bytes series for every key and counts SIGHUP reloads, and
+its own usage.db. Routes are driven through the Flask test client, so the
+numbers are request handling only (no network or WSGI server). Results are
+written as JSON for comparing runs over time.
+"""
+import os
+import argparse
+import http.server
+import json
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+# --- CONFIGURATION ---
+DEFAULT_SIZES = (1000, 10000, 100000)
+# Upper bound on samples per benchmark, and seconds spent on one before
+# stopping early (every benchmark still gets at least MIN_SAMPLES)
+DEFAULT_ITERATIONS = 200
+DEFAULT_BUDGET = 10.0
+MIN_SAMPLES = 3
+BENCH_METRICS_PORT = 19099
+STUB_NAME = 'bench-ss-server'
+SEED = 1234
+
+# --- SYNTHETIC DATA ---
+def synthetic_config(size, rng):
+    """A config like a long-running panel's: named keys, mixed ciphers, expiry dates and quotas"""
+    ciphers = ('chacha20-ietf-poly1305', 'aes-256-gcm', 'aes-128-gcm')
+    today = date.today()
+    keys = []
+    for key_id in range(1, size + 1):
+        key = {
+            'id': key_id,
+            'name': f"user{key_id}-{rng.choice(('alice', 'bob', 'carol', 'dave', 'erin', 'frank'))}",
+            'cipher': ciphers[0] if rng.random() < 0.8 else rng.choice(ciphers),
+            'secret': ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+                              for _ in range(20)),
+        }
+        roll = rng.random()
+        if roll < 0.05:
+            key['expire_date'] = (today - timedelta(days=rng.randint(1, 365))).isoformat()
+        elif roll < 0.6:
+            key['expire_date'] = (today + timedelta(days=rng.randint(1, 365))).isoformat()
+        if rng.random() < 0.2:
+            key['quota_bytes'] = rng.choice((10, 50, 100)) * 10**9
+        keys.append(key)
+    return {
+        'web': {'servers': [{'id': 'server1', 'listen': ['127.0.0.1:8080']}]},
+        'services': [{
+            'listeners': [{'type': 'websocket-stream', 'web_server': 'server1', 'path': '/tcp-ray'},
+                          {'type': 'websocket-packet', 'web_server': 'server1', 'path': '/udp-ray'}],
+            'keys': keys,
+        }],
+    }
+
+def metrics_exposition(key_ids, tick):
+    """Prometheus text shaped like outline-ss-server's, with counters that grow per tick"""
+    lines = [
+        '# HELP shadowsocks_build_info Information on the outline-ss-server build',
+        '# TYPE shadowsocks_build_info gauge',
+        'shadowsocks_build_info{version="1.9.2"} 1',
+        '# HELP shadowsocks_keys Count of access keys',
+        '# TYPE shadowsocks_keys gauge',
+        f"shadowsocks_keys {len(key_ids)}",
+        '# HELP shadowsocks_tcp_probes Histogram of number of bytes from client',
+        '# TYPE shadowsocks_tcp_probes histogram',
+    ]
+    for bucket in ('0', '49', '50', '51', '73', '91', '+Inf'):
+        lines.append(f'shadowsocks_tcp_probes_bucket{{port="8080",status="ERR_CIPHER",le="{bucket}"}} {tick}')
+    lines += ['# HELP shadowsocks_data_bytes Bytes transferred by the proxy',
+              '# TYPE shadowsocks_data_bytes counter']
+    for key_id in key_ids:
+        # Roughly a third of the keys are idle; active ones grow every scrape
+        base = (key_id * 7919) % 5_000_000_000
+        step = 0 if key_id % 3 == 0 else (key_id % 97 + 1) * 100_000
+        for proto in ('tcp', 'udp'):
+            for direction in ('c>p', 'p>t', 't>p', 'p>c'):
+                value = base + step * tick
+                lines.append(f'shadowsocks_data_bytes{{access_key="{key_id}",dir="{direction}",proto="{proto}"}} {value}')
+    lines.append('# HELP shadowsocks_time_to_cipher_ms Time needed to find the cipher')
+    lines.append('# TYPE shadowsocks_time_to_cipher_ms histogram')
+    for bucket in ('0.1', '1', '10', '+Inf'):
+        lines.append(f'shadowsocks_time_to_cipher_ms_bucket{{proto="tcp",found_key="true",le="{bucket}"}} {tick * 10}')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def read_key_ids(config_path):
+    import yaml
+    with open(config_path) as f:
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+    ids = []
+    for service in config.get('services') or []:
+        ids += [int(key['id']) for key in service.get('keys') or []]
+    return ids
+
+def serve_metrics(argv):
+    """Stub outline-ss-server: '-config FILE -metrics HOST:PORT', reloads keys on SIGHUP"""
+    def flag(name):
+        # Go-style flags: '-name value' or '-name=value'
+        for i, arg in enumerate(argv):
+            if arg == name:
+                return argv[i + 1]
+            if arg.startswith(name + '='):
+                return arg[len(name) + 1:]
+        raise SystemExit(f"missing {name}")
+
+    config_path = flag('-config')
+    host, port = flag('-metrics').rsplit(':', 1)
+    state = {'key_ids': read_key_ids(config_path), 'tick': 0, 'reloads': 0}
+
+    def reload(signum, frame):
+        state['key_ids'] = read_key_ids(config_path)
+        state['reloads'] += 1
+
+    signal.signal(signal.SIGHUP, reload)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            state['tick'] += 1
+            body = metrics_exposition(state['key_ids'], state['tick'])
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    http.server.ThreadingHTTPServer((host, int(port)), Handler).serve_forever()
+
+# --- MEASUREMENT ---
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_samples) - 1, round(fraction * len(sorted_samples) + 0.5) - 1))
+    return sorted_samples[index]
+
+def measure(name, size, func, iterations, budget, setup=None):
+    """Time func() up to iterations times or budget seconds; returns a result dict in ms"""
+    samples = []
+    deadline = time.monotonic() + budget
+    while len(samples) < iterations and (len(samples) < MIN_SAMPLES or time.monotonic() < deadline):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    total = sum(samples)
+    result = {
+        'name': name,
+        'keys': size,
+        'samples': len(samples),
+        'mean_ms': total / len(samples) * 1000,
+        'min_ms': samples[0] * 1000,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p90_ms': percentile(samples, 0.90) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+        'throughput_per_s': len(samples) / total if total else None,
+    }
+    print(f"{size:>7} keys  {name:<28} p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+          f"({result['samples']} samples)", flush=True)
+    return result
+
+def expect(status):
+    """Wrap a test client call so a wrong status fails the run instead of timing an error page"""
+    def check(response):
+        if response.status_code != status:
+            raise RuntimeError(f"{response.request.method} {response.request.path} returned "
+                               f"{response.status_code}, expected {status}")
+        return response
+    return check
+
+def bench_size(admin, size, iterations, budget, rng):
+    """Run every benchmark against a fresh size-key config in the current directory"""
+    sidecar = admin.CONFIG_FILE + admin.CONFIG_SNAPSHOT_SUFFIX if admin.CONFIG_SNAPSHOT_SUFFIX else None
+    for stale in ('config.yaml', sidecar, 'usage.db', 'usage.db-wal', 'usage.db-shm',
+                  admin.USERS_DB_FILE, admin.USERS_DB_FILE + '-wal', admin.USERS_DB_FILE + '-shm'):
+        if stale and os.path.exists(stale):
+            os.unlink(stale)
+    admin.user_store = admin.open_user_store()
+    config = synthetic_config(size, rng)
+    admin.save_config(config, generation=1)
+    admin.user_store.render_server_config()
+    admin.usage_history = admin.UsageHistory(admin.USAGE_DB_FILE)
+    admin.metrics_scraper.snapshot = admin.MetricsSnapshot({}, version=0)
+    admin.rendered_configs = admin.RenderedConfigCache(admin.CLIENT_CONFIG_CACHE_SIZE)
+
+    # Start the stub server the way the panel would and wait for its metrics port
+    event = admin.supervisor.apply()
+    if not event['ok']:
+        raise RuntimeError(f"stub server did not start: {event['error']}")
+    secrets_ = [key['secret'] for key in config['services'][0]['keys']]
+    client = admin.app.test_client()
+    ok, redirect = expect(200), expect(302)
+    results = []
+
+    def run(name, func, setup=None, n=iterations):
+        results.append(measure(name, size, func, n, budget, setup))
+
+    def cold_start():
+        # A new store object has nothing in memory, like a freshly started worker
+        admin.user_store = admin.open_user_store()
+        admin.config_cache.invalidate()
+
+    def drop_snapshot():
+        cold_start()
+        if sidecar and os.path.exists(sidecar):
+            os.unlink(sidecar)
+
+    if admin.USER_STORE == 'yaml':
+        run('load_config (cold, YAML)', admin.load_config, setup=drop_snapshot,
+            n=max(MIN_SAMPLES, iterations // 20))
+    run('load_config (cold)', admin.load_config, setup=cold_start,
+        n=max(MIN_SAMPLES, iterations // 20))
+    run('load_config (cached)', admin.load_config)
+    run('metrics scrape', admin.metrics_scraper.scrape_once, n=max(MIN_SAMPLES, iterations // 10))
+    run('get_metrics', admin.get_metrics)
+    run('GET /', lambda: ok(client.get('/')))
+    run('GET / (search)', lambda: ok(client.get('/?search=alice&sort=usage&order=desc')))
+    run('GET /dashboard/data', lambda: ok(client.get('/dashboard/data')))
+    run('GET /api (hit)', lambda: ok(client.get(f"/api?key={rng.choice(secrets_)}")))
+    run('GET /api (miss)', lambda: expect(404)(client.get(f"/api?key=guess-{rng.randrange(10 ** 12)}")))
+    run('GET /api (miss, cached)', lambda: expect(404)(client.get('/api?key=not-a-real-secret')))
+
+    def clear_flashes():
+        with client.session_transaction() as session:
+            session.clear()
+
+    run('POST /add', lambda: redirect(client.post('/add', data={'expire_date': ''})), setup=clear_flashes,
+        n=max(MIN_SAMPLES, iterations // 10))
+
+    def rename():
+        key = rng.choice(admin.load_snapshot().keys)
+        redirect(client.post(f"/update/{key['id']}", data={
+            'name': f"renamed-{rng.randrange(10 ** 6)}", 'cipher': key['cipher'], 'secret': key['secret'],
+            'expire_date': key.get('expire_date') or ''}))
+
+    run('POST /update (rename)', rename, setup=clear_flashes, n=max(MIN_SAMPLES, iterations // 10))
+    # Reloads are queued by /add; let them finish before the next size
+    admin.reload_queue.flush()
+
+    for pid in admin.supervisor.find_pids():
+        os.kill(pid, signal.SIGTERM)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+def port_free(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(('127.0.0.1', port)) != 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark admin.py hot paths")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help="max samples per benchmark")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help="seconds per benchmark")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args(argv)
+
+    if not port_free(BENCH_METRICS_PORT):
+        parser.error(f"port {BENCH_METRICS_PORT} is in use (stale stub server?)")
+    output = os.path.abspath(args.output)
+    started_at = datetime.now().isoformat(timespec='seconds')
+    workdir = tempfile.mkdtemp(prefix='outline-bench-')
+    stub = os.path.join(workdir, STUB_NAME)
+    with open(stub, 'w') as f:
+        f.write(f"#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} --serve-metrics \"$@\"\n")
+    os.chmod(stub, 0o755)
+
+    # admin.py keeps its state files next to the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    import admin
+    admin.BINARY_PATH = stub
+    admin.METRICS_PORT = BENCH_METRICS_PORT
+    admin.METRICS_URL = f"http://127.0.0.1:{BENCH_METRICS_PORT}/metrics"
+    admin.SERVER_LOG_FILE = os.path.join(workdir, 'outline.log')
+    # Scrapes and expiry run when the benchmark says so, not on background threads
+    admin._background_started = True
+    # Every benchmark request comes from one address; measure the handlers, not the limiter
+    admin.api_limiter = admin.TokenBucketLimiter(float('inf'), 0, 1)
+    admin.app.logger.disabled = True
+
+    rng = random.Random(SEED)
+    results = []
+    try:
+        for size in args.sizes:
+            results += bench_size(admin, size, args.iterations, args.budget, rng)
+    finally:
+        for pid in admin.supervisor.find_pids():
+            os.kill(pid, signal.SIGTERM)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'started_at': started_at,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'budget_s': args.budget,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve-metrics':
+        serve_metrics(sys.argv[2:])
+    else:
+        main()
@@ -61,7 +61,8 @@ $DOMAIN:443 {
 $DOMAIN:8443 {
     # SSL: Point to the Certbot certificates
 
-    # Proxy: Forward traffic to Outline
+    # Proxy: public /api goes to its own listener, everything else to the admin UI
+    reverse_proxy /api* 127.0.0.1:5001
     reverse_proxy 127.0.0.1:5000
 }
 EOF
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admin  # noqa: E402
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory with admin's module-level store and cache reset"""
+    monkeypatch.chdir(tmp_path)
+    store = admin.SqliteUserStore(admin.USERS_DB_FILE, admin.CONFIG_FILE)
+    monkeypatch.setattr(admin, 'user_store', store)
+    monkeypatch.setattr(admin, 'config_cache', admin.ConfigCache())
+    yield tmp_path
+    if store._db is not None:
+        store._db.close()
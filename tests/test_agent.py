@@ -0,0 +1,21 @@
+import pytest
+
+import agent
+
+def test_empty_token_authorizes_nothing(workdir, monkeypatch):
+    monkeypatch.setitem(agent.app.config, 'AGENT_TOKEN', '')
+    client = agent.app.test_client()
+    assert client.get('/health', headers={'Authorization': 'Bearer '}).status_code == 401
+    assert client.get('/health').status_code == 401
+
+def test_valid_token_is_accepted(workdir, monkeypatch):
+    monkeypatch.setitem(agent.app.config, 'AGENT_TOKEN', 'sesame')
+    client = agent.app.test_client()
+    assert client.get('/health', headers={'Authorization': 'Bearer sesame'}).status_code == 200
+    assert client.get('/health', headers={'Authorization': 'Bearer '}).status_code == 401
+
+def test_main_refuses_an_empty_token(workdir, monkeypatch):
+    monkeypatch.setenv('OUTLINE_AGENT_TOKEN', '  ')
+    (workdir / agent.TOKEN_FILE).write_text('\n')
+    with pytest.raises(SystemExit):
+        agent.main([])
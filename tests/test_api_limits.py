@@ -0,0 +1,65 @@
+import admin
+from test_user_store import base_config, make_key, write_config_yaml
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_blocked_client_recovers_after_refill():
+    clock = Clock()
+    limiter = admin.TokenBucketLimiter(burst=3, rate=2, max_clients=10, clock=clock)
+    assert [limiter.allow('10.0.0.1')[0] for _ in range(3)] == [True, True, True]
+    allowed, retry_after = limiter.allow('10.0.0.1')
+    assert not allowed and retry_after == 0.5
+    # Other clients have their own bucket
+    assert limiter.allow('10.0.0.2') == (True, 0)
+
+    clock.now += 0.4
+    assert not limiter.allow('10.0.0.1')[0]
+    clock.now += 0.1
+    assert limiter.allow('10.0.0.1') == (True, 0)
+    assert not limiter.allow('10.0.0.1')[0]
+
+    # The bucket never fills beyond the burst
+    clock.now += 60
+    assert [limiter.allow('10.0.0.1')[0] for _ in range(4)] == [True, True, True, False]
+
+def test_least_recently_seen_client_is_evicted():
+    clock = Clock()
+    limiter = admin.TokenBucketLimiter(burst=1, rate=0.001, max_clients=2, clock=clock)
+    assert limiter.allow('a')[0] and limiter.allow('b')[0]
+    assert not limiter.allow('a')[0]
+    # 'c' pushes out 'b', the least recently seen, which starts over full
+    assert limiter.allow('c')[0]
+    assert list(limiter._buckets) == ['a', 'c']
+    assert limiter.allow('b')[0]
+    assert list(limiter._buckets) == ['c', 'b']
+
+def test_cached_miss_expires_after_ttl(workdir):
+    write_config_yaml(base_config([make_key(1)]))
+    snapshot = admin.load_snapshot()
+    clock = Clock()
+    misses = admin.NegativeCache(ttl=30, size=10, clock=clock)
+    misses.add('wrong', snapshot)
+    assert misses.contains('wrong')
+    assert not misses.contains('other')
+
+    clock.now += 29.9
+    assert misses.contains('wrong')
+    clock.now += 0.1
+    assert not misses.contains('wrong')
+    assert not misses._entries
+
+def test_cached_miss_voided_by_config_change(workdir):
+    write_config_yaml(base_config([make_key(1)]))
+    misses = admin.NegativeCache(ttl=30, size=10, clock=Clock())
+    misses.add('secret0002', admin.load_snapshot())
+    with admin.config_transaction() as txn:
+        keys = admin.get_keys(txn.config)
+        keys.append(make_key(2))
+        admin.set_keys(txn.config, keys)
+    admin.load_snapshot()
+    assert not misses.contains('secret0002')
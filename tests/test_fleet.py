@@ -0,0 +1,43 @@
+import pytest
+
+import admin
+
+def test_fleet_push_runs_when_local_apply_fails(workdir, monkeypatch):
+    pushed = []
+
+    def broken_apply():
+        raise RuntimeError("server exited with code 1")
+
+    def push():
+        pushed.append(True)
+        return {'n1': {'ok': True, 'error': None}, 'n2': {'ok': False, 'error': 'timeout'}}
+
+    monkeypatch.setattr(admin.user_store, 'render_server_config', lambda: True)
+    monkeypatch.setattr(admin.supervisor, 'apply', broken_apply)
+    monkeypatch.setattr(admin, 'push_to_fleet', push)
+
+    event = admin.apply_server_changes('test')
+    assert pushed
+    assert event['action'] == 'failed' and not event['ok']
+    assert event['error'] == "server exited with code 1"
+    assert event['fleet_error'] == "n2 (timeout)"
+
+def test_fleet_push_error_keeps_local_result(workdir, monkeypatch):
+    def broken_push():
+        raise KeyError('name')
+
+    monkeypatch.setattr(admin.user_store, 'render_server_config', lambda: True)
+    monkeypatch.setattr(admin.supervisor, 'apply', lambda: {'action': 'reload', 'ok': True, 'error': None})
+    monkeypatch.setattr(admin, 'push_to_fleet', broken_push)
+
+    event = admin.apply_server_changes('test')
+    assert event['action'] == 'reload' and event['ok']
+    assert event['fleet_error'] == "'name'"
+
+def test_node_needs_a_token(workdir):
+    registry = admin.NodeRegistry(admin.NODES_FILE)
+    for token in ('', '   '):
+        with pytest.raises(ValueError):
+            registry.add('n1', 'http://10.0.0.1:5002', token)
+    registry.add('n1', 'http://10.0.0.1:5002', 'sesame')
+    assert [(node.name, node.token) for node in registry.nodes()] == [('n1', 'sesame')]
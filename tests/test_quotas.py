@@ -0,0 +1,52 @@
+import time
+from datetime import datetime, timezone
+
+import admin
+from test_user_store import base_config, ids, make_key, write_config_yaml
+
+def next_month(at):
+    moment = datetime.fromtimestamp(at, timezone.utc)
+    year, month = divmod(moment.year * 12 + moment.month, 12)
+    return datetime(year, month + 1, 1, 0, 0, 30, tzinfo=timezone.utc).timestamp()
+
+def test_key_over_quota_is_suspended_and_restored_after_restart(workdir, monkeypatch):
+    reloads = []
+    monkeypatch.setattr(admin, 'usage_history', admin.UsageHistory(admin.USAGE_DB_FILE))
+    monkeypatch.setattr(admin.reload_queue, 'request', reloads.append)
+    write_config_yaml(base_config([make_key(1, quota_bytes=1000), make_key(2, quota_bytes=5000)]))
+    now = time.time()
+    enforcer = admin.QuotaEnforcer()
+    deltas = admin.usage_history.record({'1': 1500, '2': 1500}, now)
+    assert enforcer.check(deltas, now) == [1]
+
+    snapshot = admin.load_snapshot()
+    assert ids(snapshot.keys) == [2]
+    assert ids(snapshot.disabled_keys) == [1]
+    assert snapshot.disabled_keys[0]['disabled_reason'] == 'quota'
+    assert len(reloads) == 1
+
+    # A restart within the same month keeps the suspension
+    assert admin.QuotaEnforcer().check({}, now + 1) == []
+    assert ids(admin.load_snapshot().disabled_keys) == [1]
+
+    # The first scrape of the next month in a new process lifts it
+    restarted = admin.QuotaEnforcer()
+    assert restarted.check({}, next_month(now)) == []
+    snapshot = admin.load_snapshot()
+    assert sorted(ids(snapshot.keys)) == [1, 2]
+    assert not snapshot.disabled_keys
+    assert 'disabled_reason' not in snapshot.find(1)
+    assert len(reloads) == 2
+
+def test_restore_leaves_other_suspensions_alone(workdir, monkeypatch):
+    monkeypatch.setattr(admin.reload_queue, 'request', lambda reason: None)
+    now = time.time()
+    write_config_yaml(base_config([make_key(1)], disabled=[
+        make_key(2, disabled_reason='manual', disabled_at='2020-01-01T00:00:00'),
+        make_key(3, disabled_reason='quota', disabled_at='2020-01-01T00:00:00', expire_date='2020-02-01'),
+        make_key(4, disabled_reason='quota', disabled_at='2020-01-01T00:00:00'),
+    ]))
+    admin.QuotaEnforcer().check({}, now)
+    snapshot = admin.load_snapshot()
+    assert sorted(ids(snapshot.keys)) == [1, 4]
+    assert ids(snapshot.disabled_keys) == [2, 3]
@@ -0,0 +1,54 @@
+import time
+
+import admin
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_requests_within_debounce_apply_once(workdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(admin, 'RELOAD_DEBOUNCE', 0.3)
+    monkeypatch.setattr(admin, 'RELOAD_MAX_DELAY', 5)
+    monkeypatch.setattr(admin, 'apply_server_changes', lambda reason: calls.append(reason) or {'ok': True})
+    queue = admin.ReloadQueue()
+    try:
+        for n in range(5):
+            assert queue.request(f"change {n}") == n + 1
+        wait_for(lambda: queue.last_applied is not None)
+        assert calls == ["5 changes (change 0; change 1; change 2; ...)"]
+        assert queue.last_applied['changes'] == 5
+        assert queue.state()['pending'] == 0 and queue.state()['applying'] == 0
+    finally:
+        queue.stop(5)
+
+def test_failing_batch_records_failed_event(workdir, monkeypatch):
+    calls = []
+
+    def apply(reason):
+        calls.append(reason)
+        if len(calls) == 1:
+            raise KeyError('name')
+        return {'action': 'reload', 'ok': True}
+
+    monkeypatch.setattr(admin, 'RELOAD_DEBOUNCE', 0.05)
+    monkeypatch.setattr(admin, 'apply_server_changes', apply)
+    queue = admin.ReloadQueue()
+    try:
+        queue.request("first")
+        assert queue.flush(5)
+        event = queue.last_applied['event']
+        assert event['action'] == 'failed' and not event['ok'] and event['error'] == "'name'"
+        assert queue.state()['applying'] == 0
+
+        # The same worker thread keeps applying later batches
+        thread = queue._thread
+        queue.request("second")
+        assert queue.flush(5)
+        assert queue._thread is thread and thread.is_alive()
+        assert queue.last_applied['event']['action'] == 'reload'
+        assert calls == ["first", "second"]
+    finally:
+        queue.stop(5)
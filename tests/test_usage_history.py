@@ -0,0 +1,65 @@
+from datetime import datetime, timezone
+
+import admin
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+def test_counter_reset_adds_the_new_value(workdir):
+    history = admin.UsageHistory(admin.USAGE_DB_FILE)
+    start = utc(2026, 3, 10, 12, 0)
+    assert history.record({'1': 1000}, start) == {'1': 1000}
+    assert history.record({'1': 1500}, start + 60) == {'1': 500}
+    # The server restarted: its counter starts again from zero
+    assert history.record({'1': 200}, start + 120) == {'1': 200}
+    assert history.record({'1': 200}, start + 180) == {}
+    assert history.totals()['1'] == 1700
+
+    reopened = admin.UsageHistory(admin.USAGE_DB_FILE)
+    assert reopened.totals()['1'] == 1700
+    assert reopened.month_total('1', 202603) == 1700
+    resets = reopened._connect().execute("SELECT resets FROM counters WHERE key_id = '1'").fetchone()[0]
+    assert resets == 1
+
+def test_node_counters_reset_independently(workdir):
+    history = admin.UsageHistory(admin.USAGE_DB_FILE)
+    start = utc(2026, 3, 10, 12, 0)
+    history.record({'1': 1000, '1@n2': 400}, start)
+    # Only n2 restarted; the local counter keeps growing
+    assert history.record({'1': 1100, '1@n2': 50}, start + 60) == {'1': 150}
+    assert history.totals()['1'] == 1550
+
+def test_older_scrape_is_ignored(workdir):
+    history = admin.UsageHistory(admin.USAGE_DB_FILE)
+    start = utc(2026, 3, 10, 12, 0)
+    history.record({'1': 1000}, start)
+    assert history.record({'1': 5000}, start - 1) == {}
+    assert history.record({'1': 5000}, start) == {}
+    assert history.totals()['1'] == 1000
+
+def test_bucket_boundaries(workdir):
+    history = admin.UsageHistory(admin.USAGE_DB_FILE)
+    history.record({'1': 100}, utc(2026, 3, 10, 22, 59, 59))
+    history.record({'1': 150}, utc(2026, 3, 10, 23, 0))
+    history.record({'1': 170}, utc(2026, 3, 10, 23, 59, 59))
+    history.record({'1': 200}, utc(2026, 3, 11, 0, 0))
+
+    assert history.series('1') == [(utc(2026, 3, 10, 22), 100), (utc(2026, 3, 10, 23), 70),
+                                   (utc(2026, 3, 11, 0), 30)]
+    assert history.series('1', 'daily') == [(utc(2026, 3, 10), 170), (utc(2026, 3, 11), 30)]
+
+def test_month_rollover(workdir):
+    history = admin.UsageHistory(admin.USAGE_DB_FILE)
+    history.record({'1': 1000, '2': 10}, utc(2026, 1, 31, 23, 59))
+    assert history.month_total('1', 202601) == 1000
+
+    history.record({'1': 1300, '2': 10}, utc(2026, 2, 1, 0, 0, 30))
+    assert history.month_total('1', 202602) == 300
+    assert history.month_total('1', 202601) == 0
+    # Key 2 moved nothing this month
+    assert history.month_total('2', 202602) == 0
+    assert history.totals() == {'1': 1300, '2': 10}
+
+    reopened = admin.UsageHistory(admin.USAGE_DB_FILE)
+    assert reopened.month_total('1', 202602) == 300
+    assert reopened.month_total('2', 202602) == 0
@@ -0,0 +1,138 @@
+import yaml
+
+import admin
+
+def make_key(key_id, **fields):
+    return dict({'id': str(key_id), 'port': 9000, 'cipher': admin.DEFAULT_CIPHER,
+                 'secret': f"secret{key_id:04d}"}, **fields)
+
+def write_config_yaml(config, generation=3):
+    with open(admin.CONFIG_FILE, 'w') as f:
+        f.write(f"{admin.VERSION_HEADER} {generation}\n")
+        yaml.safe_dump(config, f, sort_keys=False)
+
+def base_config(keys, disabled=()):
+    config = {'services': [{'listeners': [{'type': 'websocket-stream', 'web_server': 'ws', 'path': '/tcp'}],
+                            'keys': list(keys)}]}
+    if disabled:
+        config['disabled_keys'] = list(disabled)
+    return config
+
+def rows(store):
+    """{id: (state, shard, seq)} straight from the database"""
+    return {key_id: (state, shard, seq) for key_id, state, shard, seq in
+            store._db.execute("SELECT id, state, shard, seq FROM users")}
+
+def ids(keys):
+    return [int(key['id']) for key in keys]
+
+def test_import_then_save_round_trip(workdir):
+    original = base_config([make_key(1, name='alice', expire_date='2030-01-01'), make_key(2)],
+                           disabled=[make_key(3, disabled_reason='manual')])
+    write_config_yaml(original)
+
+    snapshot = admin.load_snapshot()
+    assert snapshot.generation == 4
+    assert admin.thaw(snapshot.config) == original
+    assert (workdir / 'config.yaml.pre-import').exists()
+
+    with admin.config_transaction() as txn:
+        admin.get_keys(txn.config)[0]['name'] = 'alicia'
+
+    reopened = admin.SqliteUserStore(admin.USERS_DB_FILE, admin.CONFIG_FILE)
+    stamp, config, generation, _ = reopened.load()
+    assert generation == 5
+    expected = admin.thaw(admin.load_snapshot().config)
+    assert expected['services'][0]['keys'][0]['name'] == 'alicia'
+    assert admin.thaw(config) == expected
+
+def test_delete_and_append_keep_sequence_numbers(workdir):
+    write_config_yaml(base_config([make_key(i) for i in range(1, 6)]))
+    admin.load_snapshot()
+    store = admin.user_store
+    before = rows(store)
+
+    with admin.config_transaction() as txn:
+        keys = [key for key in admin.get_keys(txn.config) if key['id'] != '3']
+        keys.append(make_key(6))
+        admin.set_keys(txn.config, keys)
+
+    after = rows(store)
+    assert 3 not in after
+    for key_id in (1, 2, 4, 5):
+        assert after[key_id] == before[key_id]
+    assert after[6][2] > after[5][2]
+
+    reopened = admin.SqliteUserStore(admin.USERS_DB_FILE, admin.CONFIG_FILE)
+    assert ids(admin.get_keys(reopened.load()[1])) == [1, 2, 4, 5, 6]
+
+def test_shard_move(workdir):
+    write_config_yaml(base_config([make_key(i) for i in range(1, 7)]))
+    admin.load_snapshot()
+
+    with admin.config_transaction() as txn:
+        moved = admin.rebalance_shards(txn.config, 2)
+    assert moved == 3
+
+    store = admin.user_store
+    assert {key_id: shard for key_id, (_, shard, _) in rows(store).items()} == {i: i % 2 for i in range(1, 7)}
+    config = admin.SqliteUserStore(admin.USERS_DB_FILE, admin.CONFIG_FILE).load()[1]
+    assert config[admin.SHARDS_FIELD] == 2
+    assert [ids(service['keys']) for service in config['services']] == [[2, 4, 6], [1, 3, 5]]
+    assert config['services'][1]['listeners'][0]['path'] == '/tcp-1'
+
+    assert store.render_server_config()
+    with open(admin.CONFIG_FILE) as f:
+        rendered = yaml.safe_load(f)
+    assert admin.SHARDS_FIELD not in rendered
+    assert [ids(service['keys']) for service in rendered['services']] == [[2, 4, 6], [1, 3, 5]]
+
+def test_admin_only_edit_does_not_render(workdir):
+    write_config_yaml(base_config([make_key(1), make_key(2)]))
+    admin.load_snapshot()
+    store = admin.user_store
+    assert store.render_server_config()
+    rendered = (workdir / 'config.yaml').read_text()
+
+    with admin.config_transaction() as txn:
+        key = admin.get_keys(txn.config)[0]
+        key['name'] = 'renamed'
+        key['expire_date'] = '2031-05-01'
+    assert not store.render_server_config()
+    assert (workdir / 'config.yaml').read_text() == rendered
+
+    with admin.config_transaction() as txn:
+        admin.get_keys(txn.config)[0]['secret'] = 'rotated'
+    assert store.render_server_config()
+    with open(admin.CONFIG_FILE) as f:
+        rendered = yaml.safe_load(f)
+    assert rendered['services'][0]['keys'][0] == {'id': '1', 'port': 9000, 'cipher': admin.DEFAULT_CIPHER,
+                                                  'secret': 'rotated'}
+
+def test_other_worker_sees_new_generation(workdir):
+    write_config_yaml(base_config([make_key(1)]))
+    first = admin.SqliteUserStore(admin.USERS_DB_FILE, admin.CONFIG_FILE)
+    second = admin.SqliteUserStore(admin.USERS_DB_FILE, admin.CONFIG_FILE)
+    stamp, config, generation, _ = first.load()
+    assert second.load()[0] == stamp
+
+    updated = admin.thaw(config)
+    updated['services'][0]['keys'].append(make_key(2))
+    first.save(updated, generation + 1)
+
+    assert second.stamp() == (admin.USERS_DB_FILE, generation + 1)
+    new_stamp, refreshed, _, source = second.load(unless_stamp=stamp)
+    assert new_stamp != stamp and source == 'store'
+    assert ids(admin.get_keys(refreshed)) == [1, 2]
+    assert second.load(unless_stamp=new_stamp) is None
+
+    # A save from a worker that missed a generation diffs against the
+    # rows on disk, not its stale copy: key 3 added and key 2 removed here
+    stale = admin.thaw(refreshed)
+    stale['services'][0]['keys'] = [make_key(1, name='one'), make_key(3)]
+    first.save(admin.thaw(first.load()[1]), generation + 2)
+    second.save(stale, generation + 3)
+    assert sorted(rows(second)) == [1, 3]
+    reloaded = first.load()[1]
+    assert ids(admin.get_keys(reloaded)) == [1, 3]
+    assert admin.get_keys(reloaded)[0]['name'] == 'one'